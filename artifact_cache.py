@@ -0,0 +1,208 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import time
+from collections import OrderedDict
+
+CACHE_DIR = "data/cache"
+DATA_DIR = "data"
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+_FINGERPRINTS = OrderedDict()  # id(obj) -> (obj, digest), keeps the objects alive so that ids are not reused
+_MAX_FINGERPRINTS = 64
+
+
+def _remember(obj, digest: str):
+    _FINGERPRINTS[id(obj)] = (obj, digest)
+    _FINGERPRINTS.move_to_end(id(obj))
+    while len(_FINGERPRINTS) > _MAX_FINGERPRINTS:
+        _FINGERPRINTS.popitem(last=False)
+
+
+class ArtifactKey(str):
+    """
+    stands in for a stage artifact by its cache key, e.g. to compute the key of a later stage before the artifact
+    exists. fingerprint returns the key itself, like for an artifact returned by the cache.
+    """
+
+
+def fingerprint(obj) -> str:
+    """
+    content hash of a stage input. Artifacts returned by the cache are identified by their cache key, so chained
+    stages never rehash large intermediate results; any other object is hashed from its pickle on every call.
+    :param obj: a stage input or parameter
+    :return: a hex digest
+    """
+    if isinstance(obj, ArtifactKey):
+        return str(obj)
+    if id(obj) in _FINGERPRINTS and _FINGERPRINTS[id(obj)][0] is obj:
+        return _FINGERPRINTS[id(obj)][1]
+    return hashlib.sha256(pickle.dumps(obj, protocol=4)).hexdigest()
+
+
+def artifact_key(stage: str, arguments: dict) -> str:
+    """
+    cache key of a stage run
+    :param stage: stage name
+    :param arguments: all arguments of the stage (inputs and parameters) by name
+    :return: a hex digest
+    """
+    content = hashlib.sha256(stage.encode("utf8"))
+    for name in sorted(arguments):
+        content.update(f"{name}={fingerprint(arguments[name])};".encode("utf8"))
+    return content.hexdigest()
+
+
+def stage_key(func, stage: str, *args, **kwargs) -> str:
+    """
+    cache key of func(*args, **kwargs) for a function decorated with cached_stage, without running it
+    :param func: the stage function
+    :param stage: its stage name
+    :return: a hex digest
+    """
+    arguments = inspect.signature(func).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    return artifact_key(stage, dict(arguments.arguments))
+
+
+def _artifact_path(cache_dir: str, stage: str, key: str) -> str:
+    return os.path.join(cache_dir, f"{stage}-{key}.pkl")
+
+
+def load_artifact(stage: str, key: str, cache_dir: str = CACHE_DIR):
+    """
+    :return: the cached artifact of a stage run, None if there is none
+    """
+    path = _artifact_path(cache_dir, stage, key)
+    if not os.path.exists(path):
+        return None
+    print(f"loading {stage} from cache {path}")
+    artifact = pickle.load(open(path, "rb"))
+    os.utime(path)
+    _remember(artifact, key)
+    return artifact
+
+
+def store_artifact(stage: str, key: str, artifact, cache_dir: str = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+    """
+    store the artifact of a stage run under its key
+    """
+    path = _artifact_path(cache_dir, stage, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    pickle.dump(artifact, open(path + ".tmp", "wb"))
+    os.replace(path + ".tmp", path)
+    evict(cache_dir, max_bytes, keep=path)
+    _remember(artifact, key)
+
+
+def cached(stage: str, compute, arguments: dict, cache_dir: str = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+    """
+    load the artifact of a stage run from the cache, or compute and store it if the key is unknown
+    :param stage: stage name
+    :param compute: a callable without arguments producing the artifact
+    :param arguments: all arguments of the stage (inputs and parameters) by name
+    :param cache_dir: cache directory
+    :param max_bytes: cache size limit, least recently used entries are evicted beyond it
+    :return: the artifact
+    """
+    key = artifact_key(stage, arguments)
+    if os.path.exists(_artifact_path(cache_dir, stage, key)):
+        return load_artifact(stage, key, cache_dir)
+    artifact = compute()
+    store_artifact(stage, key, artifact, cache_dir, max_bytes)
+    return artifact
+
+
+def cached_stage(stage: str, artifact: str = None):
+    """
+    decorator adding the `cache` and `data_dir` keywords to a pipeline stage. With cache=None (default) the stage runs
+    as before, with cache set to a directory the stage result is looked up by the hash of all its arguments. An
+    explicit pkl argument still wins over the cache.
+    A computed result is also written to data_dir/artifact (data/{stage}.pkl by default), results loaded from pkl or
+    from the cache are not written again. data_dir=None disables the write.
+    :param stage: stage name used for the cache entries
+    :param artifact: file name of the stage result in data_dir, {stage}.pkl by default
+    """
+    artifact = artifact or f"{stage}.pkl"
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, cache=None, data_dir=DATA_DIR, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            if arguments.arguments.get("pkl") is not None:
+                return func(*args, **kwargs)
+
+            def compute():
+                result = func(*args, **kwargs)
+                if data_dir is not None:
+                    os.makedirs(data_dir, exist_ok=True)
+                    pickle.dump(result, open(os.path.join(data_dir, artifact), "wb"))
+                return result
+            if cache is None:
+                return compute()
+            return cached(stage, compute, dict(arguments.arguments), cache)
+        return wrapper
+    return decorator
+
+
+def list_entries(cache_dir: str = CACHE_DIR) -> list:
+    """
+    list the cache entries, most recently used first
+    :param cache_dir: cache directory
+    :return: [{"stage": ..., "key": ..., "path": ..., "size": bytes, "last_used": timestamp}, ...]
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(".pkl"):
+            continue
+        stage, key = file_name[:-len(".pkl")].rsplit("-", 1)
+        path = os.path.join(cache_dir, file_name)
+        stat = os.stat(path)
+        entries.append({"stage": stage, "key": key, "path": path, "size": stat.st_size, "last_used": stat.st_mtime})
+    return sorted(entries, key=lambda x: x["last_used"], reverse=True)
+
+
+def evict(cache_dir: str = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES, keep: str = None) -> list:
+    """
+    remove least recently used entries until the cache is smaller than max_bytes
+    :param cache_dir: cache directory
+    :param max_bytes: cache size limit
+    :param keep: a path which must not be evicted
+    :return: list of removed entries
+    """
+    entries, removed = list_entries(cache_dir), []
+    total = sum(entry["size"] for entry in entries)
+    for entry in reversed(entries):
+        if total <= max_bytes:
+            break
+        if entry["path"] == keep:
+            continue
+        os.remove(entry["path"])
+        total -= entry["size"]
+        removed.append(entry)
+    return removed
+
+
+def purge(cache_dir: str = CACHE_DIR, stage: str = None, older_than: float = None) -> list:
+    """
+    remove cache entries
+    :param cache_dir: cache directory
+    :param stage: if provided, only entries of this stage are removed
+    :param older_than: if provided, only entries not used for this many seconds are removed
+    :return: list of removed entries
+    """
+    removed = []
+    for entry in list_entries(cache_dir):
+        if stage is not None and entry["stage"] != stage:
+            continue
+        if older_than is not None and time.time() - entry["last_used"] < older_than:
+            continue
+        os.remove(entry["path"])
+        removed.append(entry)
+    return removed
@@ -0,0 +1,231 @@
+"""
+command line entry point, one subcommand per stage, e.g.
+
+    python cli.py snapshots --end-time 2016-08-01 --window-size 30
+    python cli.py communities --mode parallel
+    python cli.py report --events
+
+Stages read their inputs from the pickles of the previous stages in data/ and write their own, like test.py.
+Each subcommand imports only the modules it needs, --timing prints the startup and run time.
+"""
+import time
+
+_START = time.perf_counter()
+
+import argparse
+import json
+import os
+import pickle
+import sys
+from datetime import datetime as dt
+
+DATA_DIR = "data"
+
+
+def _load(name: str):
+    path = os.path.join(DATA_DIR, f"{name}.pkl")
+    if not os.path.exists(path):
+        sys.exit(f"{path} does not exist, run the stage producing it first")
+    return pickle.load(open(path, "rb"))
+
+
+def _read_jsonl(path: str) -> list:
+    return [json.loads(line)["data"] for line in open(path, encoding="utf8")]
+
+
+def ingest(args):
+    from ingest import ingest_edge_log
+    edge_log = ingest_edge_log(args.nodes, args.edges, args.edge_log)
+    print(f"{len(edge_log['nodes'])} nodes and {len(edge_log['day'])} edges written to {args.edge_log}")
+
+
+def snapshots(args):
+    from generate_snapshots import generate_snapshots
+    end_time = dt.strptime(args.end_time, "%Y-%m-%d")
+    if args.edge_log is not None:
+        from ingest import load_edge_log
+        result = generate_snapshots(end_time, args.window_size, None, None, edge_log=load_edge_log(args.edge_log),
+                                    store=args.store)
+    else:
+        result = generate_snapshots(end_time, args.window_size, _read_jsonl(args.edges), _read_jsonl(args.nodes),
+                                    store=args.store)
+    print(f"{len(result['timestamps'])} snapshots")
+
+
+def stream(args):
+    from streaming import stream_pipeline
+    end_time = dt.strptime(args.end_time, "%Y-%m-%d")
+    if args.edge_log is not None:
+        from ingest import load_edge_log
+        edges, nodes, edge_log = None, None, load_edge_log(args.edge_log)
+    else:
+        edges, nodes, edge_log = _read_jsonl(args.edges), _read_jsonl(args.nodes), None
+    result = stream_pipeline(end_time, args.window_size, edges, nodes, path=args.output, edge_log=edge_log,
+                             community_mode=args.mode, seed=args.seed, alpha=args.alpha, beta=args.beta,
+                             method=args.method, engine=args.engine, store_snapshots=not args.no_snapshots)
+    network = result["meta_community_network"]
+    print(f"{len(result['timestamps'])} snapshots, meta community network with {network.number_of_nodes()} nodes "
+          f"and {network.number_of_edges()} edges in {args.output}")
+
+
+def communities(args):
+    from community_operations import static_community_detection
+    result = static_community_detection(_load("snapshots"), mode=args.mode, seed=args.seed, processes=args.processes)
+    print(f"{sum(len(c.communities) for c in result)} communities in {len(result)} snapshots")
+
+
+def positions(args):
+    from community_operations import social_position_score
+    social_position_score(_load("snapshots"), engine=args.engine, processes=args.processes)
+
+
+def meta(args):
+    from community_operations import meta_community_network_generation
+    network = meta_community_network_generation(_load("communities"), _load("social_positions"), args.alpha,
+                                                args.beta, method=args.method)
+    print(f"meta community network with {network.number_of_nodes()} nodes and {network.number_of_edges()} edges")
+
+
+def features(args):
+    from community_operations import feature_extraction
+    feature_extraction(_load("snapshots"), _load("communities"), _load("social_positions"), engine=args.engine,
+                       processes=args.processes)
+
+
+def samples(args):
+    from model_operations import generate_samples
+    result = generate_samples(_load("meta_community_network"), _load("features"), paths=args.paths,
+                              history=args.history, relative=args.relative)
+    print(f"{len(result['train_Y'])} training and {len(result['test_Y'])} test samples")
+
+
+def train(args):
+    from model_operations import train_prediction_model
+    result = _load("samples")
+    # samples written before history and relative were stored use the defaults
+    train_prediction_model(result["train_X"], result["train_Y"], args.model, n_jobs=args.jobs,
+                           predictor=args.predictor, history=result.get("history", 3),
+                           relative=result.get("relative", False))
+
+
+def explain(args):
+    from model_operations import compute_shap_values
+    result = _load("samples")
+    values, _ = compute_shap_values(_load("explainer"), result["train_X"], path=args.output,
+                                    processes=args.processes, subsample=args.subsample, labels=result["train_Y"])
+    print(f"shap values of shape {values.shape} in {args.output}")
+
+
+def report(args):
+    if args.events:
+        from report import evolution_event_distribution_report
+        evolution_event_distribution_report(_load("snapshots")["timestamps"], _load("meta_community_network"))
+    if args.shap is not None:
+        import numpy as np
+        from community_operations import FEATURE_NAMES
+        from report import batch_report
+        values = np.load(os.path.join(args.shap, "values.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(args.shap, "indices.npy"))
+        class_names = ["continuing", "growing", "shrinking", "splitting", "merging", "dissolving"]
+        samples = _load("samples")
+        index = batch_report(values, np.asarray(samples["train_X"])[indices], FEATURE_NAMES, class_names[:len(values)],
+                             path=args.output, history=samples.get("history", 3))
+        print(f"report written to {index}")
+
+
+def parser() -> argparse.ArgumentParser:
+    main = argparse.ArgumentParser(description="community-based service ecosystem evolution analysis")
+    main.add_argument("--timing", action="store_true", help="print startup and run time")
+    commands = main.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("ingest", help="convert nodes.json/edges.json to a columnar edge log")
+    command.add_argument("--nodes", default="data/nodes.json")
+    command.add_argument("--edges", default="data/edges.json")
+    command.add_argument("--edge-log", default="data/edge_log")
+    command.set_defaults(run=ingest)
+
+    command = commands.add_parser("snapshots", help="generate the snapshots")
+    command.add_argument("--end-time", default="2016-08-01", help="timestamp of the first snapshot")
+    command.add_argument("--window-size", type=int, default=30, help="days between snapshots")
+    command.add_argument("--nodes", default="data/nodes.json")
+    command.add_argument("--edges", default="data/edges.json")
+    command.add_argument("--edge-log", help="read an ingested edge log instead of the JSON files")
+    command.add_argument("--store", help="also write a snapshot store to this directory")
+    command.set_defaults(run=snapshots)
+
+    command = commands.add_parser("stream", help="snapshots, communities, positions, meta and features in one "
+                                                 "bounded-memory pass, results spilled to --output")
+    command.add_argument("--end-time", default="2016-08-01", help="timestamp of the first snapshot")
+    command.add_argument("--window-size", type=int, default=30, help="days between snapshots")
+    command.add_argument("--nodes", default="data/nodes.json")
+    command.add_argument("--edges", default="data/edges.json")
+    command.add_argument("--edge-log", help="read an ingested edge log instead of the JSON files")
+    command.add_argument("--output", default="data/stream")
+    command.add_argument("--mode", choices=["parallel", "incremental"], default="parallel")
+    command.add_argument("--seed", type=int, default=0)
+    command.add_argument("--alpha", type=float, default=0.5)
+    command.add_argument("--beta", type=float, default=0.5)
+    command.add_argument("--method", choices=["index", "full", "sparse"], default="index")
+    command.add_argument("--engine", choices=["sweep", "community"], default="sweep")
+    command.add_argument("--no-snapshots", action="store_true", help="do not keep the snapshots")
+    command.set_defaults(run=stream)
+
+    command = commands.add_parser("communities", help="detect the communities of every snapshot")
+    command.add_argument("--mode", choices=["serial", "parallel", "incremental"], default="serial")
+    command.add_argument("--seed", type=int, default=0)
+    command.add_argument("--processes", type=int)
+    command.set_defaults(run=communities)
+
+    command = commands.add_parser("positions", help="compute the social position (PageRank) scores")
+    command.add_argument("--engine", choices=["networkx", "sparse"], default="networkx")
+    command.add_argument("--processes", type=int)
+    command.set_defaults(run=positions)
+
+    command = commands.add_parser("meta", help="build the meta community network")
+    command.add_argument("--alpha", type=float, default=0.5)
+    command.add_argument("--beta", type=float, default=0.5)
+    command.add_argument("--method", choices=["index", "full", "sparse"], default="index")
+    command.set_defaults(run=meta)
+
+    command = commands.add_parser("features", help="extract the community features")
+    command.add_argument("--engine", choices=["sweep", "community"], default="sweep")
+    command.add_argument("--processes", type=int)
+    command.set_defaults(run=features)
+
+    command = commands.add_parser("samples", help="generate the training and test samples")
+    command.add_argument("--paths", choices=["layered", "shortest"], default="layered")
+    command.add_argument("--history", type=int, default=3)
+    command.add_argument("--relative", action="store_true")
+    command.set_defaults(run=samples)
+
+    command = commands.add_parser("train", help="train the prediction model")
+    command.add_argument("--model", default="random_forest", help="a key of model_operations.CLASSIFIERS")
+    command.add_argument("--jobs", type=int)
+    command.add_argument("--predictor", help="also export the model for prediction_service to this file")
+    command.set_defaults(run=train)
+
+    command = commands.add_parser("explain", help="compute the SHAP values of the training samples")
+    command.add_argument("--output", default="data/shap")
+    command.add_argument("--processes", type=int)
+    command.add_argument("--subsample", type=int)
+    command.set_defaults(run=explain)
+
+    command = commands.add_parser("report", help="write the html reports")
+    command.add_argument("--events", action="store_true", help="evolution event distribution")
+    command.add_argument("--shap", nargs="?", const="data/shap", help="summary and dependency reports of these SHAP "
+                                                                      "values (default data/shap)")
+    command.add_argument("--output", default="figure/report")
+    command.set_defaults(run=report)
+    return main
+
+
+def main(argv: list = None):
+    args = parser().parse_args(argv)
+    started = time.perf_counter()
+    args.run(args)
+    if args.timing:
+        print(f"startup {started - _START:.2f}s, {args.command} {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
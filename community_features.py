@@ -1,6 +1,114 @@
+import math
+import random
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
 import networkx as nx
 
+from profiling import profiled
+
+# per snapshot centrality results, {graph: {(kind, options): {node: score}}}. Entries go away with the graph.
+_CENTRALITY_CACHE = weakref.WeakKeyDictionary()
+
+
+def _cached_centrality(graph: nx.Graph, kind: str, options: dict, compute) -> dict:
+    key = (kind, tuple(sorted(options.items())))
+    cache = _CENTRALITY_CACHE.setdefault(graph, {})
+    if key not in cache:
+        cache[key] = compute()
+    return cache[key]
+
+
+def clear_centrality_cache(graph: nx.Graph = None):
+    """
+    drop cached centralities, e.g. after a snapshot was modified
+    :param graph: the graph whose results are dropped, all graphs if not provided
+    """
+    if graph is None:
+        _CENTRALITY_CACHE.clear()
+    else:
+        _CENTRALITY_CACHE.pop(graph, None)
+
+
+def _closeness_from_sources(graph: nx.Graph, sources: list) -> dict:
+    """
+    exact closeness centrality of the source nodes, the same computation as nx.closeness_centrality
+    """
+    closeness, len_G = {}, len(graph)
+    for n in sources:
+        sp = nx.single_source_shortest_path_length(graph, n)
+        totsp = sum(sp.values())
+        closeness[n] = 0.0
+        if totsp > 0.0 and len_G > 1:
+            closeness[n] = (len(sp) - 1.0) / totsp * ((len(sp) - 1.0) / (len_G - 1))
+    return closeness
+
+
+def _sampled_closeness(graph: nx.Graph, samples: int, seed: int) -> dict:
+    """
+    closeness centrality estimated from shortest paths to sampled pivots (Eppstein and Wang). In every connected
+    component with more than `samples` nodes, the distance sum of a node is (size / samples) times its distance sum to
+    `samples` pivots drawn uniformly from the component; smaller components are computed exactly.
+    """
+    rng, closeness, len_G = random.Random(seed), {}, len(graph)
+    for component in nx.connected_components(graph):
+        if len(component) <= samples:
+            closeness.update(_closeness_from_sources(graph, list(component)))
+            continue
+        totsp = dict.fromkeys(component, 0)
+        for pivot in rng.sample(sorted(component, key=str), samples):
+            for node, distance in nx.single_source_shortest_path_length(graph, pivot).items():
+                totsp[node] += distance
+        reachable = len(component) - 1.0
+        for node, total in totsp.items():
+            total *= len(component) / samples
+            closeness[node] = reachable / total * (reachable / (len_G - 1)) if total > 0 else 0.0
+    return closeness
+
+
+@profiled
+def closeness_centrality(graph: nx.Graph, processes: int = None, samples: int = None, epsilon: float = None,
+                         seed: int = 0) -> dict:
+    """
+    closeness centrality of every node in the graph, cached per graph. The graph itself is not modified.
+    :param graph: the graph object to be used
+    :param processes: exact mode only, if provided the source nodes are split over this many worker processes
+    :param samples: number of pivots of the sampled approximation (per connected component)
+    :param epsilon: error budget of the sampled approximation, samples = ceil(log(N) / epsilon^2) pivots bound the
+                    additive error of the average distance by epsilon times the diameter with high probability
+    :param seed: random seed of the pivot sampling
+    :return: {node: closeness}, equal to nx.closeness_centrality in the exact mode (no samples nor epsilon)
+    """
+    if samples is None and epsilon is not None:
+        samples = math.ceil(math.log(max(len(graph), 2)) / epsilon ** 2)
+    if samples is not None:
+        return _cached_centrality(graph, "closeness", {"samples": samples, "seed": seed},
+                                  lambda: _sampled_closeness(graph, samples, seed))
+
+    def compute():
+        nodes = list(graph)
+        if processes is None or processes <= 1:
+            return _closeness_from_sources(graph, nodes)
+        chunks = [nodes[start::processes] for start in range(processes)]
+        closeness = {}
+        with ProcessPoolExecutor(processes) as executor:
+            for result in executor.map(_closeness_from_sources, [graph] * processes, chunks):
+                closeness.update(result)
+        return {node: closeness[node] for node in nodes}
+    return _cached_centrality(graph, "closeness", {}, compute)
+
 
+@profiled
+def eigenvector_centrality(graph: nx.Graph) -> dict:
+    """
+    weighted eigenvector centrality of every node in the graph, cached per graph. The graph itself is not modified.
+    :param graph: the graph object to be used
+    :return: {node: eigenvector centrality}
+    """
+    return _cached_centrality(graph, "eigenvector", {}, lambda: nx.eigenvector_centrality(graph, weight="weight"))
+
+
+@profiled
 def community_density(graph: nx.Graph, community: list) -> float:
     """
     $density = \frac{E}{n \times (n-1)}$ where E is the number of edges in the community and n is the number of nodes
@@ -14,6 +122,7 @@ def community_density(graph: nx.Graph, community: list) -> float:
     return density
 
 
+@profiled
 def community_clustering(graph: nx.Graph, community: list) -> float:
     """
     community clustering score is the mean of nodes clustering score
@@ -26,20 +135,20 @@ def community_clustering(graph: nx.Graph, community: list) -> float:
     return score
 
 
-def community_average_closeness_centrality(graph: nx.Graph, community: list, closeness: str = "closeness") -> float:
+@profiled
+def community_average_closeness_centrality(graph: nx.Graph, community: list, **options) -> float:
     """
     community closeness centrality score is the mean of nodes closeness centrality score.
     :param graph: the graph object to be used
     :param community: a list of nodes in the community
+    :param options: options of closeness_centrality, e.g. samples or epsilon for the approximation
     :return: community closeness centrality score
     """
-    if closeness not in graph.nodes[community[0]]:
-        closeness_centrality = dict(nx.closeness_centrality(graph))
-        for key, value in closeness_centrality.items():
-            graph.nodes[key][closeness] = value
-    return sum([graph.nodes[node][closeness] for node in community]) / len(community)
+    closeness = closeness_centrality(graph, **options)
+    return sum([closeness[node] for node in community]) / len(community)
 
 
+@profiled
 def community_degree(graph: nx.Graph, community: list) -> float:
     """
     community degree score is the mean of nodes degree score
@@ -52,21 +161,19 @@ def community_degree(graph: nx.Graph, community: list) -> float:
     return score
 
 
-def community_eigenvector_centrality(graph: nx.Graph, community: list, eigenvector: str = "eigenvector") -> float:
+@profiled
+def community_eigenvector_centrality(graph: nx.Graph, community: list) -> float:
     """
     community eigenvector score is the mean of nodes eigenvector score
     :param graph: the graph object to be used
     :param community: a list of nodes in the community
-    :param eigenvector: where to store the values
     :return: community eigenvector centrality score
     """
-    if eigenvector not in graph.nodes[community[0]]:
-        centrality = nx.eigenvector_centrality(graph, weight="weight")
-        for key, value in centrality.items():
-            graph.nodes[key][eigenvector] = value
-    return sum([graph.nodes[node][eigenvector] for node in community]) / len(community)
+    centrality = eigenvector_centrality(graph)
+    return sum([centrality[node] for node in community]) / len(community)
 
 
+@profiled
 def community_leadership(graph: nx.Graph, community: list) -> float:
     """
     community leadership score reflects the centralization of the community.
@@ -80,6 +187,7 @@ def community_leadership(graph: nx.Graph, community: list) -> float:
     return sum([max_degree - v for v in node_degrees]) / denomin
 
 
+@profiled
 def community_tpratio(graph: nx.Graph, community: list) -> dict:
     """
     Calculate the ratio of each type of nodes in the community
@@ -96,46 +204,58 @@ def community_tpratio(graph: nx.Graph, community: list) -> dict:
     return tpratio
 
 
-def community_activity(graph: nx.Graph, community: list) -> tuple:
+@profiled
+def community_activity(graph: nx.Graph, community: list, activity_scores: list = None) -> tuple:
     """
     Calculate the activity score of the community
     :param graph: the graph object to be used
     :param community: a list of nodes in the community
+    :param activity_scores: weights of the internal edges in any order, if already known (see community_edge_sweep)
     :return: a tuple(max, mean, sum)
     """
-    subgraph = graph.subgraph(community)
-    activity_scores = [d for u, v, d in subgraph.edges(data="weight")]
-    return max(activity_scores), sum(activity_scores) / len(community), sum(activity_scores)
+    if activity_scores is None:
+        subgraph = graph.subgraph(community)
+        activity_scores = [d for u, v, d in subgraph.edges(data="weight")]
+    # fsum is exact, so the result does not depend on the edge order
+    total = math.fsum(activity_scores)
+    return max(activity_scores), total / len(community), total
 
 
-def community_keynodes(graph: nx.Graph, community: list, social_position: list, alpha: int = 10) -> list:
+@profiled
+def community_keynodes(graph: nx.Graph, community: list, social_position: list, alpha: int = 10,
+                       internal_edges: list = None) -> list:
     """
     Key nodes detection Algorithm
     :param graph: the graph object to be used
     :param community: a list of nodes in the community
     :param social_position: social position score of each node in the community
     :param alpha: therehold score
+    :param internal_edges: edges inside the community in any order, if already known (see community_edge_sweep)
     :return: a list of key nodes
     """
     if len(set(social_position)) == 1:  # SP(V1) == SP(V2) == ... == SP(Vn)
         return community
-    key, SP = {}, {}
+    changes, SP = {}, {}
     for node, sp in zip(community, social_position):
-        key[node], SP[node] = 0, sp
+        changes[node], SP[node] = [], sp
 
-    subgraph = graph.subgraph(community)
-    for u, v in subgraph.edges():
+    if internal_edges is None:
+        internal_edges = graph.subgraph(community).edges()
+    for u, v, *_ in internal_edges:
         if SP[u] < SP[v]:
-            key[u] -= abs(SP[u]-SP[v])
-            key[v] += abs(SP[v]-SP[u])
+            changes[u].append(-abs(SP[u]-SP[v]))
+            changes[v].append(abs(SP[v]-SP[u]))
         else:
-            key[u] += abs(SP[u]-SP[v])
-            key[v] -= abs(SP[v]-SP[u])
+            changes[u].append(abs(SP[u]-SP[v]))
+            changes[v].append(-abs(SP[v]-SP[u]))
+    # summed with fsum, so the scores do not depend on the edge order
+    key = {node: math.fsum(values) for node, values in changes.items()}
     max_score = max(list(key.values()))
     keynodes =[node for node, score in key.items() if score > 0 and max_score / score < alpha]
     return keynodes
 
 
+@profiled
 def community_cohesion(graph: nx.Graph, community: list) -> float:
     """
     cohesion measure characterising strength of connections inside group in relation to connections outside group
@@ -152,9 +272,50 @@ def community_cohesion(graph: nx.Graph, community: list) -> float:
             inter += w
         elif any(flags):
             outer += w
+    return cohesion_score(inter, outer, n, N)
+
+
+def cohesion_score(inter: float, outer: float, n: int, N: int) -> float:
+    """
+    cohesion from the internal and external weight sums of a community, see community_cohesion
+    :param inter: sum of the weights of the edges inside the community
+    :param outer: sum of the weights of the edges leaving the community
+    :param n: number of nodes in the community
+    :param N: number of nodes in the graph
+    :return: cohesion score
+    """
     cohesion = 0
     if outer == 0:
         cohesion = 10000    # 10000 is Large enough
     else:
         cohesion = (inter / (n * (n - 1))) / (outer / N * (N - n))
     return cohesion
+
+
+@profiled
+def community_edge_sweep(graph: nx.Graph, communities: list) -> dict:
+    """
+    One pass over the edges of the graph for all (disjoint) communities at once. Edges are visited in graph.edges()
+    order, like community_cohesion, so "inter" and "outer" are the same sums. The internal edges can come in another
+    order than subgraph(community).edges(); community_activity and community_keynodes sum over them with math.fsum,
+    so their results do not depend on it.
+    :param graph: the graph object to be used
+    :param communities: a list of communities, each a list of nodes
+    :return: a dict with one entry per community for "inter" (sum of internal weights), "outer" (sum of weights of
+             edges leaving the community) and "internal_edges" (list of (u, v, weight))
+    """
+    label = {node: index for index, community in enumerate(communities) for node in community}
+    inter, outer = [0] * len(communities), [0] * len(communities)
+    internal_edges = [[] for _ in communities]
+    for u, v, w in graph.edges(data="weight"):
+        cu, cv = label.get(u, -1), label.get(v, -1)
+        if cu == cv:
+            if cu >= 0:
+                inter[cu] += w
+                internal_edges[cu].append((u, v, w))
+            continue
+        if cu >= 0:
+            outer[cu] += w
+        if cv >= 0:
+            outer[cv] += w
+    return {"inter": inter, "outer": outer, "internal_edges": internal_edges}
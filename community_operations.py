@@ -1,15 +1,72 @@
 import pickle
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-from cdlib import algorithms
+import numpy as np
+from scipy import sparse
 
+from artifact_cache import cached_stage
 from community_features import *
+from feature_tensor import FeatureTensor
+from pagerank import pagerank_snapshots, scores_to_dicts
+from profiling import profiled, section
+from sparse_snapshots import graphs_to_sparse
 
 
-def static_community_detection(snapshots, pkl=None) -> list:
+@profiled
+def _louvain_partition(snapshot: nx.Graph, seed: int = None, partition: dict = None) -> dict:
+    """
+    Louvain community detection with a fixed random seed, optionally starting from a given partition
+    :param snapshot: the snapshot to be used
+    :param seed: random state of the Louvain run
+    :param partition: initial {node: community}, must cover every node of the snapshot
+    :return: {node: community}
+    """
+    from community import community_louvain
+    return community_louvain.best_partition(snapshot, partition=partition, weight="weight", random_state=seed)
+
+
+def _node_clustering(snapshot: nx.Graph, partition: dict, seed: int = None):
+    """
+    wrap a Louvain partition in the NodeClustering returned by cdlib's louvain
+    """
+    from cdlib import NodeClustering
+    coms_to_node = defaultdict(list)
+    for node, community in partition.items():
+        coms_to_node[community].append(node)
+    return NodeClustering([list(c) for c in coms_to_node.values()], snapshot, "Louvain",
+                          method_parameters={"weight": "weight", "resolution": 1., "randomize": seed})
+
+
+def _warm_start(snapshot: nx.Graph, previous: dict) -> dict:
+    """
+    initial partition for a snapshot from the partition of the previous snapshot. Nodes which are new in this snapshot
+    start in their own community.
+    :param snapshot: the snapshot to be used
+    :param previous: {node: community} of the previous snapshot
+    :return: {node: community}
+    """
+    partition, next_community = {}, max(previous.values(), default=-1) + 1
+    for node in snapshot:
+        if node in previous:
+            partition[node] = previous[node]
+        else:
+            partition[node], next_community = next_community, next_community + 1
+    return partition
+
+
+@profiled
+@cached_stage("communities")
+def static_community_detection(snapshots, pkl=None, mode="serial", seed=0, processes=None) -> list:
     """
     Detect community structure in each snapshot
     :param snapshots: generated snapshots
     :param pkl: pickle file path to store the community detection results
+    :param mode: "serial" runs cdlib's louvain on each snapshot,
+                 "parallel" spreads the snapshots over a process pool, snapshot i uses the random seed seed + i,
+                 "incremental" starts the Louvain run of each snapshot from the partition of the previous one
+    :param seed: base random seed of the "parallel" and "incremental" modes
+    :param processes: number of worker processes of the "parallel" mode, defaults to the number of CPUs
     :return list of community structure in each snapshot.
             And by default, detection results will be written to data/communities.pkl
     """
@@ -18,32 +75,62 @@ def static_community_detection(snapshots, pkl=None) -> list:
         return pickle.load(open(pkl, 'rb'))
     snapshots = snapshots["snapshots"]
     communities = []
-    for snapshot in snapshots:
-        communities.append(algorithms.louvain(snapshot, 'weight'))
+    if mode == "serial":
+        from cdlib import algorithms
+        for index, snapshot in enumerate(snapshots):
+            with section(f"snapshot {index}"):
+                communities.append(algorithms.louvain(snapshot, weight='weight'))
+    elif mode == "parallel":
+        seeds = [seed + index for index in range(len(snapshots))]
+        with ProcessPoolExecutor(processes) as executor:
+            partitions = executor.map(_louvain_partition, snapshots, seeds)
+            for snapshot, partition, snapshot_seed in zip(snapshots, partitions, seeds):
+                communities.append(_node_clustering(snapshot, partition, snapshot_seed))
+    elif mode == "incremental":
+        partition = {}
+        for index, snapshot in enumerate(snapshots):
+            with section(f"snapshot {index}"):
+                partition = _louvain_partition(snapshot, seed + index, _warm_start(snapshot, partition))
+                communities.append(_node_clustering(snapshot, partition, seed + index))
+    else:
+        raise ValueError(f"unknown community detection mode {mode}")
     # only stable communities will be included
     for index, community_struct in enumerate(communities):
         community_struct.communities = [c for c in community_struct.communities if len(c) >= 3]
         communities[index] = community_struct
-    pickle.dump(communities, open("data/communities.pkl", "wb"))
     return communities
 
 
-def social_position_score(snapshots, pkl=None) -> list:
+@profiled
+@cached_stage("social_positions")
+def social_position_score(snapshots, pkl=None, engine="networkx", tol=1e-06, warm_start=True, processes=None) -> list:
     """
     Calculate the social position score of each node in each snapshot (In this paper we use PageRank score)
     :param snapshots: generated snapshots
     :param pkl: a pickle file storing the social position score
+    :param engine: "networkx" runs nx.pagerank on each snapshot, "sparse" uses pagerank.pagerank_snapshots
+    :param tol: PageRank error tolerance
+    :param warm_start: ("sparse" engine) start each snapshot from the scores of the previous one
+    :param processes: ("sparse" engine) if provided, batches of snapshots run in this many worker processes
     :return: list of social position scores in each snapshot.[{node: score, ...},...]
              And by default, the results will be stored to data/social_position.pkl
     """
     if pkl is not None:
         print(f"loading social position score from {pkl}")
         return pickle.load(open(pkl, 'rb'))
-    snapshots, social_positions = snapshots["snapshots"], []
-    for snapshot in snapshots:
-        page_rank_score = nx.pagerank(snapshot, alpha=0.85, weight="weight")
-        social_positions.append(dict(page_rank_score))
-    pickle.dump(social_positions, open("data/social_positions.pkl", "wb"))
+    if engine == "sparse":
+        sparse_snapshots = graphs_to_sparse(snapshots)
+        node_index = {node: index for index, node in enumerate(sparse_snapshots["nodes"])}
+        members = [np.array([node_index[node] for node in snapshot], dtype=np.int64)
+                   for snapshot in snapshots["snapshots"]]
+        scores = pagerank_snapshots(sparse_snapshots, members, tol=tol, warm_start=warm_start, processes=processes)
+        social_positions = scores_to_dicts(scores, members)
+    else:
+        social_positions = []
+        for index, snapshot in enumerate(snapshots["snapshots"]):
+            with section(f"snapshot {index}"):
+                page_rank_score = nx.pagerank(snapshot, alpha=0.85, weight="weight", tol=tol)
+            social_positions.append(dict(page_rank_score))
     return social_positions
 
 
@@ -95,31 +182,107 @@ def _event_identifier(C1, C2, SP1, SP2, alpha=0.5, beta=0.6):
     return None
 
 
-def GED(communities1: list, communities2: list, SP1: dict, SP2: dict, alpha: float, beta: float):
+EVENT_RULES = ["continuing", "shrinking", "growing", "splitting", "merging"]
+
+
+def _label_events(I1, I2, size1, size2, alpha, beta) -> np.ndarray:
     """
-    Group Evolution Discovery method
-    :param beta:
-    :param alpha:
-    :param communities1:
-    :param communities2:
-    :param SP1:
-    :param SP2:
-    :return:
+    vectorized _event_identifier: the rules are checked in the same order for every pair at once
+    :param I1: array of I(C1, C2)
+    :param I2: array of I(C2, C1)
+    :param size1: array of len(C1)
+    :param size2: array of len(C2)
+    :return: object array of events, None where no event is identified
     """
-    pre_window_event, next_window_event = {}, {}
-    possible_events = []
+    conditions = [
+        (I1 >= alpha) & (I2 >= beta) & (size1 == size2),
+        ((I1 >= alpha) & (I2 >= beta) & (size1 > size2)) | ((I1 < alpha) & (I2 >= beta) & (size1 >= size2)),
+        ((I1 > alpha) & (I2 > beta) & (size1 < size2)) | ((I1 >= alpha) & (I2 < beta) & (size1 <= size2)),
+        (I1 < alpha) & (I2 >= beta) & (size1 >= size2),
+        (I1 >= alpha) & (I2 <= beta) & (size1 <= size2),
+    ]
+    return np.select(conditions, np.array(EVENT_RULES, dtype=object), default=None)
+
+
+def _candidate_pairs(communities1: list, communities2: list) -> list:
+    """
+    community pairs sharing at least one node, found through a node -> community index
+    :return: sorted list of (i, j)
+    """
+    index = defaultdict(list)
+    for j, community2 in enumerate(communities2):
+        for node in community2:
+            index[node].append(j)
+    pairs = []
     for i, community1 in enumerate(communities1):
-        if "A-{:d}".format(i) not in next_window_event:
-            next_window_event["A-{:d}".format(i)] = []
-        for j, community2 in enumerate(communities2):
-            if "B-{:d}".format(j) not in pre_window_event:
-                pre_window_event["B-{:d}".format(j)] = []
-            event = _event_identifier(community1, community2, SP1, SP2, alpha, beta)
-            if event is None:
-                continue
-            next_window_event["A-{:d}".format(i)].append(event)
-            pre_window_event["B-{:d}".format(j)].append(event)
-            possible_events.append(("A-{:d}".format(i), "B-{:d}".format(j), event))
+        candidates = set()
+        for node in community1:
+            candidates.update(index.get(node, ()))
+        pairs.extend((i, j) for j in sorted(candidates))
+    return pairs
+
+
+def _inclusion_scores(communities1: list, communities2: list, SP1: dict, SP2: dict) -> tuple:
+    """
+    all inclusion scores of two windows at once. B1, B2 are the community membership matrices, then
+    |C1 & C2| = B1 B2^T and the social positions of the shared nodes are (B1 diag(SP1)) B2^T.
+    :return: (rows, cols, I1, I2) of the overlapping pairs sorted by (row, col), I1 holds I(C1, C2) and I2 I(C2, C1)
+    """
+    node_index = {}
+    for community in communities1 + communities2:
+        for node in community:
+            node_index.setdefault(node, len(node_index))
+
+    def membership(communities, SP):
+        rows = np.repeat(np.arange(len(communities)), [len(c) for c in communities])
+        cols = np.array([node_index[node] for c in communities for node in c], dtype=np.int64)
+        weights = np.array([SP[node] for c in communities for node in c], dtype=np.float64)
+        shape = (len(communities), len(node_index))
+        return sparse.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=shape), \
+            sparse.csr_matrix((weights, (rows, cols)), shape=shape)
+
+    B1, W1 = membership(communities1, SP1)
+    B2, W2 = membership(communities2, SP2)
+    overlap = (B1 @ B2.T).tocoo()
+    order = np.lexsort((overlap.col, overlap.row))
+    rows, cols, shared = overlap.row[order], overlap.col[order], overlap.data[order]
+    size1, size2 = np.array([len(c) for c in communities1]), np.array([len(c) for c in communities2])
+    total1, total2 = np.asarray(W1.sum(axis=1)).ravel(), np.asarray(W2.sum(axis=1)).ravel()
+    quality1 = np.asarray((W1 @ B2.T)[rows, cols]).ravel() / total1[rows]
+    quality2 = np.asarray((B1 @ W2.T)[rows, cols]).ravel() / total2[cols]
+    return rows, cols, shared / size1[rows] * quality1, shared / size2[cols] * quality2
+
+
+def inclusion_matrices(communities1: list, communities2: list, SP1: dict, SP2: dict) -> tuple:
+    """
+    inclusion scores of all overlapping community pairs of two windows
+    :return: (I1, I2) sparse matrices of shape (len(communities1), len(communities2)) holding I(C1, C2) and
+             I(C2, C1)
+    """
+    shape = (len(communities1), len(communities2))
+    if 0 in shape:
+        return sparse.csr_matrix(shape), sparse.csr_matrix(shape)
+    rows, cols, I1, I2 = _inclusion_scores(communities1, communities2, SP1, SP2)
+    return sparse.csr_matrix((I1, (rows, cols)), shape=shape), sparse.csr_matrix((I2, (rows, cols)), shape=shape)
+
+
+def _window_events(n1: int, n2: int, pair_events) -> tuple:
+    """
+    aggregate the events of community pairs into the events of each community, as in GED
+    :param n1: number of communities in the first window
+    :param n2: number of communities in the second window
+    :param pair_events: iterable of (i, j, event or None) in (i, j) order
+    :return: (possible_events, events) as returned by GED
+    """
+    next_window_event = {"A-{:d}".format(i): [] for i in range(n1)}
+    pre_window_event = {"B-{:d}".format(j): [] for j in range(n2)} if n1 else {}
+    possible_events = []
+    for i, j, event in pair_events:
+        if event is None:
+            continue
+        next_window_event["A-{:d}".format(i)].append(event)
+        pre_window_event["B-{:d}".format(j)].append(event)
+        possible_events.append(("A-{:d}".format(i), "B-{:d}".format(j), event))
     events = []
     for key, value in next_window_event.items():
         if len(value) == 0:
@@ -141,7 +304,45 @@ def GED(communities1: list, communities2: list, SP1: dict, SP2: dict, alpha: flo
     return possible_events, events
 
 
-def meta_community_network_generation(communities, social_positions, alpha=None, beta=None, pkl=None) -> nx.DiGraph:
+@profiled
+def GED(communities1: list, communities2: list, SP1: dict, SP2: dict, alpha: float, beta: float, method="index"):
+    """
+    Group Evolution Discovery method
+    :param beta:
+    :param alpha:
+    :param communities1:
+    :param communities2:
+    :param SP1:
+    :param SP2:
+    :param method: "full" compares every pair of communities,
+                   "index" only compares pairs sharing a node (same result, as long as alpha and beta are positive
+                   disjoint communities never get an event),
+                   "sparse" computes the inclusion scores of all overlapping pairs with inclusion_matrices (all
+                   pairs if alpha or beta is not positive). Scores are summed in another order, so a pair lying
+                   exactly on a threshold may be labeled differently
+    :return:
+    """
+    if method == "sparse" and len(communities1) and len(communities2):
+        # with a threshold <= 0 disjoint pairs can get an event too, so they are scored as well
+        disjoint = not (alpha > 0 and beta > 0)
+        rows, cols, I1, I2 = _pair_inclusions(communities1, communities2, SP1, SP2, method, disjoint)
+        sizes1, sizes2 = np.array([len(c) for c in communities1]), np.array([len(c) for c in communities2])
+        labels = _label_events(I1, I2, sizes1[rows], sizes2[cols], alpha, beta)
+        pair_events = zip(rows.tolist(), cols.tolist(), labels.tolist())
+    elif method in ("index", "sparse") and alpha > 0 and beta > 0:
+        pair_events = ((i, j, _event_identifier(communities1[i], communities2[j], SP1, SP2, alpha, beta))
+                       for i, j in _candidate_pairs(communities1, communities2))
+    else:
+        pair_events = ((i, j, _event_identifier(community1, community2, SP1, SP2, alpha, beta))
+                       for i, community1 in enumerate(communities1) for j, community2 in enumerate(communities2))
+
+    return _window_events(len(communities1), len(communities2), pair_events)
+
+
+@profiled
+@cached_stage("meta_community_network")
+def meta_community_network_generation(communities, social_positions, alpha=None, beta=None, pkl=None,
+                                      method="index") -> nx.DiGraph:
     """
     construct a meta community network.
     :param beta:
@@ -149,21 +350,36 @@ def meta_community_network_generation(communities, social_positions, alpha=None,
     :param communities:
     :param social_positions:
     :param pkl:
+    :param method: GED method, see GED
     :return:
     """
     if pkl is not None:
         print(f"loading meta community network from {pkl}")
         return pickle.load(open(pkl, 'rb'))
+    window_events = []
+    for index in range(len(communities) - 1):
+        C1, C2 = communities[index].communities, communities[index + 1].communities
+        SP1, SP2 = social_positions[index], social_positions[index + 1]
+        with section(f"snapshot {index}"):
+            window_events.append(GED(C1, C2, SP1, SP2, alpha, beta, method))
+    meta_community_network = _build_meta_community_network(communities, window_events)
+    return meta_community_network
+
+
+def _build_meta_community_network(communities, window_events: list) -> nx.DiGraph:
+    """
+    build the meta community network from the GED results of each pair of consecutive windows
+    :param communities: community structure of each snapshot
+    :param window_events: [(possible_events, events), ...], one entry per window pair
+    :return: meta community network
+    """
     meta_community_network = nx.DiGraph()
 
     for index, community_struct in enumerate(communities):
         for index_j, community in enumerate(community_struct.communities):
             meta_community_network.add_node(f"T{index}C{index_j}", pre="None", nex="None")
 
-    for index in range(len(communities) - 1):
-        C1, C2 = communities[index].communities, communities[index + 1].communities
-        SP1, SP2 = social_positions[index], social_positions[index + 1]
-        possible_events, events = GED(C1, C2, SP1, SP2, alpha, beta)
+    for index, (possible_events, events) in enumerate(window_events):
         for possible_event in possible_events:
             source, target = possible_event[0], possible_event[1]
             source = "T{:d}C".format(index) + source[2:]
@@ -177,11 +393,80 @@ def meta_community_network_generation(communities, social_positions, alpha=None,
             else:
                 node = "T{:d}C".format(index + 1) + node[2:]
                 meta_community_network.nodes[node]["pre"] = event_type
-
-    pickle.dump(meta_community_network, open("data/meta_community_network.pkl", "wb"))
     return meta_community_network
 
 
+def _pair_inclusions(communities1: list, communities2: list, SP1: dict, SP2: dict, method="index",
+                     disjoint=False) -> tuple:
+    """
+    inclusion scores of the community pairs of two windows
+    :param method: "index" uses _inclusion on the pairs sharing a node, "sparse" uses _inclusion_scores
+    :param disjoint: also score the pairs without shared nodes (their inclusion is 0)
+    :return: (rows, cols, I1, I2) sorted by (row, col)
+    """
+    if method == "sparse" and not disjoint and len(communities1) and len(communities2):
+        return _inclusion_scores(communities1, communities2, SP1, SP2)
+    if disjoint:
+        pairs = [(i, j) for i in range(len(communities1)) for j in range(len(communities2))]
+    else:
+        pairs = _candidate_pairs(communities1, communities2)
+    rows, cols = np.array([i for i, _ in pairs], dtype=np.int64), np.array([j for _, j in pairs], dtype=np.int64)
+    I1 = np.array([_inclusion(communities1[i], communities2[j], SP1) for i, j in pairs], dtype=np.float64)
+    I2 = np.array([_inclusion(communities2[j], communities1[i], SP2) for i, j in pairs], dtype=np.float64)
+    return rows, cols, I1, I2
+
+
+def _event_table(window_events: list) -> dict:
+    """
+    flat view of the GED results of all window pairs
+    :param window_events: [(possible_events, events), ...], one entry per window pair
+    :return: {"links": [(source, target, event), ...], "events": [(node, "pre" or "nex", event), ...]}
+    """
+    links, node_events = [], []
+    for index, (possible_events, events) in enumerate(window_events):
+        for source, target, event in possible_events:
+            links.append(("T{:d}C".format(index) + source[2:], "T{:d}C".format(index + 1) + target[2:], event))
+        for node, event_type in events:
+            if node[0] == 'A':
+                node_events.append(("T{:d}C".format(index) + node[2:], "nex", event_type))
+            else:
+                node_events.append(("T{:d}C".format(index + 1) + node[2:], "pre", event_type))
+    return {"links": links, "events": node_events}
+
+
+def meta_community_network_sweep(communities, social_positions, thresholds: list, method="index",
+                                 event_table=False) -> dict:
+    """
+    construct the meta community network for a grid of (alpha, beta) thresholds. The inclusion scores do not depend
+    on the thresholds, so they are computed once per pair of consecutive windows and all grid points are labeled
+    together.
+    :param communities: community structure of each snapshot
+    :param social_positions: social position score of each node in each snapshot
+    :param thresholds: list of (alpha, beta)
+    :param method: "index" gives the same networks as meta_community_network_generation, "sparse" computes the
+                   inclusion scores with sparse matrices (see GED)
+    :param event_table: return the event table (see _event_table) instead of the meta community network
+    :return: {(alpha, beta): meta community network or event table}
+    """
+    alphas = np.array([alpha for alpha, _ in thresholds], dtype=np.float64)[:, None]
+    betas = np.array([beta for _, beta in thresholds], dtype=np.float64)[:, None]
+    disjoint = not ((alphas > 0).all() and (betas > 0).all())
+    window_events = {threshold: [] for threshold in thresholds}
+    for index in range(len(communities) - 1):
+        C1, C2 = communities[index].communities, communities[index + 1].communities
+        SP1, SP2 = social_positions[index], social_positions[index + 1]
+        rows, cols, I1, I2 = _pair_inclusions(C1, C2, SP1, SP2, method, disjoint)
+        sizes1, sizes2 = np.array([len(c) for c in C1], dtype=np.int64), np.array([len(c) for c in C2], dtype=np.int64)
+        labels = _label_events(I1[None, :], I2[None, :], sizes1[rows][None, :], sizes2[cols][None, :], alphas, betas)
+        for threshold, threshold_labels in zip(thresholds, labels):
+            pair_events = zip(rows.tolist(), cols.tolist(), threshold_labels.tolist())
+            window_events[threshold].append(_window_events(len(C1), len(C2), pair_events))
+    if event_table:
+        return {threshold: _event_table(events) for threshold, events in window_events.items()}
+    return {threshold: _build_meta_community_network(communities, events)
+            for threshold, events in window_events.items()}
+
+
 FEATURE_NAMES = [
     "size", "density", "clustering", "avg_closeness_centrality", "degree",
     # "eigenvectors_centrality",
@@ -191,45 +476,143 @@ FEATURE_NAMES = [
 ]
 
 
-def feature_extraction(snapshots, communities, social_positions, pkl=None):
+@profiled
+def _snapshot_features(snapshot: nx.Graph, communities: list, social_position: dict,
+                       closeness_options: dict = None) -> list:
+    """
+    FEATURE_NAMES vector of every community of a snapshot. The edges are swept once for all communities
+    (community_edge_sweep), node degrees, closeness and clustering are computed once per snapshot.
+    :param snapshot: the snapshot to be used
+    :param communities: the communities of the snapshot
+    :param social_position: social position score of each node in the snapshot
+    :param closeness_options: options of community_features.closeness_centrality
+    :return: list of feature vectors
+    """
+    if len(communities) == 0:
+        return []
+    # sections named after the community_features functions, so that both engines profile alike
+    sweep = community_edge_sweep(snapshot, communities)
+    with section("degree"):
+        degree = dict(snapshot.degree(weight="weight"))
+    closeness = closeness_centrality(snapshot, **(closeness_options or {}))
+    with section("clustering"):
+        clustering = nx.clustering(snapshot, [node for community in communities for node in community], "weight")
+    N = snapshot.number_of_nodes()
+    communities_features = []
+    for index, community in enumerate(communities):
+        n, internal_edges = len(community), sweep["internal_edges"][index]
+        tpratio = community_tpratio(snapshot, community)
+        keynodes = community_keynodes(snapshot, community, [social_position[node] for node in community],
+                                      internal_edges=internal_edges)
+        activity = community_activity(snapshot, community, [w for _, _, w in internal_edges])
+        degrees = [degree[node] for node in community]
+        with section("community_density"):
+            density = len(internal_edges) / (n ** 2 - n)
+        with section("community_clustering"):
+            community_clustering_score = sum([clustering[node] for node in community]) / n
+        with section("community_average_closeness_centrality"):
+            average_closeness = sum([closeness[node] for node in community]) / n
+        with section("community_degree"):
+            community_degree_score = sum(degrees) / n
+        with section("community_leadership"):
+            leadership = sum([max(degrees) - v for v in degrees]) / ((n - 2) * (n - 1))
+        with section("community_cohesion"):
+            cohesion = cohesion_score(sweep["inter"][index], sweep["outer"][index], n, N)
+        with section("key nodes"):
+            keynodes_degree = sum([degree[node] for node in keynodes]) / len(keynodes)
+            keynodes_closeness = sum([closeness[node] for node in keynodes]) / len(keynodes)
+        communities_features.append([
+            n,  # community size
+            density,  # community density
+            community_clustering_score,  # community clustering
+            average_closeness,  # average closeness centrality
+            community_degree_score,  # community degree
+            leadership,  # community leadership
+            cohesion,  # community cohesion
+            len(keynodes),  # number of keynodes
+            activity[0],  # max activity
+            activity[1],  # mean activity
+            activity[2],  # sum activity
+            tpratio.get("Stakeholder", 0),  # number of stakeholders in community
+            tpratio.get("Service", 0),  # number of services in community
+            keynodes_degree,  # key nodes degree
+            keynodes_closeness,  # key nodes average closeness
+        ])
+    return communities_features
+
+
+@profiled
+def _community_features(snapshot: nx.Graph, communities: list, social_position: dict,
+                        closeness_options: dict = None) -> list:
+    """
+    FEATURE_NAMES vector of every community of a snapshot, calling the community_features functions for each
+    community
+    """
+    communities_features, closeness_options = [], closeness_options or {}
+    for community in communities:
+        tpratio = community_tpratio(snapshot, community)
+        keynodes = community_keynodes(snapshot, community, [social_position[node] for node in community])
+        activity = community_activity(snapshot, community)
+        community_features = [
+            len(community),  # community size
+            community_density(snapshot, community),  # community density
+            community_clustering(snapshot, community),  # community clustering
+            # average closeness centrality
+            community_average_closeness_centrality(snapshot, community, **closeness_options),
+            community_degree(snapshot, community),  # community degree
+            # community_eigenvector_centrality(snapshot, community),  # eigenvector centrality
+            community_leadership(snapshot, community),  # community leadership
+            community_cohesion(snapshot, community),  # community cohesion
+            len(keynodes),  # number of keynodes
+            activity[0],  # max activity
+            activity[1],  # mean activity
+            activity[2],  # sum activity
+            tpratio.get("Stakeholder", 0),  # number of stakeholders in community
+            tpratio.get("Service", 0),  # number of services in community
+            community_degree(snapshot, keynodes),  # key nodes degree
+            # key nodes average closeness
+            community_average_closeness_centrality(snapshot, keynodes, **closeness_options),
+            # community_eigenvector_centrality(snapshot, keynodes),  # key nodes eigenvectors centrality
+        ]
+        communities_features.append(community_features.copy())
+    return communities_features
+
+
+FEATURE_ENGINES = {"sweep": _snapshot_features, "community": _community_features}
+
+
+@profiled
+@cached_stage("features")
+def feature_extraction(snapshots, communities, social_positions, pkl=None, engine="sweep", closeness_options=None,
+                       processes=None, tensor=False):
     """
     extract features for each community
     :param pkl:
     :param snapshots:
     :param communities:
     :param social_positions:
+    :param engine: "sweep" computes all communities of a snapshot together (_snapshot_features), "community" calls
+                   the community_features functions for each community
+    :param closeness_options: options of community_features.closeness_centrality, e.g. {"samples": 64} or
+                              {"epsilon": 0.1} for the sampled approximation, {"processes": 8} for parallel exact
+    :param processes: if provided, snapshots are processed in this many worker processes
+    :param tensor: return a FeatureTensor (one float array plus per-snapshot offsets) instead of nested lists
     :return:
     """
     if pkl is not None:
         print(f"loading features from {pkl}")
         return pickle.load(open(pkl, 'rb'))
-    features, snapshots = [], snapshots["snapshots"]
-    for snapshot, community_struct, social_position in zip(snapshots, communities, social_positions):
-        communities_features = []
-        for community in community_struct.communities:
-            tpratio = community_tpratio(snapshot, community)
-            keynodes = community_keynodes(snapshot, community, [social_position[node] for node in community])
-            activity = community_activity(snapshot, community)
-            community_features = [
-                len(community),  # community size
-                community_density(snapshot, community),  # community density
-                community_clustering(snapshot, community),  # community clustering
-                community_average_closeness_centrality(snapshot, community),  # average closeness centrality
-                community_degree(snapshot, community),  # community degree
-                # community_eigenvector_centrality(snapshot, community),  # eigenvector centrality
-                community_leadership(snapshot, community),  # community leadership
-                community_cohesion(snapshot, community),  # community cohesion
-                len(keynodes),  # number of keynodes
-                activity[0],  # max activity
-                activity[1],  # mean activity
-                activity[2],  # sum activity
-                tpratio.get("Stakeholder", 0),  # number of stakeholders in community
-                tpratio.get("Service", 0),  # number of services in community
-                community_degree(snapshot, keynodes),  # key nodes degree
-                community_average_closeness_centrality(snapshot, keynodes),  # key nodes average closeness
-                # community_eigenvector_centrality(snapshot, keynodes),  # key nodes eigenvectors centrality
-            ]
-            communities_features.append(community_features.copy())
-        features.append(communities_features.copy())
-    pickle.dump(features, open("data/features.pkl", "wb"))
+    snapshots, extract = snapshots["snapshots"], FEATURE_ENGINES[engine]
+    arguments = [snapshots, [community_struct.communities for community_struct in communities], social_positions,
+                 [closeness_options] * len(communities)]
+    if processes is None:
+        features = []
+        for index, snapshot_arguments in enumerate(zip(*arguments)):
+            with section(f"snapshot {index}"):
+                features.append(extract(*snapshot_arguments))
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            features = list(executor.map(extract, *arguments))
+    if tensor:
+        features = FeatureTensor.from_nested(features, len(FEATURE_NAMES))
     return features
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class FeatureTensor:
+    """
+    community features of all snapshots in one contiguous float array of shape (total_communities, n_features).
+    Row offsets[sid] + cid holds community cid of snapshot sid, so features[sid][cid] works like with the nested
+    lists returned by feature_extraction.
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        self.values, self.offsets = values, offsets
+
+    @classmethod
+    def from_nested(cls, features: list, n_features: int = None) -> "FeatureTensor":
+        """
+        :param features: [[feature vector of each community] of each snapshot]
+        :param n_features: length of a feature vector, needed when there are no communities at all
+        """
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(snapshot_features) for snapshot_features in features])
+        rows = [vector for snapshot_features in features for vector in snapshot_features]
+        if n_features is None:
+            n_features = len(rows[0]) if rows else 0
+        values = np.array(rows, dtype=np.float64).reshape(len(rows), n_features)
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, sid) -> np.ndarray:
+        """
+        :param sid: snapshot id
+        :return: a (communities, n_features) view of the snapshot's rows
+        """
+        if sid < 0:
+            sid += len(self)
+        if not 0 <= sid < len(self):
+            raise IndexError(f"snapshot index {sid} out of range")
+        return self.values[self.offsets[sid]:self.offsets[sid + 1]]
+
+    def __iter__(self):
+        return (self[sid] for sid in range(len(self)))
+
+    def rows(self, sids, cids) -> np.ndarray:
+        """
+        gather the rows of many communities at once
+        :param sids: array of snapshot ids
+        :param cids: array of community ids
+        :return: array of shape (len(sids), n_features)
+        """
+        sids, cids = np.asarray(sids, dtype=np.int64), np.asarray(cids, dtype=np.int64)
+        sids = np.where(sids < 0, sids + len(self), sids)
+        if np.any((sids < 0) | (sids >= len(self))):
+            raise IndexError(f"snapshot index {sids[(sids < 0) | (sids >= len(self))][0]} out of range")
+        # a cid past the snapshot's communities would silently read the rows of the next snapshot
+        counts = self.offsets[sids + 1] - self.offsets[sids]
+        outside = (cids < 0) | (cids >= counts)
+        if np.any(outside):
+            first = np.flatnonzero(outside)[0]
+            raise IndexError(f"community index {cids.flat[first]} out of range for snapshot {sids.flat[first]} with "
+                             f"{counts.flat[first]} communities")
+        return self.values[self.offsets[sids] + cids]
+
+    def to_nested(self) -> list:
+        return [self[sid].tolist() for sid in range(len(self))]
@@ -1,15 +1,24 @@
+import os
 import pickle
 from datetime import datetime as dt
 from datetime import timedelta
 
 import networkx as nx
+import numpy as np
+
+from artifact_cache import cached_stage, fingerprint
+from profiling import profiled, section
+from snapshot_store import open_snapshot_store, save_snapshot_store, store_parameters
 
 INITIAL_WEIGHT = {"exit": -1, "conflict": -1, "join": 4, "acquisition": 4, "BelongTo": 2, "Structural": 2}
 STABLE_EDGE = ["exit", "conflict", "join", "acquisition", "BelongTo", "Structural"]
+DECAY_RATE = 30
+MAX_DECAY = 12
+HISTORY_END = "2019-12-30"
 
 
-def linear_decay(edge_type: str, duration: int, initial_weight: dict = None,
-                 stable_edge: list = None, decay_rate: int = 30, default_weight: float = 2.5, max_decay: int = 12):
+def linear_decay(edge_type: str, duration: int, initial_weight: dict = None, stable_edge: list = None,
+                 decay_rate: int = DECAY_RATE, default_weight: float = 2.5, max_decay: int = MAX_DECAY):
     """
     A linear decay for edge weights in the dynamic network
     :param edge_type: a string representing edge type
@@ -35,6 +44,33 @@ def linear_decay(edge_type: str, duration: int, initial_weight: dict = None,
     return weight / aging_cofficient
 
 
+def linear_decay_batch(edge_types, durations, initial_weight: dict = None, stable_edge: list = None,
+                       decay_rate: int = DECAY_RATE, default_weight: float = 2.5, max_decay: int = MAX_DECAY):
+    """
+    NumPy version of linear_decay that ages a whole batch of edges at once
+    :param edge_types: array-like of edge type strings
+    :param durations: array-like of durations in days, aligned with edge_types
+    :param initial_weight: initial weight for specified edge types
+    :param stable_edge: if an edge type in stable_edge, then this type will not decay.
+    :param decay_rate: how often to decay (days)
+    :param default_weight: default weight for edge types not in initial_weight
+    :param max_decay: max decay numbers
+    :return: a float64 array, element-wise equal to linear_decay
+    """
+    if stable_edge is None:
+        stable_edge = STABLE_EDGE
+    if initial_weight is None:
+        initial_weight = INITIAL_WEIGHT
+    types, inverse = np.unique(np.asarray(edge_types, dtype=str), return_inverse=True)
+    weight = np.array([initial_weight.get(t, default_weight) for t in types], dtype=np.float64)[inverse]
+    stable = np.array([t in stable_edge for t in types], dtype=bool)[inverse]
+
+    aging_cofficient = np.maximum(np.asarray(durations) / decay_rate, 1)
+    decayed = np.where(aging_cofficient > max_decay, 0., weight / aging_cofficient)
+    return np.where(stable, weight, decayed)
+
+
+@profiled
 def _generate_snapshot(end_time, nodes, edges, ignore_event=True):
     """
     generate a snapshot at end time
@@ -78,7 +114,204 @@ def _generate_snapshot(end_time, nodes, edges, ignore_event=True):
     return snapshot
 
 
-def generate_snapshots(end_time: dt, window_size: int, edges: list, nodes: list, pkl=None):
+@profiled
+def _prepare_edge_log(nodes, edges, ignore_event=True):
+    """
+    parse the node list and the edge log once for the incremental snapshot engine
+    :param nodes: node list
+    :param edges: edge list
+    :param ignore_event: True if don't care about events
+    :return: (node_ids, node_types, log). node_ids keeps the node list order, node_types maps id to type and log is
+             a list of (day, source index, target index, r) sorted by timestamp. Edges whose endpoints are not
+             snapshot nodes are dropped here, exactly as _generate_snapshot skips them.
+    """
+    node_index, node_types = {}, {}
+    for node in nodes:
+        if ignore_event and node["type"] == "Event":
+            continue
+        if node["id"] not in node_index:
+            node_index[node["id"]] = len(node_index)
+        node_types[node["id"]] = node["type"]
+
+    days, log = {}, []
+    for edge in edges:
+        if edge['source'] not in node_index or edge['target'] not in node_index:
+            continue
+        timestamp = edge.get("timestamp", "1990-01-01")
+        if timestamp not in days:
+            days[timestamp] = dt.strptime(timestamp, "%Y-%m-%d").toordinal()
+        r = edge['r'] if edge['type'] != 'Structural' else "Structural"
+        log.append((days[timestamp], node_index[edge['source']], node_index[edge['target']], r))
+    # sort is stable, so edges sharing a timestamp keep the edge list order like in _generate_snapshot
+    log.sort(key=lambda x: x[0])
+    return list(node_index), node_types, log
+
+
+@profiled
+def _prepare_columnar_log(edge_log: dict, ignore_event=True):
+    """
+    same as _prepare_edge_log, but from an edge log written by ingest.ingest_edge_log
+    :param edge_log: a loaded edge log
+    :param ignore_event: True if don't care about events
+    :return: (node_ids, node_types, log)
+    """
+    type_names, relation_names = edge_log["node_type_names"], edge_log["relation_names"]
+    # codes outside the vocabularies mean the log was written with too narrow code types
+    for name, names in (("node_types", type_names), ("type", edge_log["edge_type_names"]), ("r", relation_names)):
+        codes = np.asarray(edge_log[name])
+        if len(codes) and (codes.min() < (-1 if name == "node_types" else 0) or codes.max() >= len(names)):
+            raise ValueError(f"edge log {name} codes do not match its {len(names)} names, ingest it again")
+    kept = np.asarray(edge_log["node_types"]) != -1
+    if ignore_event and "Event" in type_names:
+        kept &= np.asarray(edge_log["node_types"]) != type_names.index("Event")
+    node_ids = [node for node, keep in zip(edge_log["nodes"], kept.tolist()) if keep]
+    node_types = {node: type_names[code] for node, code, keep in
+                  zip(edge_log["nodes"], edge_log["node_types"].tolist(), kept.tolist()) if keep}
+    # indices of the snapshot nodes in node_ids, -1 for dropped nodes
+    index = np.where(kept, np.cumsum(kept) - 1, -1)
+
+    sources, targets = index[edge_log["source"]], index[edge_log["target"]]
+    relations = np.asarray(edge_log["r"]).copy()
+    if "Structural" in edge_log["edge_type_names"]:
+        relations[np.asarray(edge_log["type"]) == edge_log["edge_type_names"].index("Structural")] = \
+            relation_names.index("Structural")
+    retained = np.flatnonzero((sources >= 0) & (targets >= 0))
+    retained = retained[np.argsort(np.asarray(edge_log["day"])[retained], kind="stable")]
+    log = list(zip(np.asarray(edge_log["day"])[retained].tolist(), sources[retained].tolist(),
+                   targets[retained].tolist(), [relation_names[r] for r in relations[retained].tolist()]))
+    return node_ids, node_types, log
+
+
+def _fold_edge_history(history, end):
+    """
+    replay the edges between two nodes in timestamp order, as _generate_snapshot does
+    :param history: a list of (position, day, r) in timestamp order
+    :param end: the snapshot end time as a day ordinal
+    :return: (position of the edge that (re)created the graph edge, weight). position is None if there is no edge
+    """
+    created, weight = None, 0
+    for position, day, r in history:
+        edge_weight = linear_decay(r, end - day)
+        if edge_weight < 0:
+            # the edge is removed and added again with the negative weight
+            created, weight = position, 0
+        elif edge_weight == 0:
+            continue
+        elif created is None:
+            created, weight = position, 0
+        weight += edge_weight
+    return created, weight
+
+
+class SnapshotBuilder:
+    """
+    state of the incremental snapshot engine: the folded edge history of every node pair and the weights that can
+    still decay. snapshot(end_time) adds the edges that arrived up to end_time and returns the snapshot, rollback()
+    undoes the last call, so that the newest snapshot can be rebuilt after edges were added to the log.
+    """
+
+    def __init__(self, node_ids: list, node_types: dict, log: list):
+        """
+        :param node_ids: snapshot node ids, the node index
+        :param node_types: {node id: type}
+        :param log: list of (day, source index, target index, r) sorted by day
+        """
+        self.node_ids, self.node_types, self.log = node_ids, node_types, log
+        self.history, self.weights, self.aging, self.cursor = {}, {}, {}, 0
+        self._undo = None
+
+    def snapshot(self, end_time: dt) -> nx.Graph:
+        """
+        :param end_time: snapshot end time, not before the end time of the previous call
+        :return: the snapshot, equal to _generate_snapshot(end_time, nodes, edges)
+        """
+        end = end_time.toordinal()
+        # cursor, aging, previous weights and history lengths of the touched pairs
+        undo = (self.cursor, self.aging, {}, {})
+        history, weights, aging = self.history, self.weights, dict(self.aging)
+        dirty = set(aging)
+        while self.cursor < len(self.log) and self.log[self.cursor][0] <= end:
+            day, source, target, r = self.log[self.cursor]
+            pair = (source, target) if source <= target else (target, source)
+            if pair not in undo[3]:
+                undo[3][pair] = len(history.get(pair, ()))
+            history.setdefault(pair, []).append((self.cursor, day, r))
+            if r not in STABLE_EDGE:
+                aging[pair] = day
+            dirty.add(pair)
+            self.cursor += 1
+
+        for pair in dirty:
+            undo[2][pair] = weights.get(pair)
+            created, weight = _fold_edge_history(history[pair], end)
+            if created is None:
+                weights.pop(pair, None)
+            else:
+                weights[pair] = (created, weight)
+        # once the newest non-stable edge of a pair is fully decayed its weight can not change anymore
+        self.aging = {pair: day for pair, day in aging.items() if (end - day) / DECAY_RATE <= MAX_DECAY}
+        self._undo = undo
+
+        snapshot = nx.Graph()
+        for index in sorted({index for pair in weights for index in pair}):
+            snapshot.add_node(self.node_ids[index], type=self.node_types[self.node_ids[index]])
+        # adding edges in creation order reproduces the adjacency order of _generate_snapshot
+        for (source, target), (_, weight) in sorted(weights.items(), key=lambda x: x[1][0]):
+            snapshot.add_edge(self.node_ids[source], self.node_ids[target], weight=weight)
+        return snapshot
+
+    def rollback(self):
+        """
+        undo the last snapshot call
+        """
+        if self._undo is None:
+            raise ValueError("nothing to roll back")
+        self.cursor, self.aging, weights, lengths = self._undo
+        for pair, length in lengths.items():
+            if length:
+                del self.history[pair][length:]
+            else:
+                del self.history[pair]
+        for pair, weight in weights.items():
+            if weight is None:
+                self.weights.pop(pair, None)
+            else:
+                self.weights[pair] = weight
+        self._undo = None
+
+
+def iter_snapshots(end_time: dt, window_size: int, edges: list, nodes: list, ignore_event=True, edge_log=None,
+                   history_end: str = HISTORY_END):
+    """
+    incremental sliding-window snapshot engine. The edge log is parsed and sorted once, then each step only adds the
+    edges that arrived in the new window and recomputes the weights that can still decay (non-stable edges younger
+    than MAX_DECAY * DECAY_RATE days). Every yielded graph equals _generate_snapshot(end_time, nodes, edges).
+    :param end_time: timestamp of the first snapshot
+    :param window_size: days between snapshots
+    :param edges: a list of edges
+    :param nodes: a list of nodes
+    :param ignore_event: True if don't care about events
+    :param edge_log: an edge log loaded by ingest.load_edge_log, used instead of edges and nodes if provided
+    :param history_end: snapshots are generated for end times before this date
+    :return: a generator of (timestamp, snapshot)
+    """
+    if edge_log is not None:
+        builder = SnapshotBuilder(*_prepare_columnar_log(edge_log, ignore_event))
+    else:
+        builder = SnapshotBuilder(*_prepare_edge_log(nodes, edges, ignore_event))
+    stop_time, index = dt.strptime(history_end, "%Y-%m-%d"), 0
+    while end_time < stop_time:
+        # the section ends before the yield, so the consumer's work is not counted in it
+        with section(f"snapshot {index}"):
+            snapshot = builder.snapshot(end_time)
+        yield end_time.strftime("%Y-%m-%d"), snapshot
+        end_time, index = end_time + timedelta(days=window_size), index + 1
+
+
+@profiled
+@cached_stage("snapshots")
+def generate_snapshots(end_time: dt, window_size: int, edges: list, nodes: list, pkl=None, incremental=True,
+                       store=None, edge_log=None, history_end: str = HISTORY_END):
     """
     generate a set of snapshots at different timestamp
     :param end_time: a timestamp
@@ -86,16 +319,59 @@ def generate_snapshots(end_time: dt, window_size: int, edges: list, nodes: list,
     :param edges: a list of edges
     :param nodes: a list of nodes
     :param pkl: if provided, then will load from it. otherwise will generate step by step
+    :param incremental: if True, use the sliding-window engine iter_snapshots, else rebuild every snapshot from scratch
+    :param store: a snapshot store directory. If it holds a complete store built from the same inputs, end_time,
+            window_size and history_end, the snapshots are opened lazily from it (memory-mapped), otherwise the
+            generated snapshots are also written to it
+    :param edge_log: an edge log loaded by ingest.load_edge_log, used instead of edges and nodes if provided
+            (incremental engine only, ValueError otherwise)
+    :param history_end: snapshots are generated for end times before this date
     :return: a dict {"snapshot": [snapshot...], "timestamp": [end_time...]}. And will generate a
             pkl file in "data/snapshots.pkl"
     """
     if pkl is not None:
         print(f"loading snapshots from {pkl}")
         return pickle.load(open(pkl, "rb"))
+    if edge_log is not None and not incremental:
+        raise ValueError("edge_log is only supported by the incremental engine, pass edges and nodes instead")
+    parameters = None
+    if store is not None:
+        parameters = {"end_time": end_time.strftime("%Y-%m-%d"), "window_size": window_size, "history_end": history_end,
+                      "input": fingerprint(edge_log if edge_log is not None else (edges, nodes))}
+        if store_parameters(store) == parameters:
+            print(f"opening snapshot store {store}")
+            return open_snapshot_store(store)
+        if os.path.exists(os.path.join(store, "meta.json")):
+            print(f"snapshot store {store} was built with other parameters, rebuilding it")
     snapshots, timestamps = [], []
-    while end_time < dt.strptime("2019-12-30", "%Y-%m-%d"):
-        snapshots.append(_generate_snapshot(end_time, nodes, edges))
-        timestamps.append(end_time.strftime("%Y-%m-%d"))
-        end_time += timedelta(days=window_size)
-    pickle.dump({"snapshots": snapshots, "timestamps": timestamps}, open("data/snapshots.pkl", "wb"))
+    if incremental:
+        for timestamp, snapshot in iter_snapshots(end_time, window_size, edges, nodes, edge_log=edge_log,
+                                                   history_end=history_end):
+            snapshots.append(snapshot)
+            timestamps.append(timestamp)
+    else:
+        while end_time < dt.strptime(history_end, "%Y-%m-%d"):
+            snapshots.append(_generate_snapshot(end_time, nodes, edges))
+            timestamps.append(end_time.strftime("%Y-%m-%d"))
+            end_time += timedelta(days=window_size)
+    if store is not None:
+        save_snapshot_store({"snapshots": snapshots, "timestamps": timestamps}, store, parameters)
     return {"snapshots": snapshots, "timestamps": timestamps}
+
+
+def positive_snapshots(snapshots: dict) -> tuple:
+    """
+    copies of the snapshots without the edges of weight <= 0 (exit, conflict) and the nodes left isolated, since
+    Louvain and PageRank need positive weights
+    :param snapshots: generated snapshots {"snapshots": [...], "timestamps": [...]}
+    :return: (cleaned snapshots, number of removed edges)
+    """
+    cleaned, removed = [], 0
+    for snapshot in snapshots["snapshots"]:
+        snapshot = snapshot.copy()
+        negative = [(u, v) for u, v, w in snapshot.edges(data="weight") if w <= 0]
+        snapshot.remove_edges_from(negative)
+        snapshot.remove_nodes_from(list(nx.isolates(snapshot)))
+        cleaned.append(snapshot)
+        removed += len(negative)
+    return {"snapshots": cleaned, "timestamps": snapshots["timestamps"]}, removed
@@ -0,0 +1,85 @@
+import json
+import os
+from datetime import datetime as dt
+
+import numpy as np
+
+MISSING_TIMESTAMP = "1990-01-01"
+UNKNOWN_TYPE = -1
+
+
+def _intern(vocabulary: dict, value) -> int:
+    if value not in vocabulary:
+        vocabulary[value] = len(vocabulary)
+    return vocabulary[value]
+
+
+def _code_dtype(names) -> type:
+    """
+    smallest signed integer type holding a code for every name (and UNKNOWN_TYPE)
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if len(names) <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def ingest_edge_log(nodes_path: str = "data/nodes.json", edges_path: str = "data/edges.json",
+                    path: str = "data/edge_log"):
+    """
+    stream nodes.json and edges.json once and store them as columnar arrays: node ids are interned to integers,
+    timestamps become day ordinals and "type"/"r" become integer codes, as narrow as the number of names allows.
+    :param nodes_path: JSONL node file
+    :param edges_path: JSONL edge file
+    :param path: output directory
+    :return: the loaded edge log, see load_edge_log
+    """
+    node_index, node_types, type_names = {}, [], {}
+    for line in open(nodes_path, encoding="utf8"):
+        node = json.loads(line)["data"]
+        index = _intern(node_index, node["id"])
+        if index == len(node_types):
+            node_types.append(UNKNOWN_TYPE)
+        node_types[index] = _intern(type_names, node["type"])
+
+    edge_types, relations, days = {}, {"Structural": 0}, {}
+    sources, targets, edge_days, edge_type_codes, relation_codes = [], [], [], [], []
+    for line in open(edges_path, encoding="utf8"):
+        edge = json.loads(line)["data"]
+        for end_point, column in ((edge["source"], sources), (edge["target"], targets)):
+            index = _intern(node_index, end_point)
+            if index == len(node_types):
+                node_types.append(UNKNOWN_TYPE)
+            column.append(index)
+        timestamp = edge.get("timestamp", MISSING_TIMESTAMP)
+        if timestamp not in days:
+            days[timestamp] = dt.strptime(timestamp, "%Y-%m-%d").toordinal()
+        edge_days.append(days[timestamp])
+        edge_type_codes.append(_intern(edge_types, edge["type"]))
+        relation_codes.append(_intern(relations, edge.get("r", "")))
+
+    os.makedirs(path, exist_ok=True)
+    json.dump({"nodes": list(node_index), "node_type_names": list(type_names), "edge_type_names": list(edge_types),
+               "relation_names": list(relations)},
+              open(os.path.join(path, "meta.json"), "w", encoding="utf8"), ensure_ascii=False)
+    np.save(os.path.join(path, "node_types.npy"), np.array(node_types, dtype=_code_dtype(type_names)))
+    np.save(os.path.join(path, "source.npy"), np.array(sources, dtype=np.int32))
+    np.save(os.path.join(path, "target.npy"), np.array(targets, dtype=np.int32))
+    np.save(os.path.join(path, "day.npy"), np.array(edge_days, dtype=np.int32))
+    np.save(os.path.join(path, "type.npy"), np.array(edge_type_codes, dtype=_code_dtype(edge_types)))
+    np.save(os.path.join(path, "r.npy"), np.array(relation_codes, dtype=_code_dtype(relations)))
+    return load_edge_log(path)
+
+
+def load_edge_log(path: str = "data/edge_log") -> dict:
+    """
+    memory-map an edge log written by ingest_edge_log
+    :param path: edge log directory
+    :return: a dict with the vocabularies "nodes", "node_type_names", "edge_type_names", "relation_names" and the
+             arrays "node_types" (per node, -1 for ids only seen in edges), "source", "target", "day", "type", "r"
+             (per edge)
+    """
+    edge_log = json.load(open(os.path.join(path, "meta.json"), encoding="utf8"))
+    for name in ["node_types", "source", "target", "day", "type", "r"]:
+        edge_log[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    return edge_log
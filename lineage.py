@@ -0,0 +1,152 @@
+from collections import Counter, defaultdict
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from model_operations import extract_ids
+
+
+class LineageIndex:
+    """
+    indexes over the meta community network for interactive queries without scanning the graph: community positions by
+    (snapshot, community), events by type and time, the evolution edges in both directions and, when the communities are
+    given, the communities of every node. Ancestors and descendants are found by a traversal of the evolution edges
+    per query, so the index stays linear in the size of the network.
+    Events follow evolution_event_distribution_report: the "nex" event of TiCj and the "pre" event of Ti+1Ck belong
+    to the window starting at timestamps[i].
+    """
+
+    def __init__(self, meta_community_network: nx.DiGraph, timestamps: list, communities: list = None):
+        """
+        :param meta_community_network: output of meta_community_network_generation
+        :param timestamps: snapshot timestamps, snapshots["timestamps"]
+        :param communities: community structure of each snapshot, needed by memberships
+        """
+        self.timestamps = list(timestamps)
+        self._timestamp_array = np.array(self.timestamps)
+        self.names = sorted(meta_community_network.nodes(), key=extract_ids)
+        self.ids = np.array([extract_ids(name) for name in self.names], dtype=np.int64).reshape(-1, 2)
+        self.positions = {name: position for position, name in enumerate(self.names)}
+
+        events = defaultdict(list)
+        for position, name in enumerate(self.names):
+            sid = int(self.ids[position, 0])
+            attributes = meta_community_network.nodes[name]
+            if attributes.get("pre", "None") != "None":
+                events[attributes["pre"]].append((sid - 1, position))
+            if attributes.get("nex", "None") != "None":
+                events[attributes["nex"]].append((sid, position))
+        # per event type, windows and community positions sorted by window
+        self.events = {}
+        for event_type, occurrences in events.items():
+            occurrences.sort()
+            self.events[event_type] = (np.array([window for window, _ in occurrences], dtype=np.int64),
+                                       np.array([position for _, position in occurrences], dtype=np.int64))
+
+        n = len(self.names)
+        rows = [self.positions[u] for u, _ in meta_community_network.edges()]
+        cols = [self.positions[v] for _, v in meta_community_network.edges()]
+        self.successors = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n))
+        self.predecessors = self.successors.T.tocsr()
+
+        self.membership = None
+        if communities is not None:
+            self.membership = defaultdict(list)
+            for sid, community_struct in enumerate(communities):
+                for cid, community in enumerate(community_struct.communities):
+                    for node in community:
+                        self.membership[node].append((sid, cid))
+
+    def _position(self, community) -> int:
+        """
+        :param community: a community node "T{sid}C{cid}" or a (sid, cid) tuple
+        """
+        if not isinstance(community, str):
+            community = "T{:d}C{:d}".format(*community)
+        return self.positions[community]
+
+    def _window(self, date: str, side: str) -> int:
+        """
+        index of the first window starting on or after date ("left") or after date ("right")
+        """
+        return int(np.searchsorted(self._timestamp_array, date, side=side))
+
+    def _reachable(self, adjacency: sparse.csr_matrix, position: int) -> list:
+        """
+        breadth-first search over the evolution edges, one frontier of communities at a time
+        :return: names of the communities reachable from position (itself excluded), oldest first
+        """
+        seen = np.zeros(adjacency.shape[0], dtype=bool)
+        seen[position] = True
+        found, frontier = [], np.array([position])
+        while len(frontier):
+            frontier = np.unique(adjacency[frontier].indices)
+            frontier = frontier[~seen[frontier]]
+            seen[frontier] = True
+            found.append(frontier)
+        # names are sorted by (sid, cid), so sorted positions are oldest first
+        return [self.names[position] for position in np.sort(np.concatenate(found)).tolist()]
+
+    def community(self, sid: int, cid: int) -> str:
+        """
+        :return: the community node of (sid, cid), KeyError if the community does not exist
+        """
+        return self.names[self._position((sid, cid))]
+
+    def ancestors(self, community) -> list:
+        """
+        :param community: a community node or a (sid, cid) tuple
+        :return: every community the given one evolved from, oldest first
+        """
+        return self._reachable(self.predecessors, self._position(community))
+
+    def descendants(self, community) -> list:
+        """
+        :param community: a community node or a (sid, cid) tuple
+        :return: every community evolved from the given one, oldest first
+        """
+        return self._reachable(self.successors, self._position(community))
+
+    def lineage(self, community) -> list:
+        """
+        full lineage of a community: its ancestors, itself and its descendants, oldest first
+        """
+        return self.ancestors(community) + [self.names[self._position(community)]] + self.descendants(community)
+
+    def events_between(self, event_type: str, start: str = None, end: str = None) -> list:
+        """
+        all events of one type in the windows starting between two dates, e.g. events_between("merging", "2017-01-01",
+        "2017-12-31")
+        :param event_type: one of forming, continuing, growing, shrinking, splitting, merging, dissolving
+        :param start: first date "%Y-%m-%d" (inclusive), from the first window if not provided
+        :param end: last date "%Y-%m-%d" (inclusive), to the last window if not provided
+        :return: list of (window timestamp, community node)
+        """
+        if event_type not in self.events:
+            return []
+        windows, positions = self.events[event_type]
+        first = 0 if start is None else np.searchsorted(windows, self._window(start, "left"), side="left")
+        last = len(windows) if end is None else np.searchsorted(windows, self._window(end, "right"), side="left")
+        return [(self.timestamps[window], self.names[position])
+                for window, position in zip(windows[first:last].tolist(), positions[first:last].tolist())]
+
+    def event_counts(self) -> dict:
+        """
+        :return: {window timestamp: Counter({event type: count})}, the data of evolution_event_distribution_report
+        """
+        counts = defaultdict(Counter)
+        for event_type, (windows, _) in self.events.items():
+            for window, count in zip(*np.unique(windows, return_counts=True)):
+                counts[self.timestamps[window]][event_type] = int(count)
+        return dict(counts)
+
+    def memberships(self, node) -> list:
+        """
+        communities containing a node over time
+        :param node: a node id of the snapshots
+        :return: list of (timestamp, community node), one entry per snapshot the node belongs to a community in
+        """
+        if self.membership is None:
+            raise ValueError("LineageIndex was built without communities")
+        return [(self.timestamps[sid], "T{:d}C{:d}".format(sid, cid)) for sid, cid in self.membership.get(node, [])]
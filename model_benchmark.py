@@ -0,0 +1,144 @@
+import json
+import multiprocessing
+import os
+import pickle
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold
+
+from model_operations import CLASSIFIERS
+
+
+def _status_bytes(field: str) -> int:
+    for line in open("/proc/self/status"):
+        if line.startswith(f"{field}:"):
+            return int(line.split()[1]) * 1024
+    raise OSError(f"{field} not in /proc/self/status")
+
+
+def _measure_fit(fit) -> tuple:
+    """
+    run fit() and measure its time and its peak memory above the memory in use before it (bytes). On Linux this is the peak
+    resident set size, which includes native (C/OpenMP) allocations; elsewhere tracemalloc's peak of the Python
+    allocations. A tracemalloc session started by someone else (profiling.enable(memory=True)) is never reset nor
+    stopped; without /proc the peak is then not measured (None).
+    :return: (seconds, peak memory)
+    """
+    def timed():
+        start = time.perf_counter()
+        fit()
+        return time.perf_counter() - start
+
+    try:
+        # writing 5 to clear_refs resets the peak resident set size (VmHWM) of the process
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        before = _status_bytes("VmRSS")
+    except OSError:
+        before = None
+    if before is not None:
+        seconds = timed()
+        return seconds, max(0, _status_bytes("VmHWM") - before)
+    if tracemalloc.is_tracing():
+        return timed(), None
+    tracemalloc.start()
+    try:
+        seconds = timed()
+        return seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _benchmark_model(name: str, factory, X: np.ndarray, y: np.ndarray, cv: int, seed: int) -> dict:
+    """
+    cross-validate one classifier and measure its cost
+    :return: a result row, see benchmark_models
+    """
+    accuracy, f1, fit_time, predict_latency, peak_memory, model_size = [], [], [], [], [], []
+    for train, test in StratifiedKFold(cv, shuffle=True, random_state=seed).split(X, y):
+        model = factory()
+        seconds, peak = _measure_fit(lambda: model.fit(X[train], y[train]))
+        fit_time.append(seconds)
+        peak_memory.append(peak)
+
+        start = time.perf_counter()
+        prediction = model.predict(X[test])
+        predict_latency.append((time.perf_counter() - start) / len(test))
+        accuracy.append(accuracy_score(y[test], prediction))
+        f1.append(f1_score(y[test], prediction, average="macro"))
+        model_size.append(len(pickle.dumps(model)))
+
+    start = time.perf_counter()
+    for row in X[:20]:
+        model.predict(row[None, :])
+    single_latency = (time.perf_counter() - start) / min(len(X), 20)
+    return {
+        "model": name,
+        "accuracy": float(np.mean(accuracy)), "accuracy_std": float(np.std(accuracy)),
+        "f1_macro": float(np.mean(f1)), "f1_macro_std": float(np.std(f1)),
+        "fit_time": float(np.mean(fit_time)),
+        "predict_latency": float(np.mean(predict_latency)),
+        "single_predict_latency": single_latency,
+        "peak_memory": None if None in peak_memory else int(np.max(peak_memory)),
+        "model_size": int(np.mean(model_size)),
+    }
+
+
+def _pin_worker(cpus):
+    # one CPU per worker, so that concurrent fits do not compete for cores
+    os.sched_setaffinity(0, {cpus.get()})
+
+
+def benchmark_models(X, y, registry: dict = None, cv: int = 5, processes: int = None, seed: int = 42,
+                     output: str = None) -> list:
+    """
+    compare classifiers on the same samples with stratified cross-validation
+    :param X: samples, e.g. samples["train_X"]
+    :param y: labels
+    :param registry: {name: callable returning an unfitted classifier}, CLASSIFIERS by default. The callables must be
+                     picklable (classes or functools.partial) when processes is used
+    :param cv: number of folds
+    :param processes: if provided, models are benchmarked in up to this many worker processes, each pinned to its
+                      own CPU so that the fits do not skew each other's times. Where CPU affinity is not available
+                      (not Linux) the models run one after the other
+    :param seed: random seed of the folds
+    :param output: if provided, results are also written to this JSON file
+    :return: one row per model with mean accuracy and macro F1 (and their std over the folds), fit time (seconds),
+             predict latency (seconds per sample, batch and single sample), peak memory during fit (bytes, see
+             _measure_fit) and pickled model size (bytes)
+    """
+    registry = CLASSIFIERS if registry is None else registry
+    X, y = np.asarray(X), np.asarray(y)
+    if processes is None or not hasattr(os, "sched_setaffinity"):
+        results = [_benchmark_model(name, factory, X, y, cv, seed) for name, factory in registry.items()]
+    else:
+        cpus = multiprocessing.Queue()
+        available = sorted(os.sched_getaffinity(0))[:processes]
+        for cpu in available:
+            cpus.put(cpu)
+        with ProcessPoolExecutor(len(available), initializer=_pin_worker, initargs=(cpus,)) as executor:
+            futures = [executor.submit(_benchmark_model, name, factory, X, y, cv, seed)
+                       for name, factory in registry.items()]
+            results = [future.result() for future in futures]
+    if output is not None:
+        json.dump(results, open(output, "w"), indent=2)
+    return results
+
+
+def benchmark_report(results: list) -> str:
+    """
+    format benchmark results as a text table
+    :param results: the output of benchmark_models
+    :return: the table
+    """
+    lines = [f"{'model':<20}{'accuracy':>10}{'f1':>8}{'fit s':>9}{'pred us':>10}{'peak MB':>9}{'size KB':>10}"]
+    for row in sorted(results, key=lambda x: x["f1_macro"], reverse=True):
+        lines.append(f"{row['model']:<20}{row['accuracy']:>10.3f}{row['f1_macro']:>8.3f}{row['fit_time']:>9.3f}"
+                     f"{row['predict_latency'] * 1e6:>10.1f}"
+                     f"{row['peak_memory'] / 2 ** 20 if row['peak_memory'] is not None else float('nan'):>9.1f}"
+                     f"{row['model_size'] / 2 ** 10:>10.1f}")
+    return "\n".join(lines)
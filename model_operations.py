@@ -1,10 +1,18 @@
+import hashlib
+import importlib
+import json
+import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from typing import List, Tuple
 
 import networkx as nx
-import shap
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split
+import numpy as np
+
+from artifact_cache import cached_stage
+from feature_tensor import FeatureTensor
+from profiling import profiled
 
 
 def is_path_valid(path: List[str], graph: nx.DiGraph, SEQUENCE_LENGTH: int = 4) -> bool:
@@ -35,24 +43,52 @@ def extract_ids(community_node: str) -> Tuple[int, int]:
     return sid, cid
 
 
-def _generate_sample_vector(path: list, features, meta_community_network, event_mapping, relative=False):
+def iter_temporal_paths(meta_community_network: nx.DiGraph, SEQUENCE_LENGTH: int = 4):
+    """
+    enumerate the sample paths of the layered meta community network: every chain T -> T+1 -> ... of SEQUENCE_LENGTH
+    communities, and every chain one community shorter whose last community is dissolving (see is_path_valid).
+    Paths are extended layer by layer from each source community, depth first, so memory stays proportional to one
+    path per layer.
+    :param meta_community_network: meta community network with T{sid}C{cid} nodes
+    :param SEQUENCE_LENGTH: sequence length of path
+    :return: a generator of paths (lists of nodes)
+    """
+    layer = {node: extract_ids(node)[0] for node in meta_community_network}
+    for source in meta_community_network:
+        stack = [[source]]
+        while stack:
+            path = stack.pop()
+            if is_path_valid(path, meta_community_network, SEQUENCE_LENGTH):
+                yield path
+            if len(path) < SEQUENCE_LENGTH:
+                successors = [node for node in meta_community_network.successors(path[-1])
+                              if layer[node] == layer[path[-1]] + 1]
+                stack.extend(path + [node] for node in reversed(successors))
+
+
+EVENT_MAPPING = {"continuing": 1, "growing": 2, "shrinking": 3, "splitting": 4, "merging": 5, "dissolving": 6,
+                 "None": 0, "forming": 7}
+
+
+def _generate_sample_vector(path: list, features, meta_community_network, event_mapping, relative=False,
+                            history=3):
     sample_X, sample_y = [], [0]
     for index, node in enumerate(path):
         sid, cid = extract_ids(node)
-        if index <= 2:
+        if index <= history - 1:
             sample_X.extend(features[sid][cid])
-        if index == 2:
+        if index == history - 1:
             sample_y.append(event_mapping[meta_community_network.nodes[node]['nex']])
-        if index == 3:
+        if index == history:
             sample_y.append(event_mapping[meta_community_network.nodes[node]['pre']])
     if relative:
         length = len(sample_X)
         relative_sample_X = []
         for index, value in enumerate(sample_X):
-            if index < length / 3:
+            if index < length / history:
                 relative_sample_X.append(value)
             else:
-                x1, x2 = sample_X[index - int(length / 3)], value
+                x1, x2 = sample_X[index - int(length / history)], value
                 if x1 != 0:
                     relative_sample_X.append((x2 - x1)/x1 * 100)
                 else:
@@ -62,7 +98,58 @@ def _generate_sample_vector(path: list, features, meta_community_network, event_
     return sample_X, sample_y
 
 
-def generate_samples(meta_community_network, features, evolution_type_as_feature=False, pkl=None, relative=False):
+def path_indices(paths, meta_community_network, history=3, event_mapping=None) -> tuple:
+    """
+    convert sample paths to index arrays
+    :param paths: iterable of paths of history or history + 1 communities
+    :param meta_community_network: meta community network
+    :param history: number of windows used as features
+    :param event_mapping: event -> label, EVENT_MAPPING by default
+    :return: (sids, cids, labels), sids and cids of shape (n, history) and labels of shape (n,). The label is the
+             largest of 0, the "nex" event of the last history community and the "pre" event of the next community
+    """
+    event_mapping = EVENT_MAPPING if event_mapping is None else event_mapping
+    ids, sids, cids, labels = {}, [], [], []
+    for path in paths:
+        for node in path[:history]:
+            if node not in ids:
+                ids[node] = extract_ids(node)
+            sids.append(ids[node][0])
+            cids.append(ids[node][1])
+        label = max(0, event_mapping[meta_community_network.nodes[path[history - 1]]['nex']])
+        if len(path) > history:
+            label = max(label, event_mapping[meta_community_network.nodes[path[history]]['pre']])
+        labels.append(label)
+    shape = (len(labels), history)
+    return np.array(sids, dtype=np.int64).reshape(shape), np.array(cids, dtype=np.int64).reshape(shape), \
+        np.array(labels, dtype=np.int64)
+
+
+def build_sample_matrix(sids: np.ndarray, cids: np.ndarray, features, relative=False) -> np.ndarray:
+    """
+    gather the feature rows of all samples at once
+    :param sids: snapshot ids of shape (n, history)
+    :param cids: community ids of shape (n, history)
+    :param features: a FeatureTensor or the nested lists returned by feature_extraction
+    :param relative: replace the features of every window but the first by the percent change to the previous
+                     window (x2 * 100 where the previous value is 0), as _generate_sample_vector
+    :return: float32 array of shape (n, history * n_features), windows in path order
+    """
+    if not isinstance(features, FeatureTensor):
+        features = FeatureTensor.from_nested(features)
+    X = features.rows(sids.ravel(), cids.ravel()).reshape(sids.shape[0], sids.shape[1], -1)
+    if relative and sids.shape[1] > 1:
+        previous, current = X[:, :-1], X[:, 1:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = np.where(previous != 0, (current - previous) / previous * 100, current * 100)
+        X = np.concatenate([X[:, :1], change], axis=1)
+    return X.reshape(sids.shape[0], -1).astype(np.float32)
+
+
+@profiled
+@cached_stage("samples")
+def generate_samples(meta_community_network, features, evolution_type_as_feature=False, pkl=None, relative=False,
+                     paths="layered", history=3, matrix=False):
     """
     Generate Training and Testing samples from meta-community network
     :param relative:
@@ -70,43 +157,219 @@ def generate_samples(meta_community_network, features, evolution_type_as_feature
     :param meta_community_network:
     :param features:
     :param evolution_type_as_feature:
+    :param paths: "layered" uses every valid chain (iter_temporal_paths), "shortest" only keeps one shortest path per
+                  pair of communities, like the samples of the paper
+    :param history: number of windows used as features, paths have history + 1 communities
+    :param matrix: build float32 train_X/test_X matrices and label arrays with build_sample_matrix instead of lists
     :return:
     """
     if pkl is not None:
         print(f"loading samples from {pkl}")
         return pickle.load(open(pkl, 'rb'))
-    paths = dict(nx.all_pairs_shortest_path(meta_community_network, cutoff=4))
-    available_paths = [path for single_source_paths in paths.values() for path in single_source_paths.values()
-                       if is_path_valid(path, meta_community_network)]
-    event_mapping = {"continuing": 1, "growing": 2, "shrinking": 3, "splitting": 4, "merging": 5, "dissolving": 6,
-                     "None": 0, "forming": 7}
-    X, Y = [], []
-    for path in available_paths:
-        sample_X, sample_y = _generate_sample_vector(path, features, meta_community_network, event_mapping, relative)
-        X.append(sample_X)
-        Y.append(sample_y)
+    if paths == "layered":
+        available_paths = iter_temporal_paths(meta_community_network, history + 1)
+    else:
+        paths = dict(nx.all_pairs_shortest_path(meta_community_network, cutoff=history + 1))
+        available_paths = [path for single_source_paths in paths.values() for path in single_source_paths.values()
+                           if is_path_valid(path, meta_community_network, history + 1)]
+    if matrix:
+        sids, cids, Y = path_indices(available_paths, meta_community_network, history)
+        X = build_sample_matrix(sids, cids, features, relative)
+    else:
+        X, Y = [], []
+        for path in available_paths:
+            sample_X, sample_y = _generate_sample_vector(path, features, meta_community_network, EVENT_MAPPING,
+                                                         relative, history)
+            X.append(sample_X)
+            Y.append(sample_y)
+    from sklearn.model_selection import train_test_split
     train_X, test_X, train_Y, test_Y = train_test_split(X, Y, test_size=0.2, random_state=42)
-    samples = {"train_X": train_X, "train_Y": train_Y, "test_X": test_X, "test_Y": test_Y}
-    pickle.dump(samples, open("data/samples.pkl", "wb"))
+    samples = {"train_X": train_X, "train_Y": train_Y, "test_X": test_X, "test_Y": test_Y, "history": history,
+               "relative": relative}
     return samples
 
 
-def train_prediction_model(train_X, train_Y, model_name="random_forest", pkl=None):
+def _classifier(module: str, name: str, **params):
+    """
+    create a scikit-learn classifier, importing its module only when a model is actually built
+    """
+    return getattr(importlib.import_module(module), name)(**params)
+
+
+CLASSIFIERS = {
+    "random_forest": partial(_classifier, "sklearn.ensemble", "RandomForestClassifier", n_estimators=50),
+    "extra_trees": partial(_classifier, "sklearn.ensemble", "ExtraTreesClassifier", n_estimators=50),
+    "gradient_boosting": partial(_classifier, "sklearn.ensemble", "GradientBoostingClassifier"),
+    "decision_tree": partial(_classifier, "sklearn.tree", "DecisionTreeClassifier"),
+    "logistic_regression": partial(_classifier, "sklearn.linear_model", "LogisticRegression", max_iter=1000),
+    "knn": partial(_classifier, "sklearn.neighbors", "KNeighborsClassifier"),
+}
+
+
+@profiled
+@cached_stage("model", "explainer.pkl")
+def train_prediction_model(train_X, train_Y, model_name="random_forest", pkl=None, n_jobs=None, predictor=None,
+                           history=3, relative=False):
     """
     using specified training model
     :param pkl:
     :param train_X:
     :param train_Y:
-    :param model_name:
+    :param model_name: a key of CLASSIFIERS, the explainer needs a tree model
+    :param n_jobs: number of jobs of models supporting it (e.g. random forest)
+    :param predictor: if provided, the model is also exported for prediction_service to this file
+    :param history: history of the samples (samples["history"]), stored with the exported predictor
+    :param relative: relative of the samples (samples["relative"]), stored with the exported predictor
     :return:
     """
     if pkl is not None:
         print(f"loading model from {pkl}")
         return pickle.load(open(pkl, 'rb'))
-    model = None
-    if model_name == "random_forest":
-        model = RandomForestClassifier(n_estimators=50)
+    import shap
+    model = CLASSIFIERS[model_name]()
+    if n_jobs is not None and "n_jobs" in model.get_params():
+        model.set_params(n_jobs=n_jobs)
     model.fit(train_X, train_Y)
     explainer = shap.TreeExplainer(model)
-    pickle.dump(explainer, open("data/explainer.pkl", "wb"))
+    if predictor is not None:
+        export_predictor(model, predictor, history=history, relative=relative)
     return explainer
+
+
+PREDICTOR_PATH = "data/predictor.npz"
+TREE_ARRAYS = ["children_left", "children_right", "children_default", "features", "thresholds", "values",
+               "base_offset"]
+
+
+def export_predictor(model, path: str = PREDICTOR_PATH, classes=None, history: int = 3, relative: bool = False):
+    """
+    store a tree ensemble classifier as a few compressed arrays (the tree layout shap uses) for
+    prediction_service.PredictionService, a fraction of the size of the pickled explainer
+    :param model: a fitted forest or tree classifier, or the shap.TreeExplainer returned by train_prediction_model
+    :param path: output .npz file
+    :param classes: class labels of the model outputs, taken from the model if not provided (needed for explainers)
+    :param history: number of windows in a sample
+    :param relative: whether the samples were built with relative=True
+    """
+    import shap
+    if isinstance(model, shap.TreeExplainer):
+        ensemble = model.model
+    else:
+        ensemble = shap.TreeExplainer(model).model
+        classes = model.classes_ if classes is None else classes
+    if classes is None:
+        raise ValueError("classes are needed to export an explainer")
+    from community_operations import FEATURE_NAMES
+    n_features = getattr(model, "n_features_in_", None)
+    if n_features is not None and n_features != history * len(FEATURE_NAMES):
+        raise ValueError(f"the model has {n_features} features, samples of history {history} have "
+                         f"{history * len(FEATURE_NAMES)}")
+    if ensemble.tree_output != "probability":
+        raise ValueError(f"only probability tree ensembles can be exported, not {ensemble.tree_output}")
+    np.savez_compressed(path, classes=np.asarray(classes), history=history, relative=relative,
+                        **{name: getattr(ensemble, name) for name in TREE_ARRAYS})
+
+
+def _class_shap_values(values) -> np.ndarray:
+    """
+    shap returns a list with one (n, features) array per class (older versions) or one (n, features, classes) array
+    :return: array of shape (classes, n, features)
+    """
+    if isinstance(values, list):
+        return np.stack(values)
+    values = np.asarray(values)
+    return np.moveaxis(values, -1, 0) if values.ndim == 3 else values[None]
+
+
+def stratified_subsample(labels, size: int, seed: int = 42) -> np.ndarray:
+    """
+    pick about `size` samples keeping the class proportions, at least one sample of every class
+    :param labels: class of each sample
+    :param size: number of samples to pick
+    :param seed: random seed
+    :return: sorted sample indices
+    """
+    labels, rng = np.asarray(labels), np.random.RandomState(seed)
+    if size >= len(labels):
+        return np.arange(len(labels))
+    indices = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        count = min(len(members), max(1, int(round(size * len(members) / len(labels)))))
+        indices.append(rng.choice(members, count, replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+_SHAP_EXPLAINER = None
+
+
+def _init_shap_worker(explainer):
+    global _SHAP_EXPLAINER
+    _SHAP_EXPLAINER = explainer
+
+
+def _shap_chunk(chunk: np.ndarray) -> np.ndarray:
+    return _class_shap_values(_SHAP_EXPLAINER.shap_values(chunk))
+
+
+@profiled
+def compute_shap_values(explainer, X, path="data/shap", chunk_size=256, processes=None, subsample=None, labels=None,
+                        seed=42) -> tuple:
+    """
+    SHAP values computed chunk by chunk and written to a memory-mapped array. Finished chunks are recorded on disk, so
+    an interrupted run resumes where it stopped when called again with the same arguments.
+    :param explainer: a fitted shap explainer, e.g. the one returned by train_prediction_model
+    :param X: samples to explain
+    :param path: output directory, values.npy holds the values with shape (classes, samples, features)
+    :param chunk_size: samples per chunk
+    :param processes: if provided, chunks are explained in this many worker processes
+    :param subsample: if provided, only explain about this many samples, stratified by labels
+    :param labels: class of each sample, needed for subsample
+    :param seed: random seed of the subsample
+    :return: (values, indices), values is a read-only memmap whose [class_index] gives the per-class array expected by
+             the reports, indices are the explained rows of X
+    """
+    if subsample is not None and labels is None:
+        raise ValueError("subsample needs the labels of the samples")
+    X = np.asarray(X)
+    indices = np.arange(len(X)) if subsample is None else stratified_subsample(labels, subsample, seed)
+    n_classes = len(np.atleast_1d(explainer.expected_value))
+    shape = (n_classes, len(indices), X.shape[1])
+    chunks = [(start, min(start + chunk_size, len(indices))) for start in range(0, len(indices), chunk_size)]
+    # a retrained model on the same samples must not resume the old values
+    meta = {"shape": list(shape), "chunk_size": chunk_size,
+            "digest": hashlib.sha256(np.ascontiguousarray(X[indices]).tobytes()).hexdigest(),
+            "explainer": hashlib.sha256(pickle.dumps(explainer)).hexdigest()}
+
+    values_path, done_path, meta_path = [os.path.join(path, name) for name in ["values.npy", "done.npy", "meta.json"]]
+    if os.path.exists(meta_path) and json.load(open(meta_path)) == meta:
+        values = np.lib.format.open_memmap(values_path, mode="r+")
+        done = np.lib.format.open_memmap(done_path, mode="r+")
+        print(f"resuming shap values in {path}: {int(done.sum())}/{len(chunks)} chunks done")
+    else:
+        os.makedirs(path, exist_ok=True)
+        values = np.lib.format.open_memmap(values_path, mode="w+", dtype=np.float32, shape=shape)
+        done = np.lib.format.open_memmap(done_path, mode="w+", dtype=bool, shape=(len(chunks),))
+        np.save(os.path.join(path, "indices.npy"), indices)
+        json.dump(meta, open(meta_path, "w"))
+
+    todo = [index for index in range(len(chunks)) if not done[index]]
+    inputs = (X[indices[chunks[index][0]:chunks[index][1]]] for index in todo)
+    if processes is None:
+        _init_shap_worker(explainer)
+        results = map(_shap_chunk, inputs)
+    else:
+        executor = ProcessPoolExecutor(processes, initializer=_init_shap_worker, initargs=(explainer,))
+        results = executor.map(_shap_chunk, inputs)
+    try:
+        for index, result in zip(todo, results):
+            start, end = chunks[index]
+            values[:, start:end] = result
+            values.flush()
+            done[index] = True
+            done.flush()
+    finally:
+        if processes is not None:
+            executor.shutdown(cancel_futures=True)
+    del values, done
+    return np.load(values_path, mmap_mode="r"), indices
@@ -0,0 +1,198 @@
+import pickle
+from collections import ChainMap
+from datetime import datetime as dt
+from datetime import timedelta
+
+import networkx as nx
+
+from community_operations import FEATURE_ENGINES, GED, _louvain_partition, _node_clustering
+from generate_snapshots import SnapshotBuilder, _prepare_edge_log
+
+
+class OnlineEcosystem:
+    """
+    stage results kept up to date while edges arrive. Only the newest snapshot is open: ingest() rebuilds it (or
+    creates the next ones when time moves past it), then reruns community detection, PageRank and feature extraction
+    for those snapshots only and redoes GED against the previous window. A node whose type changes is retyped in the
+    older snapshots too, and their features are recomputed.
+    The state always equals a full rebuild of the stages up to the newest snapshot, i.e. generate_snapshots(...,
+    history_end=day after the newest timestamp), static_community_detection(mode="parallel", seed=seed),
+    social_position_score(engine="networkx"), feature_extraction(engine=engine) and meta_community_network_generation.
+    """
+
+    def __init__(self, end_time: dt, window_size: int, edges: list, nodes: list, as_of: dt = None, seed: int = 0,
+                 alpha: float = 0.5, beta: float = 0.5, method: str = "index", tol: float = 1e-06,
+                 engine: str = "sweep", closeness_options: dict = None, ignore_event=True):
+        """
+        :param end_time: timestamp of the first snapshot
+        :param window_size: days between snapshots
+        :param edges: the edges known so far
+        :param nodes: the nodes known so far
+        :param as_of: the newest snapshot is the first one at or after this date, by default the newest edge
+        :param seed: base random seed of the community detection, snapshot i uses seed + i
+        :param alpha: GED alpha
+        :param beta: GED beta
+        :param method: GED method
+        :param tol: PageRank error tolerance
+        :param engine: feature extraction engine, see FEATURE_ENGINES
+        :param closeness_options: options of community_features.closeness_centrality
+        :param ignore_event: True if don't care about events
+        """
+        self.start_time, self.window_size, self.ignore_event = end_time, window_size, ignore_event
+        self.seed, self.alpha, self.beta, self.method, self.tol = seed, alpha, beta, method, tol
+        self.engine, self.closeness_options = engine, closeness_options
+        self.builder = SnapshotBuilder(*_prepare_edge_log(nodes, edges, ignore_event))
+        self.node_index = {node: index for index, node in enumerate(self.builder.node_ids)}
+        self.snapshots = {"snapshots": [], "timestamps": []}
+        self.communities, self.social_positions, self.features = [], [], []
+        self.meta_community_network = nx.DiGraph()
+        self.ingest(as_of=as_of)
+
+    def _latest_time(self) -> dt:
+        return self.start_time + timedelta(days=self.window_size * (len(self.snapshots["timestamps"]) - 1))
+
+    def _new_nodes(self, nodes: list) -> tuple:
+        """
+        read new nodes without changing the state, with the rules of _prepare_edge_log: the first occurrence fixes
+        the index, the last one the type
+        :return: (indices of the unknown nodes, type of every node)
+        """
+        new_index, types = {}, {}
+        for node in nodes:
+            if self.ignore_event and node["type"] == "Event":
+                continue
+            if node["id"] not in self.node_index and node["id"] not in new_index:
+                new_index[node["id"]] = len(self.builder.node_ids) + len(new_index)
+            types[node["id"]] = node["type"]
+        return new_index, types
+
+    def _log_entries(self, edges: list, node_index) -> list:
+        """
+        convert edges to edge log entries like _prepare_edge_log
+        """
+        entries = []
+        for edge in edges:
+            if edge["source"] not in node_index or edge["target"] not in node_index:
+                continue
+            day = dt.strptime(edge.get("timestamp", "1990-01-01"), "%Y-%m-%d").toordinal()
+            r = edge["r"] if edge["type"] != "Structural" else "Structural"
+            entries.append((day, node_index[edge["source"]], node_index[edge["target"]], r))
+        return entries
+
+    def _retype(self, types: dict) -> list:
+        """
+        set the node types, in the built snapshots too (a full rebuild gives every snapshot the last type), and
+        recompute the features of the snapshots holding a retyped node
+        :return: indices of those snapshots
+        """
+        changed = {node: node_type for node, node_type in types.items()
+                   if node in self.builder.node_types and self.builder.node_types[node] != node_type}
+        self.builder.node_types.update(types)
+        retyped = []
+        for index, snapshot in enumerate(self.snapshots["snapshots"]):
+            nodes = [node for node in changed if node in snapshot]
+            if not nodes:
+                continue
+            for node in nodes:
+                snapshot.nodes[node]["type"] = changed[node]
+            self.features[index] = FEATURE_ENGINES[self.engine](snapshot, self.communities[index].communities,
+                                                                self.social_positions[index], self.closeness_options)
+            retyped.append(index)
+        return retyped
+
+    def _update_snapshot(self, index: int, snapshot: nx.Graph):
+        """
+        store snapshot index and recompute the results depending on it
+        """
+        timestamp = (self.start_time + timedelta(days=self.window_size * index)).strftime("%Y-%m-%d")
+        snapshot_seed = self.seed + index
+        clustering = _node_clustering(snapshot, _louvain_partition(snapshot, snapshot_seed), snapshot_seed)
+        clustering.communities = [community for community in clustering.communities if len(community) >= 3]
+        social_position = dict(nx.pagerank(snapshot, alpha=0.85, weight="weight", tol=self.tol))
+        features = FEATURE_ENGINES[self.engine](snapshot, clustering.communities, social_position,
+                                                self.closeness_options)
+        results = [self.snapshots["snapshots"], self.snapshots["timestamps"], self.communities, self.social_positions,
+                   self.features]
+        for values, value in zip(results, [snapshot, timestamp, clustering, social_position, features]):
+            if index < len(values):
+                values[index] = value
+            else:
+                values.append(value)
+        self._update_meta_community_network(index)
+
+    def _update_meta_community_network(self, index: int):
+        """
+        replace the communities of snapshot index in the meta community network and redo GED with the previous window
+        """
+        network = self.meta_community_network
+        network.remove_nodes_from([node for node in network if node.startswith(f"T{index}C")])
+        for index_j in range(len(self.communities[index].communities)):
+            network.add_node(f"T{index}C{index_j}", pre="None", nex="None")
+        if index == 0:
+            return
+        for index_j in range(len(self.communities[index - 1].communities)):
+            network.nodes[f"T{index - 1}C{index_j}"]["nex"] = "None"
+        possible_events, events = GED(self.communities[index - 1].communities, self.communities[index].communities,
+                                      self.social_positions[index - 1], self.social_positions[index], self.alpha,
+                                      self.beta, self.method)
+        # the same naming as _build_meta_community_network
+        for source, target, _ in possible_events:
+            network.add_edge("T{:d}C".format(index - 1) + source[2:], "T{:d}C".format(index) + target[2:])
+        for node, event_type in events:
+            if node[0] == 'A':
+                network.nodes["T{:d}C".format(index - 1) + node[2:]]["nex"] = event_type
+            else:
+                network.nodes["T{:d}C".format(index) + node[2:]]["pre"] = event_type
+
+    def ingest(self, edges: list = (), nodes: list = (), as_of: dt = None) -> list:
+        """
+        add new nodes and edges. Edges must be newer than the snapshot before the newest one.
+        :param edges: new edges
+        :param nodes: new nodes, the nodes of new edges must be known
+        :param as_of: the current date, snapshots are created up to the first one at or after it. By default the
+                      newest edge date
+        :return: indices of the snapshots that were rebuilt, retyped or created
+        """
+        # nothing changes before the input is accepted
+        new_index, types = self._new_nodes(nodes)
+        entries = self._log_entries(edges, ChainMap(new_index, self.node_index))
+        latest = len(self.snapshots["timestamps"]) - 1
+        rebuild = False
+        if entries and latest >= 0:
+            first_day = min(day for day, _, _, _ in entries)
+            if latest > 0 and first_day <= (self._latest_time() - timedelta(days=self.window_size)).toordinal():
+                raise ValueError("edges older than the previous snapshot need a full rebuild")
+            rebuild = first_day <= self._latest_time().toordinal()
+        self.node_index.update(new_index)
+        self.builder.node_ids.extend(new_index)
+        updated = self._retype(types)
+        if rebuild:
+            # the newest snapshot is rebuilt with the new edges
+            self.builder.rollback()
+            updated = [index for index in updated if index != latest] + [latest]
+        log, cursor = self.builder.log, self.builder.cursor
+        # a stable sort of the pending edges followed by the new ones keeps the order of a full rebuild
+        log[cursor:] = sorted(log[cursor:] + entries, key=lambda x: x[0])
+        if rebuild:
+            self._update_snapshot(latest, self.builder.snapshot(self._latest_time()))
+        if as_of is None:
+            as_of = dt.fromordinal(log[-1][0]) if log else self.start_time
+        while not self.snapshots["timestamps"] or self._latest_time() < as_of:
+            index = len(self.snapshots["timestamps"])
+            end_time = self.start_time + timedelta(days=self.window_size * index)
+            self._update_snapshot(index, self.builder.snapshot(end_time))
+            updated.append(index)
+        return updated
+
+    def history_end(self) -> str:
+        """
+        :return: the history_end of the equivalent full rebuild, the day after the newest snapshot
+        """
+        return (self._latest_time() + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    def save(self, path: str):
+        pickle.dump(self, open(path, "wb"))
+
+    @staticmethod
+    def load(path: str) -> "OnlineEcosystem":
+        return pickle.load(open(path, "rb"))
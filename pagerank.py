@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+
+def sparse_pagerank(adjacency: sparse.csr_matrix, alpha: float = 0.85, tol: float = 1e-06, max_iter: int = 100,
+                    nstart: np.ndarray = None) -> tuple:
+    """
+    weighted PageRank by power iteration on a sparse adjacency, the same iteration as nx.pagerank
+    :param adjacency: weighted adjacency of one snapshot
+    :param alpha: damping parameter
+    :param tol: error tolerance used to check convergence (l1 norm, scaled by the number of nodes)
+    :param max_iter: maximum number of iterations
+    :param nstart: starting vector, uniform if not provided
+    :return: (scores, number of iterations)
+    """
+    N = adjacency.shape[0]
+    if N == 0:
+        return np.zeros(0), 0
+    S = np.asarray(adjacency.sum(axis=1)).ravel()
+    S[S != 0] = 1.0 / S[S != 0]
+    A = sparse.diags(S).tocsr() @ adjacency
+    x = np.repeat(1.0 / N, N) if nstart is None else nstart / nstart.sum()
+    p = np.repeat(1.0 / N, N)
+    is_dangling = np.where(S == 0)[0]
+    for iteration in range(1, max_iter + 1):
+        xlast = x
+        x = alpha * (x @ A + x[is_dangling].sum() * p) + (1 - alpha) * p
+        if np.absolute(x - xlast).sum() < N * tol:
+            return x, iteration
+    raise nx.PowerIterationFailedConvergence(max_iter)
+
+
+def _pagerank_batch(adjacencies: list, members: list, n_nodes: int, alpha: float, tol: float, max_iter: int,
+                    warm_start: bool) -> tuple:
+    """
+    PageRank of consecutive snapshots, each run starting from the scores of the previous snapshot
+    :return: (list of score arrays, list of iteration counts)
+    """
+    scores, iterations, previous = [], [], np.full(n_nodes, np.nan)
+    for adjacency, nodes in zip(adjacencies, members):
+        nstart = None
+        if warm_start and scores:
+            # nodes new in this snapshot start from the uniform score
+            nstart = previous[nodes]
+            nstart[np.isnan(nstart)] = 1.0 / len(nodes)
+        x, iteration = sparse_pagerank(adjacency, alpha, tol, max_iter, nstart)
+        previous = np.full(n_nodes, np.nan)
+        previous[nodes] = x
+        scores.append(x)
+        iterations.append(iteration)
+    return scores, iterations
+
+
+def pagerank_snapshots(sparse_snapshots: dict, members: list = None, alpha: float = 0.85, tol: float = 1e-06,
+                       max_iter: int = 100, warm_start: bool = True, processes: int = None,
+                       batch_size: int = None) -> dict:
+    """
+    PageRank of every snapshot on the shared node index. With warm_start each snapshot starts from the scores of the
+    previous one, which needs far fewer iterations on nearly identical snapshots.
+    :param sparse_snapshots: the output of sparse_snapshots.generate_sparse_snapshots or graphs_to_sparse
+    :param members: node indices of each snapshot, by default the nodes with at least one edge
+    :param alpha: damping parameter
+    :param tol: error tolerance used to check convergence
+    :param max_iter: maximum number of iterations
+    :param warm_start: start each snapshot from the scores of the previous snapshot
+    :param processes: if provided, batches of consecutive snapshots run in this many worker processes. Warm starts
+                      only chain inside a batch
+    :param batch_size: snapshots per batch, by default the snapshots are split evenly over the processes
+    :return: a dict {"nodes": [id...], "scores": [array...], "iterations": [int...]}. scores[i] is aligned to the node
+             index, nodes not in snapshot i are nan
+    """
+    matrices = sparse_snapshots["snapshots"]
+    if members is None:
+        members = [np.flatnonzero(np.diff(matrix.indptr)) for matrix in matrices]
+    adjacencies = [matrix[nodes][:, nodes] for matrix, nodes in zip(matrices, members)]
+    n_nodes = len(sparse_snapshots["nodes"])
+
+    if processes is None:
+        scores, iterations = _pagerank_batch(adjacencies, members, n_nodes, alpha, tol, max_iter, warm_start)
+    else:
+        batch_size = batch_size or max(1, -(-len(matrices) // processes))
+        batches = range(0, len(matrices), batch_size)
+        scores, iterations = [], []
+        with ProcessPoolExecutor(processes) as executor:
+            futures = [executor.submit(_pagerank_batch, adjacencies[start:start + batch_size],
+                                       members[start:start + batch_size], n_nodes, alpha, tol, max_iter, warm_start)
+                       for start in batches]
+            for future in futures:
+                batch_scores, batch_iterations = future.result()
+                scores.extend(batch_scores)
+                iterations.extend(batch_iterations)
+
+    aligned = []
+    for x, nodes in zip(scores, members):
+        score = np.full(n_nodes, np.nan)
+        score[nodes] = x
+        aligned.append(score)
+    return {"nodes": sparse_snapshots["nodes"], "scores": aligned, "iterations": iterations}
+
+
+def scores_to_dicts(pagerank: dict, members: list) -> list:
+    """
+    convert aligned score arrays to the [{node: score, ...}, ...] format of social_position_score
+    :param pagerank: the output of pagerank_snapshots
+    :param members: node indices of each snapshot, the dict order follows them
+    :return: list of {node: score}
+    """
+    node_ids = pagerank["nodes"]
+    return [dict(zip([node_ids[node] for node in nodes.tolist()], score[nodes].tolist()))
+            for score, nodes in zip(pagerank["scores"], members)]
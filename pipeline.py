@@ -0,0 +1,323 @@
+import os
+import pickle
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime as dt
+from datetime import timedelta
+from functools import partial
+
+import networkx as nx
+
+from artifact_cache import CACHE_DIR, ArtifactKey, artifact_key, load_artifact, stage_key, store_artifact
+from community_operations import FEATURE_ENGINES, GED, _build_meta_community_network, _louvain_partition, \
+    _node_clustering, feature_extraction, meta_community_network_generation, social_position_score, \
+    static_community_detection
+from generate_snapshots import HISTORY_END, generate_snapshots, positive_snapshots
+from model_operations import generate_samples, train_prediction_model
+from report import evolution_event_distribution_report
+
+# stage: stages it depends on
+STAGES = {
+    "snapshots": [],
+    "positive_edges": ["snapshots"],
+    "communities": ["positive_edges"],
+    "social_positions": ["positive_edges"],
+    "meta_community_network": ["communities", "social_positions"],
+    "features": ["positive_edges", "communities", "social_positions"],
+    "samples": ["meta_community_network", "features"],
+    "model": ["samples"],
+    "report": ["snapshots", "meta_community_network"],
+}
+# stage: artifact file, the same files the stages write to data/
+ARTIFACTS = {
+    "snapshots": "snapshots.pkl",
+    "positive_edges": "positive_snapshots.pkl",
+    "communities": "communities.pkl",
+    "social_positions": "social_positions.pkl",
+    "meta_community_network": "meta_community_network.pkl",
+    "features": "features.pkl",
+    "samples": "samples.pkl",
+    "model": "explainer.pkl",
+}
+# stages whose function already writes data_dir/{artifact}
+_SELF_WRITING = ["snapshots", "samples", "model"]
+
+Task = namedtuple("Task", ["dependencies", "function", "arguments", "remote"])
+
+
+def _timed(function, arguments):
+    start = time.perf_counter()
+    result = function(*arguments)
+    return result, time.perf_counter() - start
+
+
+def _snapshot_count(end_time: dt, window_size: int) -> int:
+    count, history_end = 0, dt.strptime(HISTORY_END, "%Y-%m-%d")
+    while end_time < history_end:
+        count, end_time = count + 1, end_time + timedelta(days=window_size)
+    return count
+
+
+def _positive_edges(snapshots: dict, enabled: bool) -> dict:
+    """
+    the snapshots the later stages run on: without the edges of weight <= 0 if enabled, see positive_snapshots
+    """
+    if not enabled:
+        return snapshots
+    cleaned, removed = positive_snapshots(snapshots)
+    print(f"{removed} edges of weight <= 0 removed from the snapshots")
+    return cleaned
+
+
+def _stage_keys(end_time, window_size, edges, nodes, options: dict) -> dict:
+    """
+    cache keys of the stage results, chained through the keys of their inputs. They are the keys the cache keyword
+    of the stage functions would use for the equivalent calls on artifacts loaded from the cache, so the pipeline and
+    the stage functions share cache entries.
+    :return: {stage: key} for the stages of ARTIFACTS
+    """
+    keys = {"snapshots": stage_key(generate_snapshots, "snapshots", end_time, window_size, edges, nodes)}
+    # without cleaning the later stages run on the snapshots themselves
+    keys["positive_edges"] = artifact_key("positive_edges", {"snapshots": ArtifactKey(keys["snapshots"])}) \
+        if options["positive_edges"] else keys["snapshots"]
+    snapshots = ArtifactKey(keys["positive_edges"])
+    keys["communities"] = stage_key(static_community_detection, "communities", snapshots, mode="parallel",
+                                    seed=options["seed"])
+    keys["social_positions"] = stage_key(social_position_score, "social_positions", snapshots, engine="networkx",
+                                         tol=options["tol"])
+    communities, social_positions = ArtifactKey(keys["communities"]), ArtifactKey(keys["social_positions"])
+    keys["meta_community_network"] = stage_key(meta_community_network_generation, "meta_community_network",
+                                               communities, social_positions, options["alpha"], options["beta"],
+                                               method=options["method"])
+    keys["features"] = stage_key(feature_extraction, "features", snapshots, communities, social_positions,
+                                 engine=options["engine"], closeness_options=options["closeness_options"])
+    keys["samples"] = stage_key(generate_samples, "samples", ArtifactKey(keys["meta_community_network"]),
+                                ArtifactKey(keys["features"]))
+    keys["model"] = stage_key(train_prediction_model, "model", ArtifactKey(keys["samples"] + "/train_X"),
+                              ArtifactKey(keys["samples"] + "/train_Y"), options["model_name"])
+    return keys
+
+
+def _snapshot_communities(snapshot: nx.Graph, seed: int) -> list:
+    """
+    communities of one snapshot with at least 3 nodes, as static_community_detection(mode="parallel")
+    """
+    clustering = _node_clustering(snapshot, _louvain_partition(snapshot, seed), seed)
+    return [community for community in clustering.communities if len(community) >= 3]
+
+
+def _snapshot_social_position(snapshot: nx.Graph, tol: float) -> dict:
+    return dict(nx.pagerank(snapshot, alpha=0.85, weight="weight", tol=tol))
+
+
+def _assemble_communities(snapshots, seed, *communities) -> list:
+    from cdlib import NodeClustering
+    return [NodeClustering(snapshot_communities, snapshot, "Louvain",
+                           method_parameters={"weight": "weight", "resolution": 1., "randomize": seed + index})
+            for index, (snapshot, snapshot_communities) in enumerate(zip(snapshots["snapshots"], communities))]
+
+
+def _pipeline_tasks(stages: list, n_snapshots: int, end_time, window_size, edges, nodes, options: dict,
+                    data_dir: str) -> dict:
+    """
+    task graph of the stages to run. communities, social_positions, features and the meta community network are
+    split into one task per snapshot (or window) plus a local task assembling the stage result, so that the tasks of
+    snapshot i only wait for the inputs of snapshot i.
+    :param stages: stages to run, the others are loaded before the tasks start
+    :param data_dir: directory the self-writing stages write their artifact to
+    :return: {task name: Task}, in submission order
+    """
+    tasks = {}
+
+    def per_snapshot(stage, index):
+        # task holding the value of one snapshot, or the loaded stage
+        return f"{stage}/{index}" if stage in stages else stage
+
+    def value(results, stage, index):
+        if f"{stage}/{index}" in results:
+            return results[f"{stage}/{index}"]
+        if stage == "communities":
+            return results[stage][index].communities
+        return results[stage][index]
+
+    if "snapshots" in stages:
+        tasks["snapshots"] = Task([], partial(generate_snapshots, data_dir=data_dir),
+                                  lambda r: (end_time, window_size, edges, nodes), True)
+    if "positive_edges" in stages:
+        tasks["positive_edges"] = Task(["snapshots"], _positive_edges,
+                                       lambda r: (r["snapshots"], options["positive_edges"]), False)
+    if "communities" in stages:
+        for index in range(n_snapshots):
+            tasks[f"communities/{index}"] = Task(
+                ["positive_edges"], _snapshot_communities,
+                lambda r, index=index: (r["positive_edges"]["snapshots"][index], options["seed"] + index), True)
+    if "social_positions" in stages:
+        for index in range(n_snapshots):
+            tasks[f"social_positions/{index}"] = Task(
+                ["positive_edges"], _snapshot_social_position,
+                lambda r, index=index: (r["positive_edges"]["snapshots"][index], options["tol"]), True)
+    if "features" in stages:
+        extract = FEATURE_ENGINES[options["engine"]]
+        for index in range(n_snapshots):
+            tasks[f"features/{index}"] = Task(
+                ["positive_edges", per_snapshot("communities", index), per_snapshot("social_positions", index)],
+                extract, lambda r, index=index: (r["positive_edges"]["snapshots"][index],
+                                                 value(r, "communities", index), value(r, "social_positions", index),
+                                                 options["closeness_options"]), True)
+    if "meta_community_network" in stages:
+        for index in range(n_snapshots - 1):
+            tasks[f"GED/{index}"] = Task(
+                [per_snapshot(stage, i) for stage in ["communities", "social_positions"] for i in (index, index + 1)],
+                GED, lambda r, index=index: (value(r, "communities", index), value(r, "communities", index + 1),
+                                             value(r, "social_positions", index),
+                                             value(r, "social_positions", index + 1),
+                                             options["alpha"], options["beta"], options["method"]), True)
+    if "communities" in stages:
+        tasks["communities"] = Task(
+            ["positive_edges"] + [f"communities/{index}" for index in range(n_snapshots)], _assemble_communities,
+            lambda r: (r["positive_edges"], options["seed"], *[r[f"communities/{i}"] for i in range(n_snapshots)]),
+            False)
+    if "social_positions" in stages:
+        tasks["social_positions"] = Task(
+            [f"social_positions/{index}" for index in range(n_snapshots)], lambda *scores: list(scores),
+            lambda r: [r[f"social_positions/{index}"] for index in range(n_snapshots)], False)
+    if "features" in stages:
+        tasks["features"] = Task(
+            [f"features/{index}" for index in range(n_snapshots)], lambda *features: list(features),
+            lambda r: [r[f"features/{index}"] for index in range(n_snapshots)], False)
+    if "meta_community_network" in stages:
+        tasks["meta_community_network"] = Task(
+            ["communities"] + [f"GED/{index}" for index in range(n_snapshots - 1)],
+            lambda communities, *window_events: _build_meta_community_network(communities, list(window_events)),
+            lambda r: (r["communities"], *[r[f"GED/{index}"] for index in range(n_snapshots - 1)]), False)
+    if "samples" in stages:
+        tasks["samples"] = Task(["meta_community_network", "features"],
+                                partial(generate_samples, data_dir=data_dir),
+                                lambda r: (r["meta_community_network"], r["features"]), True)
+    if "model" in stages:
+        tasks["model"] = Task(["samples"], partial(train_prediction_model, data_dir=data_dir),
+                              lambda r: (r["samples"]["train_X"], r["samples"]["train_Y"], options["model_name"]),
+                              True)
+    if "report" in stages:
+        tasks["report"] = Task(["snapshots", "meta_community_network"], evolution_event_distribution_report,
+                               lambda r: (r["snapshots"]["timestamps"], r["meta_community_network"]), True)
+    return tasks
+
+
+def _critical_path(tasks: dict, timings: dict, order: list) -> tuple:
+    """
+    longest chain of dependent tasks, weighted by their run time
+    :param order: task names in completion order
+    :return: (task names on the chain, seconds)
+    """
+    finish, previous = {}, {}
+    for name in order:
+        dependencies = [dependency for dependency in tasks[name].dependencies if dependency in finish]
+        before = max(dependencies, key=finish.get, default=None)
+        finish[name] = timings[name] + (finish[before] if before is not None else 0)
+        previous[name] = before
+    if not finish:
+        return [], 0
+    name = max(finish, key=finish.get)
+    path, seconds = [], finish[name]
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], seconds
+
+
+def run_pipeline(end_time: dt, window_size: int, edges: list, nodes: list, targets: list = None,
+                 data_dir: str = "data", processes: int = None, resume: bool = True, cache: str = CACHE_DIR,
+                 positive_edges: bool = True, seed: int = 0, tol: float = 1e-06, alpha: float = 0.5,
+                 beta: float = 0.5, method: str = "index", engine: str = "sweep", closeness_options: dict = None,
+                 model_name: str = "random_forest") -> dict:
+    """
+    run the stages of test.py as a task graph on a process pool: communities and social positions run side by side,
+    and the features of a snapshot or the GED of a window start as soon as their own snapshots are done.
+    Communities are detected like static_community_detection(mode="parallel") and social positions like
+    social_position_score(engine="networkx").
+    :param end_time: timestamp of the first snapshot
+    :param window_size: days between snapshots
+    :param edges: a list of edges
+    :param nodes: a list of nodes
+    :param targets: stages to produce (keys of STAGES), all by default. Their missing dependencies run too
+    :param data_dir: directory the stage artifacts (ARTIFACTS) of the run are written to
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param resume: load the stages found in the cache instead of running them. Stage results are cached under a key
+            of their inputs and parameters (see _stage_keys), so a stage is only reused with the same upstream data
+    :param cache: cache directory of the stage results
+    :param positive_edges: remove the edges of weight <= 0 (exit, conflict) from the snapshots before the community
+            detection, which fails on them (positive_edges stage)
+    :param seed: base random seed of the community detection, snapshot i uses seed + i
+    :param tol: PageRank error tolerance
+    :param alpha: GED alpha
+    :param beta: GED beta
+    :param method: GED method
+    :param engine: feature extraction engine, see FEATURE_ENGINES
+    :param closeness_options: options of community_features.closeness_centrality
+    :param model_name: a key of CLASSIFIERS
+    :return: a dict with the stage "results", task "timings" (seconds), the "critical_path" (task names), its length
+             "critical_path_seconds", the summed task time "total_seconds" and the "wall_seconds" of the run
+    """
+    start = time.perf_counter()
+    options = {"positive_edges": positive_edges, "seed": seed, "tol": tol, "alpha": alpha, "beta": beta,
+               "method": method, "engine": engine, "closeness_options": closeness_options, "model_name": model_name}
+    keys = _stage_keys(end_time, window_size, edges, nodes, options)
+    if not positive_edges:
+        # the stage passes the snapshots through, caching it would only copy them
+        cached_stages = [stage for stage in keys if stage != "positive_edges"]
+    else:
+        cached_stages = list(keys)
+    # walk the dependencies of the targets, stopping at stages found in the cache
+    results, stages, pending = {}, [], list(targets or STAGES)
+    while pending:
+        stage = pending.pop(0)
+        if stage in stages or stage in results:
+            continue
+        artifact = load_artifact(stage, keys[stage], cache) if resume and stage in cached_stages else None
+        if artifact is not None:
+            results[stage] = artifact
+        else:
+            stages.append(stage)
+            pending.extend(STAGES[stage])
+
+    loaded = [stage for stage in ["positive_edges", "snapshots"] if stage in results]
+    if loaded:
+        n_snapshots = len(results[loaded[0]]["snapshots"])
+    else:
+        n_snapshots = _snapshot_count(end_time, window_size)
+    tasks = _pipeline_tasks(stages, n_snapshots, end_time, window_size, edges, nodes, options, data_dir)
+    timings, order, running, waiting = {}, [], {}, dict(tasks)
+    with ProcessPoolExecutor(processes) as executor:
+        while waiting or running:
+            ready = [name for name, task in waiting.items() if all(d in results for d in task.dependencies)]
+            for name in ready:
+                task = waiting.pop(name)
+                if task.remote:
+                    running[executor.submit(_timed, task.function, task.arguments(results))] = name
+                else:
+                    results[name], timings[name] = _timed(task.function, task.arguments(results))
+                    order.append(name)
+            if any(not tasks[name].remote for name in ready):
+                continue
+            if not running:
+                raise RuntimeError(f"unresolvable pipeline tasks {list(waiting)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name] = future.result()
+                order.append(name)
+
+    for stage in stages:
+        if stage in cached_stages:
+            store_artifact(stage, keys[stage], results[stage], cache)
+    # data_dir holds the artifacts of this run, loaded ones included, so that it never mixes runs
+    for stage in STAGES:
+        if stage in ARTIFACTS and stage in results and not (stage in stages and stage in _SELF_WRITING):
+            os.makedirs(data_dir, exist_ok=True)
+            pickle.dump(results[stage], open(os.path.join(data_dir, ARTIFACTS[stage]), "wb"))
+    critical_path, critical_seconds = _critical_path(tasks, timings, order)
+    return {"results": {stage: results[stage] for stage in STAGES if stage in results}, "timings": timings,
+            "critical_path": critical_path, "critical_path_seconds": critical_seconds,
+            "total_seconds": sum(timings.values()), "wall_seconds": time.perf_counter() - start}
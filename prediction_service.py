@@ -0,0 +1,178 @@
+import json
+import pickle
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import networkx as nx
+import numpy as np
+
+from model_operations import EVENT_MAPPING, PREDICTOR_PATH, TREE_ARRAYS, _class_shap_values, build_sample_matrix, \
+    extract_ids
+
+EVENT_NAMES = {label: event for event, label in EVENT_MAPPING.items()}
+
+
+def _tree_predict(trees: dict, X: np.ndarray) -> np.ndarray:
+    """
+    evaluate every tree on every sample at once, one level per step
+    :return: class probabilities of shape (n, classes)
+    """
+    # sklearn compares the float32 features against float64 thresholds
+    X = np.asarray(X, dtype=np.float32).astype(np.float64)
+    n_trees, n = trees["children_left"].shape[0], X.shape[0]
+    tree_index = np.arange(n_trees)[:, None]
+    sample_index = np.arange(n)[None, :]
+    node = np.zeros((n_trees, n), dtype=np.int64)
+    while True:
+        left = trees["children_left"][tree_index, node]
+        internal = left >= 0
+        if not internal.any():
+            break
+        value = X[sample_index, np.maximum(trees["features"][tree_index, node], 0)]
+        child = np.where(value <= trees["thresholds"][tree_index, node], left,
+                         trees["children_right"][tree_index, node])
+        child = np.where(np.isnan(value), trees["children_default"][tree_index, node], child)
+        node = np.where(internal, child, node)
+    return trees["values"][tree_index, node].sum(axis=0) + trees["base_offset"]
+
+
+def _history_paths(meta_community_network: nx.DiGraph, targets: list, history: int) -> list:
+    """
+    chains of history communities in consecutive snapshots ending in each target community
+    """
+    paths = []
+    for target in targets:
+        stack = [[target]]
+        while stack:
+            path = stack.pop()
+            if len(path) == history:
+                paths.append(path[::-1])
+                continue
+            sid = extract_ids(path[-1])[0]
+            stack.extend(path + [node] for node in meta_community_network.predecessors(path[-1])
+                         if extract_ids(node)[0] == sid - 1)
+    return paths
+
+
+class PredictionService:
+    """
+    predicts the next-window evolution event of live communities. The model is loaded once from the arrays written by
+    model_operations.export_predictor; update() swaps in the meta community network and features after each window
+    update (e.g. from online.OnlineEcosystem).
+    """
+
+    def __init__(self, predictor: str = PREDICTOR_PATH, meta_community_network: nx.DiGraph = None, features=None,
+                 explainer: str = "data/explainer.pkl"):
+        """
+        :param predictor: file written by model_operations.export_predictor
+        :param meta_community_network: the current meta community network
+        :param features: the current features, nested lists or a FeatureTensor
+        :param explainer: pickled shap.TreeExplainer, only loaded when SHAP values are requested
+        """
+        stored = np.load(predictor)
+        self.trees = {name: stored[name] for name in TREE_ARRAYS}
+        self.classes = [EVENT_NAMES.get(int(label), str(label)) for label in stored["classes"].tolist()]
+        self.history, self.relative = int(stored["history"]), bool(stored["relative"])
+        self.explainer_path, self._explainer = explainer, None
+        # serve() answers requests in threads, the first SHAP requests must not load the explainer concurrently
+        self._explainer_lock = threading.Lock()
+        self.meta_community_network, self.features = None, None
+        if meta_community_network is not None:
+            self.update(meta_community_network, features)
+
+    def update(self, meta_community_network: nx.DiGraph, features):
+        self.meta_community_network, self.features = meta_community_network, features
+
+    def ready(self) -> bool:
+        """
+        :return: whether a meta community network and features were given, predict raises ValueError until then
+        """
+        return self.meta_community_network is not None and self.features is not None
+
+    def latest_communities(self) -> list:
+        """
+        :return: the communities of the newest snapshot of the meta community network, [] if it is empty
+        """
+        if not self.meta_community_network:
+            return []
+        latest = max(extract_ids(node)[0] for node in self.meta_community_network)
+        return [node for node in self.meta_community_network if extract_ids(node)[0] == latest]
+
+    def explainer(self):
+        """
+        :return: the SHAP explainer, loaded on first use
+        """
+        with self._explainer_lock:
+            if self._explainer is None:
+                with open(self.explainer_path, "rb") as f:
+                    self._explainer = pickle.load(f)
+            return self._explainer
+
+    def predict(self, communities: list = None, shap_values: bool = False) -> list:
+        """
+        predict the next event of communities from their feature history. A community with several ancestor chains
+        gets one prediction per chain, communities younger than the history get none.
+        :param communities: community nodes "T{sid}C{cid}", the newest snapshot by default
+        :param shap_values: also return the SHAP values of each prediction for its predicted class
+        :return: [{"community", "path", "event", "probabilities": {event: probability}, ("shap": [value...])}]
+        """
+        if not self.ready():
+            raise ValueError("no meta community network and features yet, call update() first")
+        if communities is None:
+            communities = self.latest_communities()
+        # also rejects malformed names, every node of the network is a valid "T{sid}C{cid}"
+        unknown = [community for community in communities if community not in self.meta_community_network]
+        if unknown:
+            raise KeyError(f"unknown communities {unknown}")
+        paths = _history_paths(self.meta_community_network, communities, self.history)
+        if not paths:
+            return []
+        ids = np.array([[extract_ids(node) for node in path] for path in paths], dtype=np.int64)
+        X = build_sample_matrix(ids[:, :, 0], ids[:, :, 1], self.features, self.relative)
+        probabilities = _tree_predict(self.trees, X)
+        predicted = probabilities.argmax(axis=1)
+        results = [{"community": path[-1], "path": path, "event": self.classes[label],
+                    "probabilities": dict(zip(self.classes, row.tolist()))}
+                   for path, label, row in zip(paths, predicted.tolist(), probabilities)]
+        if shap_values:
+            values = _class_shap_values(self.explainer().shap_values(X))
+            for index, (result, label) in enumerate(zip(results, predicted.tolist())):
+                result["shap"] = values[label, index].tolist()
+        return results
+
+
+def serve(service: PredictionService, host: str = "127.0.0.1", port: int = 8000):
+    """
+    local HTTP front end: GET /predict returns the predictions of the newest snapshot as JSON,
+    /predict?community=T40C1&community=T40C2 those of given communities and shap=1 adds SHAP values. Until the service
+    has a meta community network and features, requests get 503
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/predict":
+                self.send_error(404)
+                return
+            if not service.ready():
+                self.send_error(503, "no meta community network and features yet")
+                return
+            query = parse_qs(url.query)
+            try:
+                body = service.predict(query.get("community"), query.get("shap", ["0"])[0] == "1")
+            except (KeyError, nx.NetworkXError) as error:
+                self.send_error(400, str(error))
+                return
+            data = json.dumps(body, ensure_ascii=False).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"serving predictions on http://{host}:{port}/predict")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
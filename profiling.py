@@ -0,0 +1,153 @@
+import functools
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+
+# profiling is off by default, the decorated functions then only pay one flag check
+_ENABLED = False
+_TRACE_MEMORY = False
+# one frame per active profiled call or section: [name, wall start, cpu start, memory at start, peak memory]
+_STACK = []
+# call stack (tuple of names) -> [calls, wall time, cpu time, peak memory, wall time of children]
+_RECORDS = defaultdict(lambda: [0, 0.0, 0.0, 0, 0.0])
+
+
+def enable(memory: bool = False):
+    """
+    start recording the profiled functions and sections
+    :param memory: also record peak memory with tracemalloc, which slows Python code down considerably
+    """
+    global _ENABLED, _TRACE_MEMORY
+    _ENABLED, _TRACE_MEMORY = True, memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _ENABLED, _TRACE_MEMORY
+    if _TRACE_MEMORY and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _ENABLED, _TRACE_MEMORY = False, False
+
+
+def reset():
+    """
+    drop everything recorded so far
+    """
+    _RECORDS.clear()
+
+
+def is_enabled() -> bool:
+    return _ENABLED
+
+
+def _push(name: str):
+    if _TRACE_MEMORY:
+        current, peak = tracemalloc.get_traced_memory()
+        if _STACK:
+            _STACK[-1][4] = max(_STACK[-1][4], peak)
+        tracemalloc.reset_peak()
+    else:
+        current = 0
+    _STACK.append([name, time.perf_counter(), time.process_time(), current, current])
+
+
+def _pop():
+    name, wall, cpu, memory, peak = _STACK[-1]
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    if _TRACE_MEMORY:
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    record = _RECORDS[tuple(frame[0] for frame in _STACK)]
+    _STACK.pop()
+    record[0] += 1
+    record[1] += wall
+    record[2] += cpu
+    record[3] = max(record[3], peak - memory)
+    if _STACK:
+        _RECORDS[tuple(frame[0] for frame in _STACK)][4] += wall
+        _STACK[-1][4] = max(_STACK[-1][4], peak)
+
+
+def profiled(func=None, name: str = None):
+    """
+    decorator recording wall time, CPU time, calls and peak memory of a function while profiling is enabled.
+    Use as @profiled or @profiled(name="stage name").
+    """
+    if func is None:
+        return functools.partial(profiled, name=name)
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _ENABLED:
+            return func(*args, **kwargs)
+        _push(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _pop()
+    return wrapper
+
+
+class section:
+    """
+    context manager recording a block like a profiled call, e.g. with section(f"snapshot {index}"): ...
+    The calls inside the block are nested under it, which breaks the stage timings down per snapshot.
+    """
+
+    def __init__(self, name: str):
+        self.name, self.active = name, False
+
+    def __enter__(self):
+        self.active = _ENABLED
+        if self.active:
+            _push(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.active:
+            _pop()
+        return False
+
+
+def profile_report() -> dict:
+    """
+    :return: {"stacks": [{"stack": [name...], "calls", "wall", "cpu", "self_wall", "peak_memory"}...],
+             "functions": {name: {"calls", "wall", "cpu", "self_wall", "peak_memory"}}}. Times are in seconds and
+             memory in bytes. "functions" sums every stack ending with the name, except nested calls of the same name
+             which would be counted twice
+    """
+    stacks, functions = [], defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0, "self_wall": 0.0,
+                                                 "peak_memory": 0})
+    for stack, (calls, wall, cpu, peak, children) in sorted(_RECORDS.items()):
+        entry = {"calls": calls, "wall": wall, "cpu": cpu, "self_wall": wall - children, "peak_memory": peak}
+        stacks.append({"stack": list(stack), **entry})
+        function = functions[stack[-1]]
+        function["self_wall"] += entry["self_wall"]
+        function["peak_memory"] = max(function["peak_memory"], peak)
+        if stack[-1] not in stack[:-1]:
+            function["calls"] += calls
+            function["wall"] += wall
+            function["cpu"] += cpu
+    return {"stacks": stacks, "functions": dict(functions)}
+
+
+def export_json(path: str) -> dict:
+    """
+    write profile_report to a JSON file
+    """
+    report = profile_report()
+    json.dump(report, open(path, "w", encoding="utf8"), indent=2, ensure_ascii=False)
+    return report
+
+
+def export_folded(path: str):
+    """
+    write the self wall time of every call stack in microseconds, in the folded format ("a;b;c 1234") read by
+    flamegraph.pl, speedscope and similar tools
+    """
+    with open(path, "w", encoding="utf8") as f:
+        for stack, (_, wall, _, _, children) in sorted(_RECORDS.items()):
+            f.write(f"{';'.join(stack)} {max(0, round((wall - children) * 1e6))}\n")
@@ -1,3 +1,4 @@
+import os
 from collections import Counter
 
 import numpy as np
@@ -41,29 +42,29 @@ def summary_report(shape_values, feature_names, class_names, merge=False):
         fig.write_html("figure/summary_without_merge.html")
 
 
-def dependency_report(feature_name, class_name, shap_values, data, feature_names, class_names, relative=True):
-    feature_index, class_index = feature_names.index(feature_name), class_names.index(class_name)
-    shap_value = shap_values[class_index]
-    shap_value = [sum([value[feature_index], value[feature_index + len(feature_names)],
-                    value[feature_index + 2 * len(feature_names)]]) for value in shap_value]
-    initial_value = [d[feature_index] for d in data]
-    second_value = [d[feature_index + len(feature_names)] - d[feature_index] for d in data]
-    third_value = [d[feature_index + 2 * len(feature_names)] - d[feature_index + len(feature_names)] for d in data]
-    symbols = ["star-triangle-up" if d[feature_index + 2*len(feature_names)] - d[feature_index + len(feature_names)] > 0 else "star-triangle-down" for d in data]
+def _dependency_figure(feature_name, shap_value, initial_value, second_value, third_value):
+    """
+    scatter of the summed shap value of a feature against its value in the first step of the history
+    :param shap_value: shap value of each sample, summed over the history steps
+    :param initial_value: feature value in the first step
+    :param second_value: change from the first to the second step, used as color
+    :param third_value: change over the last two steps, used as marker size and direction
+    """
+    symbols = np.where(third_value > 0, "star-triangle-up", "star-triangle-down")
     fig = go.Figure(data=[go.Scatter(
         x = initial_value,
         y = shap_value,
         marker_symbol=symbols,
         mode='markers',
         marker= dict(
-            size=[abs(v) for v in third_value],
+            size=np.abs(third_value),
             color=second_value,
             colorscale='Viridis',
             colorbar=dict(
                 title=f"2-{feature_name} - 1-{feature_name}",
             ),
             sizemode='area',
-            sizeref=2. * max(second_value) / (20. ** 2),
+            sizeref=2. * np.max(second_value) / (20. ** 2),
             sizemin=4,
             showscale=True
         )
@@ -81,9 +82,86 @@ def dependency_report(feature_name, class_name, shap_values, data, feature_names
         ),
 
     )
+    return fig
+
+
+def _history_sum(shap_value, history, n_features, chunk_size=4096) -> tuple:
+    """
+    shap values of one class summed over the history steps. They are read in chunks of samples, so a memory-mapped
+    array (compute_shap_values) is never loaded at once.
+    :param shap_value: shap values of one class, shape (n, history * n_features)
+    :return: (summed values (n, n_features), absolute values summed over the samples (history * n_features,))
+    """
+    n = len(shap_value)
+    summed, absolute = np.empty((n, n_features)), np.zeros(history * n_features)
+    for start in range(0, n, chunk_size):
+        chunk = np.asarray(shap_value[start:start + chunk_size], dtype=np.float64)
+        summed[start:start + len(chunk)] = chunk.reshape(len(chunk), history, n_features).sum(axis=1)
+        absolute += np.abs(chunk).sum(axis=0)
+    return summed, absolute
+
+
+def dependency_report(feature_name, class_name, shap_values, data, feature_names, class_names, relative=True):
+    feature_index, class_index = feature_names.index(feature_name), class_names.index(class_name)
+    shap_sum, _ = _history_sum(shap_values[class_index], 3, len(feature_names))
+    values = np.asarray(data, dtype=np.float64).reshape(-1, 3, len(feature_names))[:, :, feature_index]
+    fig = _dependency_figure(feature_name, shap_sum[:, feature_index], values[:, 0], values[:, 1] - values[:, 0],
+                             values[:, 2] - values[:, 1])
     fig.write_html(f"figure/dependency_{feature_name}_{class_name}.html")
 
 
+def batch_report(shap_values, data, feature_names, class_names, path="figure/report", history=3):
+    """
+    write the summary reports and the dependency report of every feature and class into one directory.
+    All pages share a single plotly.min.js next to them instead of embedding it, and index.html links them.
+    :param shap_values: shap values of each class, a list of (n, history * n_features) arrays or an array of shape
+                        (classes, n, history * n_features) such as the output of compute_shap_values
+    :param data: samples the shap values were computed on
+    :param feature_names: feature names of one history step
+    :param class_names: class names, in the order of shap_values
+    :param path: output directory
+    :param history: number of history steps in a sample
+    :return: path of the index page
+    """
+    os.makedirs(path, exist_ok=True)
+    n_features = len(feature_names)
+    data = np.asarray(data, dtype=np.float64).reshape(-1, history, n_features)
+    # every feature/class combination from the same three arrays. The changes of the first and of the last two steps
+    # are 0 with a single step
+    initial_value = data[:, 0]
+    second_value = data[:, 1] - data[:, 0] if history > 1 else np.zeros_like(initial_value)
+    third_value = data[:, -1] - data[:, -2] if history > 1 else np.zeros_like(initial_value)
+
+    # each class is summed over the history once, for its dependency pages and for the summaries
+    merged, without_merge, dependency_pages = [], [], []
+    for shap_value, class_name in zip(shap_values, class_names):
+        shap_sum, absolute = _history_sum(shap_value, history, n_features)
+        merged.append(np.abs(shap_sum).sum(axis=0))
+        without_merge.append(absolute)
+        for feature_index, feature_name in enumerate(feature_names):
+            fig = _dependency_figure(feature_name, shap_sum[:, feature_index],
+                                     initial_value[:, feature_index], second_value[:, feature_index],
+                                     third_value[:, feature_index])
+            file_name = f"dependency_{feature_name}_{class_name}.html"
+            fig.write_html(os.path.join(path, file_name), include_plotlyjs="directory")
+            dependency_pages.append(file_name)
+    step_names = [f"{step + 1}-{feature_name}" for step in range(history) for feature_name in feature_names]
+    pages = []
+    for file_name, importances, x in [("summary_merge.html", merged, feature_names),
+                                      ("summary_without_merge.html", without_merge, step_names)]:
+        fig = go.Figure(data=go.Heatmap(z=importances, x=x, y=class_names))
+        fig.write_html(os.path.join(path, file_name), include_plotlyjs="directory")
+        pages.append(file_name)
+    pages += dependency_pages
+
+    index = os.path.join(path, "index.html")
+    with open(index, "w", encoding="utf8") as f:
+        f.write("<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>report</title></head>\n<body>\n<ul>\n")
+        f.writelines(f'<li><a href="{page}">{page[:-len(".html")]}</a></li>\n' for page in pages)
+        f.write("</ul>\n</body>\n</html>\n")
+    return index
+
+
 def evolution_event_distribution_report(timestamps, meta_community_network):
     bar_data = {}
     for node in meta_community_network.nodes():
@@ -0,0 +1,151 @@
+import json
+import os
+import subprocess
+import tempfile
+from datetime import datetime as dt
+
+import profiling
+from community_operations import feature_extraction, meta_community_network_generation, social_position_score, \
+    static_community_detection
+from generate_snapshots import generate_snapshots, positive_snapshots
+from model_operations import generate_samples, train_prediction_model
+from synthetic import generate_ecosystem
+
+BENCHMARK_STAGES = ["snapshots", "communities", "social_positions", "meta_community_network", "features", "samples",
+                    "model"]
+DEFAULT_SCALES = [1, 10, 100]
+BENCHMARK_DIR = "data/benchmarks"
+
+
+def _run_stages(nodes: list, edges: list, stages: list, end_time: dt, window_size: int, options: dict):
+    results = {}
+    for stage in stages:
+        with profiling.section(stage):
+            if stage == "snapshots":
+                results[stage] = generate_snapshots(end_time, window_size, edges, nodes)
+            elif stage == "communities":
+                results[stage] = static_community_detection(results["snapshots"], mode=options["community_mode"])
+            elif stage == "social_positions":
+                results[stage] = social_position_score(results["snapshots"], engine=options["pagerank_engine"])
+            elif stage == "meta_community_network":
+                results[stage] = meta_community_network_generation(results["communities"],
+                                                                   results["social_positions"], 0.5, 0.5)
+            elif stage == "features":
+                results[stage] = feature_extraction(results["snapshots"], results["communities"],
+                                                    results["social_positions"], engine=options["feature_engine"])
+            elif stage == "samples":
+                results[stage] = generate_samples(results["meta_community_network"], results["features"])
+            elif stage == "model":
+                results[stage] = train_prediction_model(results["samples"]["train_X"], results["samples"]["train_Y"])
+        if stage == "snapshots" and options["positive_edges"]:
+            # timed on its own, the snapshots stage measures generate_snapshots only
+            with profiling.section("positive_edges"):
+                results[stage], results["removed_edges"] = positive_snapshots(results[stage])
+    return results
+
+
+def benchmark_scale(scale: float, seed: int = 0, stages: list = None, memory: bool = True, window_size: int = 30,
+                    end_time: dt = dt(2016, 8, 1), community_mode: str = "serial", pagerank_engine: str = "networkx",
+                    feature_engine: str = "sweep", positive_edges: bool = True, top: int = 20) -> dict:
+    """
+    run the stages on a synthetic ecosystem of one size. The stages write their usual data/*.pkl files into a temporary
+    directory, the bundled results are left alone.
+    :param scale: ecosystem size relative to the bundled data, see synthetic.generate_ecosystem
+    :param seed: random seed of the ecosystem
+    :param stages: stages to run in order, a prefix of BENCHMARK_STAGES by default all of them
+    :param memory: record peak memory with tracemalloc (slower)
+    :param window_size: days between snapshots
+    :param end_time: timestamp of the first snapshot
+    :param community_mode: mode of static_community_detection
+    :param pagerank_engine: engine of social_position_score
+    :param feature_engine: engine of feature_extraction
+    :param positive_edges: remove the edges of weight <= 0 (exit, conflict) from the generated snapshots before the
+            later stages, which fail on them. The cleaning is timed as its own "positive_edges" stage and the number
+            of removed edges is reported; with False the stages run on the unmodified generate_snapshots output
+    :param top: number of functions kept in "functions", ordered by self time
+    :return: {"scale", "seed", "nodes", "edges", "positive_edges", "variant", "removed_edges",
+             "stages": {stage: {"wall", "cpu", "peak_memory"}}, "functions": {name: profile entry}}, see
+             profiling.profile_report. "variant" names the measured snapshots, "positive_edges" (edges of weight <= 0
+             removed) or "raw"
+    """
+    stages = stages or BENCHMARK_STAGES
+    nodes, edges = generate_ecosystem(scale, seed)
+    options = {"community_mode": community_mode, "pagerank_engine": pagerank_engine, "feature_engine": feature_engine,
+               "positive_edges": positive_edges}
+    cwd = os.getcwd()
+    profiling.reset()
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "data"))
+        os.chdir(directory)
+        profiling.enable(memory)
+        try:
+            results = _run_stages(nodes, edges, stages, end_time, window_size, options)
+        finally:
+            profiling.disable()
+            os.chdir(cwd)
+    report = profiling.profile_report()
+    stage_rows = {entry["stack"][0]: {"wall": entry["wall"], "cpu": entry["cpu"], "peak_memory": entry["peak_memory"]}
+                  for entry in report["stacks"] if len(entry["stack"]) == 1}
+    functions = dict(sorted(report["functions"].items(), key=lambda x: x[1]["self_wall"], reverse=True)[:top])
+    timed = [name for stage in stages for name in ([stage, "positive_edges"] if stage == "snapshots" else [stage])]
+    return {"scale": scale, "seed": seed, "nodes": len(nodes), "edges": len(edges), "positive_edges": positive_edges,
+            "variant": "positive_edges" if positive_edges else "raw", "removed_edges": results.get("removed_edges", 0),
+            "stages": {stage: stage_rows[stage] for stage in timed if stage in stage_rows}, "functions": functions}
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unversioned"
+
+
+def run_scaling_benchmark(scales: list = None, label: str = None, path: str = BENCHMARK_DIR,
+                          max_seconds: float = None, **options) -> dict:
+    """
+    benchmark the stages over a ladder of ecosystem sizes and store the results as path/{label}.json, so that runs of
+    different versions can be compared with compare_benchmarks
+    :param scales: ecosystem sizes relative to the bundled data, DEFAULT_SCALES by default
+    :param label: name of the run, the current git commit by default
+    :param path: results directory
+    :param max_seconds: stop climbing the ladder once a stage takes longer than this
+    :param options: options of benchmark_scale
+    :return: {"label", "created", "variant", "runs": [benchmark_scale result...]}, variant as in benchmark_scale
+    """
+    label = label or _version()
+    variant = "positive_edges" if options.get("positive_edges", True) else "raw"
+    results = {"label": label, "created": dt.now().isoformat(timespec="seconds"), "variant": variant, "runs": []}
+    for scale in scales or DEFAULT_SCALES:
+        run = benchmark_scale(scale, **options)
+        results["runs"].append(run)
+        print(f"scale {scale} ({variant} snapshots): "
+              + ", ".join(f"{stage} {row['wall']:.2f}s" for stage, row in run["stages"].items())
+              + (f" ({run['removed_edges']} edges of weight <= 0 removed)" if run["positive_edges"] else ""))
+        if max_seconds is not None and any(row["wall"] > max_seconds for row in run["stages"].values()):
+            break
+    os.makedirs(path, exist_ok=True)
+    json.dump(results, open(os.path.join(path, f"{label}.json"), "w", encoding="utf8"), indent=2, ensure_ascii=False)
+    return results
+
+
+def compare_benchmarks(baseline: str, candidate: str) -> list:
+    """
+    compare two stored benchmark runs stage by stage, scales run with different positive_edges settings are skipped
+    :param baseline: JSON file written by run_scaling_benchmark
+    :param candidate: another one
+    :return: [{"scale", "stage", "baseline", "candidate", "ratio"}...] of wall times, ratio > 1 means slower
+    """
+    baseline, candidate = json.load(open(baseline, encoding="utf8")), json.load(open(candidate, encoding="utf8"))
+    candidate_runs = {run["scale"]: run for run in candidate["runs"]}
+    rows = []
+    for run in baseline["runs"]:
+        if run["scale"] not in candidate_runs or \
+                run.get("positive_edges", True) != candidate_runs[run["scale"]].get("positive_edges", True):
+            continue
+        for stage, row in run["stages"].items():
+            if stage in candidate_runs[run["scale"]]["stages"]:
+                new = candidate_runs[run["scale"]]["stages"][stage]["wall"]
+                rows.append({"scale": run["scale"], "stage": stage, "baseline": row["wall"], "candidate": new,
+                             "ratio": new / row["wall"] if row["wall"] else float("inf")})
+    return rows
@@ -0,0 +1,238 @@
+import hashlib
+import heapq
+import json
+import os
+import shutil
+from collections.abc import Sequence
+
+import networkx as nx
+import numpy as np
+
+
+def _insertion_order(snapshot: nx.Graph) -> list:
+    """
+    find an edge order which, replayed with add_edge, rebuilds the adjacency order of every node.
+    Such an order exists for graphs that were only grown (like the generated snapshots); otherwise the
+    remaining edges are appended in snapshot.edges() order.
+    :param snapshot: a networkx graph
+    :return: a list of (u, v, weight)
+    """
+    rank = {node: index for index, node in enumerate(snapshot)}
+    key = lambda u, v: (u, v) if rank[u] <= rank[v] else (v, u)
+    successors, in_degree = {}, {}
+    for u, neighbours in snapshot.adjacency():
+        previous = None
+        for v in neighbours:
+            edge = key(u, v)
+            in_degree.setdefault(edge, 0)
+            if previous is not None:
+                successors.setdefault(previous, []).append(edge)
+                in_degree[edge] += 1
+            previous = edge
+    position = {key(u, v): index for index, (u, v) in enumerate(snapshot.edges())}
+    ready = [(position[edge], edge) for edge, degree in in_degree.items() if degree == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, edge = heapq.heappop(ready)
+        order.append(edge)
+        for successor in successors.get(edge, []):
+            in_degree[successor] -= 1
+            if in_degree[successor] == 0:
+                heapq.heappush(ready, (position[successor], successor))
+    if len(order) < len(position):
+        seen = set(order)
+        order.extend(edge for edge in sorted(position, key=position.get) if edge not in seen)
+    return [(u, v, snapshot[u][v].get("weight", 1)) for u, v in order]
+
+
+def _raw_to_npy(raw_path: str, npy_path: str, dtype, shape: tuple):
+    """
+    turn a file of raw array bytes into a .npy file by prepending the header, without loading it
+    """
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": shape}
+    with open(npy_path, "wb") as npy_file, open(raw_path, "rb") as raw_file:
+        np.lib.format.write_array_header_1_0(npy_file, header)
+        shutil.copyfileobj(raw_file, npy_file)
+    os.remove(raw_path)
+
+
+class SnapshotStoreWriter:
+    """
+    write a snapshot store one snapshot at a time. The arrays are appended to disk as the snapshots arrive, only the
+    node dictionary and the offsets stay in memory; close() writes the .npy headers and finally meta.json, so a store
+    with a meta.json is complete. meta.json also holds a digest of the content, see SnapshotStore. Used as a context
+    manager, an exception aborts the store instead.
+    """
+
+    def __init__(self, path: str, parameters: dict = None):
+        """
+        :param path: store directory
+        :param parameters: JSON-serializable description of how the snapshots were made, stored in meta.json
+        """
+        self.path, self.parameters = path, parameters
+        os.makedirs(path, exist_ok=True)
+        # an existing store is incomplete from now on
+        if os.path.exists(os.path.join(path, "meta.json")):
+            os.remove(os.path.join(path, "meta.json"))
+        self.node_index, self.type_names, self.node_types, self.timestamps = {}, [], [], []
+        self.node_offsets, self.edge_offsets = [0], [0]
+        self.files = {name: open(os.path.join(path, f"{name}.raw"), "wb")
+                      for name in ["snapshot_nodes", "edges", "weights"]}
+        self.content = hashlib.sha256()
+
+    def append(self, snapshot: nx.Graph, timestamp: str):
+        snapshot_nodes = []
+        for node, node_type in snapshot.nodes(data="type"):
+            if node not in self.node_index:
+                self.node_index[node] = len(self.node_index)
+                if node_type not in self.type_names:
+                    self.type_names.append(node_type)
+                self.node_types.append(self.type_names.index(node_type))
+            snapshot_nodes.append(self.node_index[node])
+        edges, weights = [], []
+        for u, v, w in _insertion_order(snapshot):
+            edges.append((self.node_index[u], self.node_index[v]))
+            weights.append(w)
+        for name, values in [("snapshot_nodes", np.array(snapshot_nodes, dtype=np.int32)),
+                             ("edges", np.array(edges, dtype=np.int32)),
+                             ("weights", np.array(weights, dtype=np.float64))]:
+            self.files[name].write(values.tobytes())
+            self.content.update(values.tobytes())
+        self.node_offsets.append(self.node_offsets[-1] + len(snapshot_nodes))
+        self.edge_offsets.append(self.edge_offsets[-1] + len(edges))
+        self.timestamps.append(timestamp)
+
+    def close(self):
+        for raw_file in self.files.values():
+            raw_file.close()
+        path, n_nodes, n_edges = self.path, self.node_offsets[-1], self.edge_offsets[-1]
+        type_dtype = np.int8 if len(self.type_names) <= np.iinfo(np.int8).max else np.int32
+        np.save(os.path.join(path, "node_types.npy"), np.array(self.node_types, dtype=type_dtype))
+        _raw_to_npy(os.path.join(path, "snapshot_nodes.raw"), os.path.join(path, "snapshot_nodes.npy"), np.int32,
+                    (n_nodes,))
+        np.save(os.path.join(path, "node_offsets.npy"), np.array(self.node_offsets, dtype=np.int64))
+        _raw_to_npy(os.path.join(path, "edges.raw"), os.path.join(path, "edges.npy"), np.int32, (n_edges, 2))
+        _raw_to_npy(os.path.join(path, "weights.raw"), os.path.join(path, "weights.npy"), np.float64, (n_edges,))
+        np.save(os.path.join(path, "edge_offsets.npy"), np.array(self.edge_offsets, dtype=np.int64))
+        meta = {"nodes": list(self.node_index), "types": self.type_names, "timestamps": self.timestamps,
+                "parameters": self.parameters}
+        self.content.update(json.dumps(meta, ensure_ascii=False).encode("utf8"))
+        self.content.update(np.array(self.node_types, dtype=np.int32).tobytes())
+        json.dump({**meta, "digest": self.content.hexdigest()},
+                  open(os.path.join(path, "meta.json"), "w", encoding="utf8"), ensure_ascii=False)
+
+    def abort(self):
+        """
+        close the files and remove the partial arrays, no meta.json is written
+        """
+        for raw_file in self.files.values():
+            raw_file.close()
+            if os.path.exists(raw_file.name):
+                os.remove(raw_file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_snapshot_store(snapshots, path: str, parameters: dict = None):
+    """
+    write snapshots to a directory of flat arrays: one node dictionary with per-node type codes, and for every
+    snapshot its node list and an edge array (node indices and float weights).
+    :param snapshots: generated snapshots {"snapshots": [...], "timestamps": [...]}
+    :param path: store directory
+    :param parameters: description of how the snapshots were made, read back by store_parameters
+    """
+    with SnapshotStoreWriter(path, parameters) as writer:
+        for snapshot, timestamp in zip(snapshots["snapshots"], snapshots["timestamps"]):
+            writer.append(snapshot, timestamp)
+
+
+class SnapshotStore(Sequence):
+    """
+    read-only, memory-mapped view of a snapshot store written by save_snapshot_store.
+    store[i] builds the networkx graph of snapshot i from its slice of the arrays only, store[i:j] returns a list
+    and iterating yields the snapshots one by one.
+    A store pickles as its path and content digest, so its fingerprint (artifact_cache) changes when the store is
+    rebuilt, and unpickling a store that was rebuilt since raises ValueError.
+    """
+
+    def __init__(self, path: str, digest: str = None):
+        """
+        :param path: store directory
+        :param digest: expected content digest, ValueError if the store has another one
+        """
+        self.path = path
+        meta_path = os.path.join(path, "meta.json")
+        meta = json.load(open(meta_path, encoding="utf8"))
+        self.nodes, self.types, self.timestamps = meta["nodes"], meta["types"], meta["timestamps"]
+        # stores written without a digest are identified by their meta.json
+        self.digest = meta.get("digest") or hashlib.sha256(open(meta_path, "rb").read()).hexdigest()
+        if digest is not None and digest != self.digest:
+            raise ValueError(f"snapshot store {path} was rebuilt since it was saved")
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.node_types, self.snapshot_nodes, self.node_offsets = load("node_types"), load("snapshot_nodes"), \
+            load("node_offsets")
+        self.edges, self.weights, self.edge_offsets = load("edges"), load("weights"), load("edge_offsets")
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __reduce__(self):
+        # pickled by path and digest, e.g. as data/snapshots.pkl, instead of copying the memory-mapped arrays
+        return SnapshotStore, (self.path, self.digest)
+
+    def edge_arrays(self, index: int) -> tuple:
+        """
+        :param index: snapshot index
+        :return: (edges, weights) of the snapshot, edges is a (E, 2) array of node indices
+        """
+        start, end = self.edge_offsets[index], self.edge_offsets[index + 1]
+        return self.edges[start:end], self.weights[start:end]
+
+    def _snapshot(self, index: int) -> nx.Graph:
+        snapshot = nx.Graph()
+        nodes = self.snapshot_nodes[self.node_offsets[index]:self.node_offsets[index + 1]]
+        snapshot.add_nodes_from((self.nodes[node], {"type": self.types[self.node_types[node]]})
+                                for node in nodes.tolist())
+        edges, weights = self.edge_arrays(index)
+        snapshot.add_weighted_edges_from((self.nodes[u], self.nodes[v], w)
+                                         for (u, v), w in zip(edges.tolist(), weights.tolist()))
+        return snapshot
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._snapshot(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"snapshot index {index} out of range")
+        return self._snapshot(index)
+
+
+def store_parameters(path: str):
+    """
+    :param path: store directory
+    :return: the parameters recorded by the writer, None if there is no complete store or none were recorded
+    """
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    return json.load(open(meta_path, encoding="utf8")).get("parameters")
+
+
+def open_snapshot_store(path: str) -> dict:
+    """
+    open a snapshot store lazily
+    :param path: store directory
+    :return: a dict {"snapshots": SnapshotStore, "timestamps": [end_time...]}, usable wherever generated
+             snapshots are expected
+    """
+    store = SnapshotStore(path)
+    return {"snapshots": store, "timestamps": store.timestamps}
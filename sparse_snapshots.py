@@ -0,0 +1,118 @@
+from datetime import datetime as dt
+from datetime import timedelta
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from generate_snapshots import HISTORY_END, _prepare_columnar_log, _prepare_edge_log, linear_decay_batch
+
+
+def _snapshot_adjacency(sources, targets, weights, n_nodes) -> sparse.csr_matrix:
+    """
+    build the symmetric weighted adjacency of one snapshot
+    :param sources: source index of each edge (source <= target)
+    :param targets: target index of each edge
+    :param weights: weight of each edge
+    :param n_nodes: size of the shared node index
+    :return: a csr matrix, self loops are stored once on the diagonal
+    """
+    loops = sources == targets
+    rows = np.concatenate([sources, targets[~loops]])
+    cols = np.concatenate([targets, sources[~loops]])
+    data = np.concatenate([weights, weights[~loops]])
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n_nodes, n_nodes))
+
+
+def generate_sparse_snapshots(end_time: dt, window_size: int, edges: list, nodes: list, ignore_event=True,
+                              edge_log=None) -> dict:
+    """
+    generate the snapshots as CSR weighted adjacency matrices over one shared node index.
+    Edge weights come from linear_decay_batch and follow the same rules as _generate_snapshot: edges of the same node
+    pair are summed and a negative ("exit", "conflict") edge removes everything before it.
+    :param end_time: timestamp of the first snapshot
+    :param window_size: days between snapshots
+    :param edges: a list of edges
+    :param nodes: a list of nodes
+    :param ignore_event: True if don't care about events
+    :param edge_log: an edge log loaded by ingest.load_edge_log, used instead of edges and nodes if provided
+    :return: a dict {"nodes": [id...], "types": [type...], "snapshots": [csr_matrix...], "timestamps": [end_time...]}
+    """
+    if edge_log is not None:
+        node_ids, node_types, log = _prepare_columnar_log(edge_log, ignore_event)
+    else:
+        node_ids, node_types, log = _prepare_edge_log(nodes, edges, ignore_event)
+    days = np.array([edge[0] for edge in log], dtype=np.int64)
+    sources = np.array([min(edge[1], edge[2]) for edge in log], dtype=np.int64)
+    targets = np.array([max(edge[1], edge[2]) for edge in log], dtype=np.int64)
+    relations = np.array([edge[3] for edge in log], dtype=str)
+    # one id per node pair, so that parallel edges can be folded together
+    pair_keys, pair_ids = np.unique(sources * len(node_ids) + targets, return_inverse=True)
+    pair_sources, pair_targets = pair_keys // len(node_ids), pair_keys % len(node_ids)
+    positions = np.arange(len(log))
+
+    snapshots, timestamps = [], []
+    while end_time < dt.strptime(HISTORY_END, "%Y-%m-%d"):
+        end = end_time.toordinal()
+        count = int(np.searchsorted(days, end, side="right"))
+        weights = linear_decay_batch(relations[:count], end - days[:count])
+        ids = pair_ids[:count]
+
+        last_negative = np.full(len(pair_keys), -1, dtype=np.int64)
+        negative = weights < 0
+        np.maximum.at(last_negative, ids[negative], positions[:count][negative])
+        retained = positions[:count] >= last_negative[ids]
+        pair_weights = np.bincount(ids[retained], weights[retained], minlength=len(pair_keys))
+        present = np.bincount(ids, weights != 0, minlength=len(pair_keys)) > 0
+
+        snapshots.append(_snapshot_adjacency(pair_sources[present], pair_targets[present], pair_weights[present],
+                                             len(node_ids)))
+        timestamps.append(end_time.strftime("%Y-%m-%d"))
+        end_time += timedelta(days=window_size)
+    types = [node_types[node] for node in node_ids]
+    return {"nodes": node_ids, "types": types, "snapshots": snapshots, "timestamps": timestamps}
+
+
+def graphs_to_sparse(snapshots) -> dict:
+    """
+    convert networkx snapshots (the output of generate_snapshots) to the sparse representation
+    :param snapshots: generated snapshots
+    :return: a dict {"nodes": [id...], "types": [type...], "snapshots": [csr_matrix...], "timestamps": [end_time...]}
+    """
+    node_index, types = {}, []
+    for snapshot in snapshots["snapshots"]:
+        for node, node_type in snapshot.nodes(data="type"):
+            if node not in node_index:
+                node_index[node] = len(node_index)
+                types.append(node_type)
+    matrices = []
+    for snapshot in snapshots["snapshots"]:
+        sources, targets, weights = [], [], []
+        for u, v, w in snapshot.edges(data="weight"):
+            u, v = node_index[u], node_index[v]
+            sources.append(min(u, v))
+            targets.append(max(u, v))
+            weights.append(w)
+        matrices.append(_snapshot_adjacency(np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64),
+                                            np.array(weights, dtype=np.float64), len(node_index)))
+    return {"nodes": list(node_index), "types": types, "snapshots": matrices,
+            "timestamps": list(snapshots["timestamps"])}
+
+
+def sparse_to_graph(sparse_snapshots: dict, index: int) -> nx.Graph:
+    """
+    convert one sparse snapshot back to a networkx graph for the code that still needs it.
+    Nodes and edges follow the node index order, weights are floats.
+    :param sparse_snapshots: the output of generate_sparse_snapshots or graphs_to_sparse
+    :param index: snapshot index
+    :return: a networkx graph object to present the snapshot
+    """
+    node_ids, types = sparse_snapshots["nodes"], sparse_snapshots["types"]
+    upper = sparse.triu(sparse_snapshots["snapshots"][index], format="coo")
+    snapshot = nx.Graph()
+    for node in np.unique(np.concatenate([upper.row, upper.col])):
+        snapshot.add_node(node_ids[node], type=types[node])
+    snapshot.add_weighted_edges_from(
+        (node_ids[u], node_ids[v], w) for u, v, w in zip(upper.row.tolist(), upper.col.tolist(), upper.data.tolist())
+    )
+    return snapshot
@@ -0,0 +1,202 @@
+import json
+import os
+import pickle
+from collections.abc import Sequence
+from datetime import datetime as dt
+
+import networkx as nx
+import numpy as np
+
+from artifact_cache import fingerprint
+from community_operations import FEATURE_ENGINES, FEATURE_NAMES, GED, _louvain_partition, \
+    _node_clustering, _warm_start
+from feature_tensor import FeatureTensor
+from generate_snapshots import HISTORY_END, iter_snapshots
+from profiling import profiled, section
+from snapshot_store import SnapshotStoreWriter, _raw_to_npy, open_snapshot_store
+
+STREAM_DIR = "data/stream"
+
+
+class PickleLog(Sequence):
+    """
+    read-only view of a file of pickled records written one after the other, with the byte offset of every record in
+    {path}.index.npy. log[i] unpickles record i only, iterating yields the records one by one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = np.load(f"{path}.index.npy")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _record(self, index: int):
+        with open(self.path, "rb") as log_file:
+            log_file.seek(int(self.offsets[index]))
+            return pickle.load(log_file)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._record(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"record index {index} out of range")
+        return self._record(index)
+
+    def __iter__(self):
+        with open(self.path, "rb") as log_file:
+            for _ in range(len(self)):
+                yield pickle.load(log_file)
+
+
+def _append_record(log_file, offsets: list, record):
+    offsets.append(log_file.tell())
+    pickle.dump(record, log_file)
+
+
+def _add_window(meta_community_network: nx.DiGraph, index: int, n_communities: int, window_events: tuple = None):
+    """
+    add the communities of snapshot index to the meta community network and the GED result of the window between
+    snapshot index - 1 and index, in the order of _build_meta_community_network
+    """
+    for index_j in range(n_communities):
+        meta_community_network.add_node(f"T{index}C{index_j}", pre="None", nex="None")
+    if window_events is None:
+        return
+    possible_events, events = window_events
+    for source, target, _ in possible_events:
+        meta_community_network.add_edge("T{:d}C".format(index - 1) + source[2:], "T{:d}C".format(index) + target[2:])
+    for node, event_type in events:
+        if node[0] == 'A':
+            meta_community_network.nodes["T{:d}C".format(index - 1) + node[2:]]["nex"] = event_type
+        else:
+            meta_community_network.nodes["T{:d}C".format(index) + node[2:]]["pre"] = event_type
+
+
+def open_stream(path: str = STREAM_DIR) -> dict:
+    """
+    open the results of stream_pipeline lazily
+    :param path: stream directory
+    :return: {"snapshots": SnapshotStore (None if not stored), "timestamps": [end_time...],
+             "communities": PickleLog of [[node...] of each community], "social_positions": PickleLog of
+             {node: score}, "features": memory-mapped FeatureTensor, "meta_community_network": nx.DiGraph}
+    """
+    meta = json.load(open(os.path.join(path, "meta.json"), encoding="utf8"))
+    snapshots = open_snapshot_store(os.path.join(path, "snapshots"))["snapshots"] if meta["snapshots"] else None
+    features = FeatureTensor(np.load(os.path.join(path, "features.npy"), mmap_mode="r"),
+                             np.load(os.path.join(path, "feature_offsets.npy")))
+    return {"snapshots": snapshots, "timestamps": meta["timestamps"],
+            "communities": PickleLog(os.path.join(path, "communities.pkl")),
+            "social_positions": PickleLog(os.path.join(path, "social_positions.pkl")), "features": features,
+            "meta_community_network": pickle.load(open(os.path.join(path, "meta_community_network.pkl"), "rb"))}
+
+
+@profiled
+def stream_pipeline(end_time: dt, window_size: int, edges: list, nodes: list, path: str = STREAM_DIR,
+                    edge_log=None, history_end: str = HISTORY_END, community_mode: str = "parallel", seed: int = 0,
+                    tol: float = 1e-06, alpha: float = 0.5, beta: float = 0.5, method: str = "index",
+                    engine: str = "sweep", closeness_options: dict = None, store_snapshots: bool = True) -> dict:
+    """
+    run snapshots, communities, social positions, GED and features with bounded memory. The snapshots come from the
+    iter_snapshots generator and each one passes through all stages before the next is built, so only the previous
+    window (its communities, scores and Louvain partition) is held besides the meta community network. Every result
+    is appended to files under path as soon as it exists.
+    The results equal generate_snapshots, static_community_detection(mode=community_mode, seed=seed),
+    social_position_score(engine="networkx", tol=tol), meta_community_network_generation(alpha, beta, method=method)
+    and feature_extraction(engine=engine, closeness_options=closeness_options).
+    :param end_time: timestamp of the first snapshot
+    :param window_size: days between snapshots
+    :param edges: a list of edges
+    :param nodes: a list of nodes
+    :param path: stream directory. If it holds a finished run with the same inputs and parameters, that run is opened
+                 instead, a run with other ones is replaced
+    :param edge_log: an edge log loaded by ingest.load_edge_log, used instead of edges and nodes if provided
+    :param history_end: snapshots are generated for end times before this date
+    :param community_mode: "parallel" (snapshot i uses the random seed seed + i) or "incremental" (Louvain starts
+                           from the partition of the previous snapshot), see static_community_detection
+    :param seed: base random seed of the community detection
+    :param tol: PageRank error tolerance
+    :param alpha: GED alpha
+    :param beta: GED beta
+    :param method: GED method
+    :param engine: feature extraction engine, see FEATURE_ENGINES
+    :param closeness_options: options of community_features.closeness_centrality
+    :param store_snapshots: also write the snapshots to path/snapshots as a snapshot store
+    :return: the results opened by open_stream
+    """
+    if community_mode not in ["parallel", "incremental"]:
+        raise ValueError(f"unknown streaming community detection mode {community_mode}")
+    # normalized through JSON to compare with the stored ones
+    parameters = json.loads(json.dumps({
+        "end_time": end_time.strftime("%Y-%m-%d"), "window_size": window_size, "history_end": history_end,
+        "input": fingerprint(edge_log if edge_log is not None else (edges, nodes)), "community_mode": community_mode,
+        "seed": seed, "tol": tol, "alpha": alpha, "beta": beta, "method": method, "engine": engine,
+        "closeness_options": closeness_options, "store_snapshots": store_snapshots}))
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        if json.load(open(meta_path, encoding="utf8")).get("parameters") == parameters:
+            print(f"opening stream results from {path}")
+            return open_stream(path)
+        print(f"stream results in {path} were built with other parameters, rebuilding them")
+        os.remove(meta_path)
+    os.makedirs(path, exist_ok=True)
+    extract = FEATURE_ENGINES[engine]
+    writer = SnapshotStoreWriter(os.path.join(path, "snapshots")) if store_snapshots else None
+    community_file = open(os.path.join(path, "communities.pkl"), "wb")
+    social_position_file = open(os.path.join(path, "social_positions.pkl"), "wb")
+    feature_file = open(os.path.join(path, "features.raw"), "wb")
+    community_offsets, social_position_offsets, feature_offsets = [], [], [0]
+    timestamps, meta_community_network = [], nx.DiGraph()
+    partition, previous = {}, None
+    try:
+        for index, (timestamp, snapshot) in enumerate(iter_snapshots(end_time, window_size, edges, nodes,
+                                                                     edge_log=edge_log, history_end=history_end)):
+            with section(f"snapshot {index}"):
+                if community_mode == "incremental":
+                    partition = _louvain_partition(snapshot, seed + index, _warm_start(snapshot, partition))
+                else:
+                    partition = _louvain_partition(snapshot, seed + index)
+                # only stable communities will be included, in the order of the NodeClustering
+                communities = [community for community in
+                               _node_clustering(snapshot, partition, seed + index).communities if len(community) >= 3]
+                social_position = dict(nx.pagerank(snapshot, alpha=0.85, weight="weight", tol=tol))
+                window_events = None
+                if previous is not None:
+                    window_events = GED(previous[0], communities, previous[1], social_position, alpha, beta, method)
+                _add_window(meta_community_network, index, len(communities), window_events)
+                features = extract(snapshot, communities, social_position, closeness_options)
+
+                if writer is not None:
+                    writer.append(snapshot, timestamp)
+                _append_record(community_file, community_offsets, communities)
+                _append_record(social_position_file, social_position_offsets, social_position)
+                feature_file.write(np.array(features, dtype=np.float64).reshape(len(features), len(FEATURE_NAMES))
+                                   .tobytes())
+                feature_offsets.append(feature_offsets[-1] + len(features))
+                timestamps.append(timestamp)
+                previous = (communities, social_position)
+    except BaseException:
+        # no partial results are left behind
+        if writer is not None:
+            writer.abort()
+        for log_file in [community_file, social_position_file, feature_file]:
+            log_file.close()
+            os.remove(log_file.name)
+        raise
+
+    if writer is not None:
+        writer.close()
+    for log_file in [community_file, social_position_file, feature_file]:
+        log_file.close()
+    np.save(os.path.join(path, "communities.pkl.index.npy"), np.array(community_offsets, dtype=np.int64))
+    np.save(os.path.join(path, "social_positions.pkl.index.npy"), np.array(social_position_offsets, dtype=np.int64))
+    _raw_to_npy(os.path.join(path, "features.raw"), os.path.join(path, "features.npy"), np.float64,
+                (feature_offsets[-1], len(FEATURE_NAMES)))
+    np.save(os.path.join(path, "feature_offsets.npy"), np.array(feature_offsets, dtype=np.int64))
+    pickle.dump(meta_community_network, open(os.path.join(path, "meta_community_network.pkl"), "wb"))
+    # written last, marks a finished run
+    json.dump({"timestamps": timestamps, "snapshots": store_snapshots, "parameters": parameters},
+              open(os.path.join(path, "meta.json"), "w", encoding="utf8"))
+    return open_stream(path)
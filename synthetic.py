@@ -0,0 +1,208 @@
+import json
+import os
+from datetime import datetime as dt
+
+import numpy as np
+
+# sizes of the bundled data set, scale 1 reproduces them
+BASE_STAKEHOLDERS, BASE_SERVICES, BASE_EVENTS = 550, 866, 1902
+# share of the edges per year, as in data/edges.json
+YEAR_SHARES = {2015: 0.003, 2016: 0.04, 2017: 0.475, 2018: 0.35, 2019: 0.132}
+LAST_DAY = "2019-12-29"
+# evolutionary relations of data/edges.json: (r, endpoints, share). "SS" links two stakeholders, "SV" a stakeholder
+# and a service, "mixed" either. The rest of the edges get rare relations, see RARE_RELATIONS
+RELATIONS = [
+    ("release", "SV", 0.108), ("co-occurrence", "mixed", 0.066), ("cooperate", "SS", 0.053),
+    ("BelongTo", "SV", 0.043), ("join", "SS", 0.041), ("locate", "SS", 0.024), ("完成", "SV", 0.019),
+    ("获", "SV", 0.017), ("invest", "SS", 0.016), ("exit", "SS", 0.016), ("投放", "SV", 0.011),
+    ("接入", "SS", 0.010), ("acquisition", "SS", 0.009), ("conflict", "SS", 0.004),
+]
+RARE_RELATIONS = 800
+# number of evolutionary edges generated from one event, P(0), P(1), ...
+EDGES_PER_EVENT = [0.12, 0.56, 0.23, 0.09]
+RECIPIENT_PROBABILITY = 0.35
+# probability that the partner of an event is picked in the sector of its actor
+SECTOR_LOCALITY = 0.8
+SECTOR_SIZE = 40
+# structural edges (type "structural") between services of a sector, per evolutionary edge, the share of them without
+# a timestamp, which exist in every snapshot, and their relations: data/edges.json has 3 of them for 2531 evolutionary
+# edges, 2 undated. Like there, they are weighted and aged by their r
+STRUCTURAL_SHARE = 3 / 2531
+STRUCTURAL_UNDATED = 2 / 3
+STRUCTURAL_RELATIONS = ["overlap", "顺承", "加入"]
+
+
+def _weighted_choice(rng, weights: np.ndarray, sectors: np.ndarray, n_sectors: int, draws: np.ndarray) -> np.ndarray:
+    """
+    pick one node per draw with probability proportional to its weight, inside the sector of the draw (-1 for any
+    sector)
+    :param weights: weight of each node
+    :param sectors: sector of each node
+    :param draws: sector of each draw
+    :return: node indices
+    """
+    order = np.argsort(sectors, kind="stable")
+    cumulative = np.concatenate([[0.0], np.cumsum(weights[order])])
+    bounds = np.searchsorted(sectors[order], np.arange(n_sectors + 1))
+    low = np.where(draws < 0, 0.0, cumulative[bounds[np.maximum(draws, 0)]])
+    high = np.where(draws < 0, cumulative[-1], cumulative[bounds[np.minimum(np.maximum(draws, 0) + 1, n_sectors)]])
+    # a sector without nodes falls back to every node
+    empty = high <= low
+    low, high = np.where(empty, 0.0, low), np.where(empty, cumulative[-1], high)
+    picks = np.searchsorted(cumulative, low + rng.random(len(draws)) * (high - low), side="right") - 1
+    return order[np.clip(picks, 0, len(order) - 1)]
+
+
+def _local(rng, sectors: np.ndarray) -> np.ndarray:
+    return np.where(rng.random(len(sectors)) < SECTOR_LOCALITY, sectors, -1)
+
+
+def ecosystem_arrays(scale: float = 1.0, seed: int = 0) -> dict:
+    """
+    draw a synthetic ecosystem shaped like the bundled data. Stakeholders and services belong to sectors of about
+    SECTOR_SIZE nodes and get a heavy tailed popularity, so that communities and hubs emerge. Every event has an actor
+    (stakeholder), an object (service) and maybe a recipient (stakeholder) from mostly the same sector, plus a few
+    evolutionary edges between them with relations drawn from RELATIONS. Services are also linked by structural edges,
+    STRUCTURAL_SHARE of the evolutionary ones.
+    :param scale: size relative to the bundled data
+    :param seed: random seed
+    :return: a dict of numpy arrays: "stakeholders", "services", "events" (counts), "event_day" (day ordinal),
+             "actor", "object", "recipient" (-1 if none), "edge_event", "edge_source", "edge_target" (node indices
+             over stakeholders then services), "edge_relation" (index into relation_names), "relation_names" and
+             "structural_source", "structural_target", "structural_day" (-1 if undated), "structural_relation"
+             (index into STRUCTURAL_RELATIONS) of the structural edges
+    """
+    rng = np.random.default_rng(seed)
+    n_stakeholders = max(2, round(BASE_STAKEHOLDERS * scale))
+    n_services = max(1, round(BASE_SERVICES * scale))
+    n_events = max(1, round(BASE_EVENTS * scale))
+    n_sectors = max(1, (n_stakeholders + n_services) // SECTOR_SIZE)
+    stakeholder_sectors = rng.integers(n_sectors, size=n_stakeholders)
+    service_sectors = rng.integers(n_sectors, size=n_services)
+    stakeholder_weights = rng.pareto(1.2, n_stakeholders) + 1
+    service_weights = rng.pareto(1.2, n_services) + 1
+
+    years = np.array(list(YEAR_SHARES))
+    shares = np.array(list(YEAR_SHARES.values()))
+    year = rng.choice(years, size=n_events, p=shares / shares.sum())
+    first_days = {y: dt(int(y), 1, 1).toordinal() for y in years}
+    last_days = {y: min(dt(int(y), 12, 31), dt.strptime(LAST_DAY, "%Y-%m-%d")).toordinal() for y in years}
+    start = np.array([first_days[y] for y in year])
+    length = np.array([last_days[y] for y in year]) - start + 1
+    event_day = start + (rng.random(n_events) * length).astype(np.int64)
+
+    actor = _weighted_choice(rng, stakeholder_weights, stakeholder_sectors, n_sectors,
+                             np.full(n_events, -1))
+    sector = stakeholder_sectors[actor]
+    event_object = _weighted_choice(rng, service_weights, service_sectors, n_sectors, _local(rng, sector))
+    recipient = _weighted_choice(rng, stakeholder_weights, stakeholder_sectors, n_sectors, _local(rng, sector))
+    recipient[(rng.random(n_events) >= RECIPIENT_PROBABILITY) | (recipient == actor)] = -1
+
+    counts = rng.choice(len(EDGES_PER_EVENT), size=n_events, p=EDGES_PER_EVENT)
+    edge_event = np.repeat(np.arange(n_events), counts)
+    rare_share = 1 - sum(share for _, _, share in RELATIONS)
+    rare_weights = 1 / np.arange(1, RARE_RELATIONS + 1) ** 1.1
+    relation_names = [r for r, _, _ in RELATIONS] + [f"relation-{k}" for k in range(RARE_RELATIONS)]
+    relation_kinds = np.array([kind for _, kind, _ in RELATIONS] + ["mixed"] * RARE_RELATIONS)
+    relation_shares = np.concatenate([[share for _, _, share in RELATIONS],
+                                      rare_share * rare_weights / rare_weights.sum()])
+    edge_relation = rng.choice(len(relation_names), size=len(edge_event), p=relation_shares / relation_shares.sum())
+
+    # stakeholder-stakeholder edges go to the recipient (or another stakeholder of the sector), the others to the object
+    kind = relation_kinds[edge_relation]
+    kind = np.where(kind == "mixed", np.where(rng.random(len(kind)) < 0.5, "SS", "SV"), kind)
+    partner = recipient[edge_event]
+    missing = partner < 0
+    partner[missing] = _weighted_choice(rng, stakeholder_weights, stakeholder_sectors, n_sectors,
+                                        _local(rng, sector[edge_event][missing]))
+    edge_source = actor[edge_event]
+    edge_target = np.where(kind == "SS", partner, n_stakeholders + event_object[edge_event])
+    keep = edge_source != edge_target
+
+    n_structural = round(STRUCTURAL_SHARE * keep.sum())
+    structural_source = rng.integers(n_services, size=n_structural)
+    structural_target = _weighted_choice(rng, service_weights, service_sectors, n_sectors,
+                                         _local(rng, service_sectors[structural_source]))
+    structural_day = np.where(rng.random(n_structural) < STRUCTURAL_UNDATED, -1,
+                              event_day[rng.integers(n_events, size=n_structural)])
+    structural_relation = rng.integers(len(STRUCTURAL_RELATIONS), size=n_structural)
+    structural = structural_source != structural_target
+    return {"stakeholders": n_stakeholders, "services": n_services, "events": n_events, "event_day": event_day,
+            "actor": actor, "object": event_object, "recipient": recipient, "edge_event": edge_event[keep],
+            "edge_source": edge_source[keep], "edge_target": edge_target[keep],
+            "edge_relation": edge_relation[keep], "relation_names": relation_names,
+            "structural_source": n_stakeholders + structural_source[structural],
+            "structural_target": n_stakeholders + structural_target[structural],
+            "structural_day": structural_day[structural], "structural_relation": structural_relation[structural]}
+
+
+def iter_ecosystem(scale: float = 1.0, seed: int = 0):
+    """
+    stream a synthetic ecosystem in the format of data/nodes.json and data/edges.json
+    :return: generator of ("node" or "edge", record) where record is the {"data": ..., "classes": ...} line object
+    """
+    arrays = ecosystem_arrays(scale, seed)
+    n_stakeholders = arrays["stakeholders"]
+    names = [f"S{i}" for i in range(n_stakeholders)] + [f"V{i}" for i in range(arrays["services"])]
+    for i in range(n_stakeholders):
+        yield "node", {"data": {"id": names[i], "label": names[i], "type": "Stakeholder", "attr": {}},
+                       "classes": "msem-stakeholder"}
+    for i in range(n_stakeholders, len(names)):
+        yield "node", {"data": {"id": names[i], "label": names[i], "type": "Service", "attr": {}},
+                       "classes": "msem-service"}
+    timestamps = [dt.fromordinal(int(day)).strftime("%Y-%m-%d") for day in arrays["event_day"]]
+    for i, timestamp in enumerate(timestamps):
+        yield "node", {"data": {"id": f"E{i}", "label": f"E{i}", "timestamp": timestamp, "type": "Event"},
+                       "classes": "msem-evnet"}
+
+    has_x = [("hasActor", arrays["actor"]), ("hasObject", arrays["object"] + n_stakeholders),
+             ("hasRecipient", arrays["recipient"])]
+    for i, timestamp in enumerate(timestamps):
+        for r, targets in has_x:
+            if targets[i] >= 0:
+                target = names[targets[i]]
+                yield "edge", {"data": {"id": f"E{i}#{target}#{timestamp}#{r}", "source": f"E{i}", "target": target,
+                                        "timestamp": timestamp, "type": "hasX", "r": r},
+                               "classes": "msem-strutral msem-hasx"}
+    relation_names = arrays["relation_names"]
+    for event, source, target, relation in zip(arrays["edge_event"].tolist(), arrays["edge_source"].tolist(),
+                                               arrays["edge_target"].tolist(), arrays["edge_relation"].tolist()):
+        source, target, r, timestamp = names[source], names[target], relation_names[relation], timestamps[event]
+        yield "edge", {"data": {"id": f"{source}#{target}#{timestamp}#{r}", "source": source, "target": target,
+                                "r": r, "timestamp": timestamp, "type": "evolutionary", "generated_from": f"E{event}"},
+                       "classes": "msem-evolutionary"}
+    for source, target, day, relation in zip(arrays["structural_source"].tolist(),
+                                             arrays["structural_target"].tolist(), arrays["structural_day"].tolist(),
+                                             arrays["structural_relation"].tolist()):
+        source, target, r = names[source], names[target], STRUCTURAL_RELATIONS[relation]
+        timestamp = dt.fromordinal(day).strftime("%Y-%m-%d") if day >= 0 else None
+        data = {"id": f"{source}#{target}#{timestamp}#{r}", "source": source, "target": target, "r": r,
+                "type": "structural"}
+        if timestamp is not None:
+            data["timestamp"] = timestamp
+        yield "edge", {"data": data, "classes": "msem-strutral"}
+
+
+def generate_ecosystem(scale: float = 1.0, seed: int = 0) -> tuple:
+    """
+    :param scale: size relative to the bundled data
+    :param seed: random seed
+    :return: (nodes, edges), lists of "data" dicts like the ones test.py reads
+    """
+    nodes, edges = [], []
+    for kind, record in iter_ecosystem(scale, seed):
+        (nodes if kind == "node" else edges).append(record["data"])
+    return nodes, edges
+
+
+def write_ecosystem(path: str, scale: float = 1.0, seed: int = 0) -> tuple:
+    """
+    stream a synthetic ecosystem to path/nodes.json and path/edges.json without holding it in memory
+    :return: (nodes file, edges file)
+    """
+    os.makedirs(path, exist_ok=True)
+    nodes_path, edges_path = os.path.join(path, "nodes.json"), os.path.join(path, "edges.json")
+    with open(nodes_path, "w", encoding="utf8") as nodes_file, open(edges_path, "w", encoding="utf8") as edges_file:
+        for kind, record in iter_ecosystem(scale, seed):
+            (nodes_file if kind == "node" else edges_file).write(json.dumps(record, ensure_ascii=False) + "\n")
+    return nodes_path, edges_path
@@ -0,0 +1,28 @@
+import json
+import os
+import sys
+from datetime import datetime as dt
+
+import networkx as nx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from community_operations import FEATURE_ENGINES, _louvain_partition, _node_clustering  # noqa: E402
+from generate_snapshots import generate_snapshots, positive_snapshots  # noqa: E402
+
+
+def _read_jsonl(name: str) -> list:
+    return [json.loads(line)["data"] for line in open(os.path.join(ROOT, "data", name), encoding="utf8")]
+
+
+def test_sweep_engine_equals_community_engine():
+    snapshots = generate_snapshots(dt(2016, 8, 1), 30, _read_jsonl("edges.json"), _read_jsonl("nodes.json"),
+                                   data_dir=None)
+    snapshots, _ = positive_snapshots(snapshots)
+    for index, snapshot in enumerate(snapshots["snapshots"]):
+        clustering = _node_clustering(snapshot, _louvain_partition(snapshot, index), index)
+        communities = [community for community in clustering.communities if len(community) >= 3]
+        social_position = dict(nx.pagerank(snapshot, alpha=0.85, weight="weight"))
+        expected = FEATURE_ENGINES["community"](snapshot, communities, social_position)
+        assert FEATURE_ENGINES["sweep"](snapshot, communities, social_position) == expected, f"snapshot {index}"